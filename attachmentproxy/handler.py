@@ -39,7 +39,8 @@ class AttachmentProxyHandler(webapp2.RequestHandler):
     else:
       # Retrieve the attachment's metadata.
       attachment_metadata = self.mirror_service.timeline().attachments().get(
-          itemId=item_id, attachmentId=attachment_id).execute()
+          itemId=item_id, attachmentId=attachment_id,
+          fields='contentType,contentUrl').execute()
       content_type = str(attachment_metadata.get('contentType'))
       content_url = attachment_metadata.get('contentUrl')
 
@@ -0,0 +1,129 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches kept in front of the datastore."""
+
+
+import collections
+import threading
+import time
+
+
+class LocalCache(object):
+  """Least recently used cache local to the instance, with expiring entries.
+
+  Implements the get/set/delete interface of memcache, so that it can be used
+  wherever a memcache-like cache is accepted. Values are shared between the
+  threads of the instance and must therefore not be mutated.
+  """
+
+  def __init__(self, max_size=1000, ttl=60):
+    """Create a new LocalCache.
+
+    Args:
+      max_size: Maximum number of entries kept, the least recently used ones
+        are evicted first.
+      ttl: Number of seconds entries are kept.
+    """
+    self._max_size = max_size
+    self._ttl = ttl
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """Return the value cached under key, or None."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        return None
+      value, expires = entry
+      if time.time() >= expires:
+        return None
+      self._entries[key] = entry
+      return value
+
+  def set(self, key, value):
+    """Cache value under key."""
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (value, time.time() + self._ttl)
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+  def delete(self, key):
+    """Remove the value cached under key, if any."""
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    """Remove every entry."""
+    with self._lock:
+      self._entries.clear()
+
+
+class TwoTierCache(object):
+  """Write-through cache keeping a LocalCache in front of a shared cache.
+
+  Reads are served by the local tier when possible and fill it from the shared
+  one otherwise. Writes and deletes go to both tiers, so an instance always
+  sees its own writes immediately; writes made by other instances become
+  visible here once the local entry expires.
+  """
+
+  def __init__(self, shared, key_prefix='', local=None):
+    """Create a new TwoTierCache.
+
+    Args:
+      shared: memcache-like cache shared by every instance, such as the
+        google.appengine.api.memcache module, or
+        oauth2client.client.MemoryCache when there is no memcache.
+      key_prefix: string, prepended to the keys in the shared tier to keep
+        them apart from other users of the shared cache.
+      local: LocalCache, the local tier, a new one is created if None.
+    """
+    self._shared = shared
+    self._key_prefix = key_prefix
+    self._local = local if local is not None else LocalCache()
+
+  def get(self, key):
+    """Return the value cached under key, or None."""
+    value = self._local.get(key)
+    if value is None:
+      value = self._shared.get(self._key_prefix + key)
+      if value is not None:
+        self._local.set(key, value)
+    return value
+
+  def get_shared(self, key):
+    """Return the value cached under key in the shared tier, or None.
+
+    Use this where a value written by another instance must be seen, the local
+    tier is updated with what the shared one holds.
+    """
+    value = self._shared.get(self._key_prefix + key)
+    if value is None:
+      self._local.delete(key)
+    else:
+      self._local.set(key, value)
+    return value
+
+  def set(self, key, value):
+    """Cache value under key in both tiers."""
+    self._shared.set(self._key_prefix + key, value)
+    self._local.set(key, value)
+
+  def delete(self, key):
+    """Remove the value cached under key from both tiers."""
+    self._shared.delete(self._key_prefix + key)
+    self._local.delete(key)
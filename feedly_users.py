@@ -0,0 +1,144 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Access to the FeedlyUser entities, keyed by Google user ID."""
+
+
+import datetime
+import logging
+
+from google.appengine.ext import db
+
+from model import FeedlyUser
+import migrations
+
+
+# Name of the migration keying the FeedlyUser entities by user ID, finished
+# once tasks/migrate_feedly_users has migrated all of them.
+MIGRATION = 'feedly_users_by_key_name'
+
+# Users not seen for this long are inactive, the cron tasks stop refreshing
+# their tokens ahead of expiry.
+ACTIVE_PERIOD = datetime.timedelta(days=14)
+
+# last_seen is only rewritten once it is this old, to spare a put per request.
+LAST_SEEN_RESOLUTION = datetime.timedelta(hours=12)
+
+
+def migrate_legacy_user(legacy):
+  """Move a FeedlyUser stored under an automatic ID to its user ID key.
+
+  The move is done in a cross-group transaction, so that requests migrating
+  the same entity at the same time neither duplicate it nor leave it half
+  migrated.
+
+  Args:
+    legacy: FeedlyUser entity whose key has a numeric ID.
+  Returns:
+    The FeedlyUser entity keyed by the user ID.
+  """
+  def txn():
+    user = FeedlyUser.get_by_key_name(legacy.id)
+    current = db.get(legacy.key())
+    if current is None:
+      # Migrated by someone else meanwhile.
+      return user
+    if user is None:
+      user = FeedlyUser(
+          key_name=current.id,
+          id=current.id,
+          feedly_access_token=current.feedly_access_token,
+          feedly_refresh_token=current.feedly_refresh_token,
+          feedly_token_expiry=current.feedly_token_expiry,
+          subscription_verified=current.subscription_verified,
+          last_seen=current.last_seen)
+      user.put()
+    db.delete(current)
+    return user
+
+  user = db.run_in_transaction_options(
+      db.create_transaction_options(xg=True), txn)
+  logging.info('Migrated FeedlyUser %s', legacy.id)
+  return user
+
+
+class FeedlyUserRepository(object):
+  """Loads and stores the FeedlyUser entities needed by a request.
+
+  Entities are fetched by key and kept for the lifetime of the repository, so
+  a request handler holding one reads each user at most once. Until MIGRATION
+  is finished, entities that predate keying by user ID are migrated the first
+  time they are read.
+  """
+
+  def __init__(self):
+    """Create a new, empty FeedlyUserRepository."""
+    self._users = {}
+
+  def get(self, userid):
+    """Return the FeedlyUser of a Google user.
+
+    Args:
+      userid: Google user ID.
+    Returns:
+      FeedlyUser entity, or None if the user never authorized Feedly.
+    """
+    if userid in self._users:
+      return self._users[userid]
+    user = FeedlyUser.get_by_key_name(userid)
+    if user is None and not migrations.is_finished(MIGRATION):
+      legacy = FeedlyUser.all().filter('id =', userid).get()
+      if legacy is not None:
+        user = migrate_legacy_user(legacy)
+    self._users[userid] = user
+    return user
+
+  def mark_seen(self, userid):
+    """Record that a user is active, at most once per LAST_SEEN_RESOLUTION.
+
+    Args:
+      userid: Google user ID.
+    Returns:
+      FeedlyUser entity, or None if the user never authorized Feedly.
+    """
+    user = self.get(userid)
+    now = datetime.datetime.utcnow()
+    if user is not None and (user.last_seen is None or
+                             now - user.last_seen >= LAST_SEEN_RESOLUTION):
+      user.last_seen = now
+      user.put()
+    return user
+
+  def save_tokens(self, userid, access_token, refresh_token=None,
+                  expiry=None):
+    """Store the Feedly tokens of a Google user in a single put.
+
+    Args:
+      userid: Google user ID.
+      access_token: string, Feedly access token.
+      refresh_token: string, Feedly refresh token, left unchanged if None.
+      expiry: datetime.datetime, when the access token expires in UTC.
+    Returns:
+      The updated FeedlyUser entity, created if it didn't exist.
+    """
+    user = self.get(userid)
+    if user is None:
+      user = FeedlyUser(key_name=userid, id=userid)
+      self._users[userid] = user
+    user.feedly_access_token = access_token
+    if refresh_token is not None:
+      user.feedly_refresh_token = refresh_token
+    user.feedly_token_expiry = expiry
+    user.put()
+    return user
@@ -19,6 +19,7 @@ A client library for Google's discovery based APIs.
 
 __author__ = 'jcgregorio@google.com (Joe Gregorio)'
 __all__ = [
+    'DiscoveryBundle',
     'build',
     'build_from_document',
     'fix_method_name',
@@ -32,9 +33,13 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.nonmultipart import MIMENonMultipart
 import keyword
 import logging
+import marshal
 import mimetypes
 import os
 import re
+import threading
+import time
+import types
 import urllib
 import urlparse
 
@@ -77,6 +82,8 @@ VARNAME = re.compile('[a-zA-Z0-9_-]+')
 DISCOVERY_URI = ('https://www.googleapis.com/discovery/v1/apis/'
                  '{api}/{apiVersion}/rest')
 DEFAULT_METHOD_DOC = 'A description of how to use this function'
+# Seconds a cached discovery document is used before it is revalidated.
+DISCOVERY_CACHE_TTL = 60 * 60 * 24
 HTTP_PAYLOAD_METHODS = frozenset(['PUT', 'POST', 'PATCH'])
 _MEDIA_SIZE_BIT_SHIFTS = {'KB': 10, 'MB': 20, 'GB': 30, 'TB': 40}
 BODY_PARAMETER_DEFAULT_VALUE = {
@@ -139,6 +146,225 @@ def key2param(key):
   return ''.join(result)
 
 
+class _DiscoveryCacheEntry(object):
+  """A discovery document held by _DiscoveryCache.
+
+  Attributes:
+    service: object, the deserialized discovery document.
+    content: string, the discovery document as returned by the server.
+    etag: string, ETag the server returned with the document, or None.
+    fetched: float, time.time() when the document was last fetched or
+        revalidated.
+  """
+
+  def __init__(self, service, content, etag, fetched):
+    self.service = service
+    self.content = content
+    self.etag = etag
+    self.fetched = fetched
+
+  def is_fresh(self, ttl):
+    """True if the entry may be used without revalidating it."""
+    return time.time() - self.fetched < ttl
+
+  def to_json(self):
+    return simplejson.dumps({
+        'content': self.content,
+        'etag': self.etag,
+        'fetched': self.fetched,
+        })
+
+  @staticmethod
+  def from_json(s):
+    data = simplejson.loads(s)
+    content = data['content']
+    return _DiscoveryCacheEntry(simplejson.loads(content), content,
+                                data.get('etag'), data['fetched'])
+
+
+class _DiscoveryCache(object):
+  """Process-wide cache of discovery documents.
+
+  The first tier is an in-memory map from discovery URI to the parsed document,
+  shared by every call to build() in the process. An optional second tier is
+  any object with get(), set() and delete() methods, such as the App Engine
+  memcache module or httplib2.FileCache, which lets other processes skip the
+  network as well.
+  """
+
+  # Prefix for keys stored in the second tier.
+  KEY_PREFIX = 'apiclient#discovery#'
+
+  def __init__(self):
+    self._entries = {}
+    self._lock = threading.Lock()
+
+  def get(self, url, backend=None):
+    """Look up the discovery document for a URI.
+
+    Args:
+      url: string, the discovery URI.
+      backend: object, optional second tier cache.
+
+    Returns:
+      A _DiscoveryCacheEntry, or None if the document is not cached.
+    """
+    entry = self._entries.get(url)
+    if entry is None and backend is not None:
+      try:
+        value = backend.get(self.KEY_PREFIX + url)
+        if value:
+          entry = _DiscoveryCacheEntry.from_json(value)
+      except (ValueError, KeyError), e:
+        logger.warning('Ignoring unreadable cached discovery document: %s', e)
+        backend.delete(self.KEY_PREFIX + url)
+        entry = None
+      if entry is not None:
+        with self._lock:
+          entry = self._entries.setdefault(url, entry)
+    return entry
+
+  def set(self, url, entry, backend=None):
+    """Store the discovery document for a URI in every tier.
+
+    Args:
+      url: string, the discovery URI.
+      entry: _DiscoveryCacheEntry, the document to store.
+      backend: object, optional second tier cache.
+    """
+    with self._lock:
+      self._entries[url] = entry
+    if backend is not None:
+      backend.set(self.KEY_PREFIX + url, entry.to_json())
+
+  def clear(self):
+    """Drop every document held in memory."""
+    with self._lock:
+      self._entries.clear()
+
+
+_discovery_cache = _DiscoveryCache()
+
+
+# Version of the layout of the files written by DiscoveryBundle.save.
+BUNDLE_FORMAT_VERSION = 1
+
+# Age in seconds after which the documents of a bundle are no longer used.
+BUNDLE_MAX_AGE = 60*60*24*30
+
+
+class DiscoveryBundle(object):
+  """Discovery documents snapshotted to a file ahead of time.
+
+  A bundle lets build() create services without touching the network on a
+  new process. The documents are stored already parsed and with their
+  parameters normalized, in marshal format, so loading them is a single read
+  with no JSON parsing. Bundles are written by tools/build_discovery_bundle.py.
+  """
+
+  def __init__(self, entries, created):
+    """Constructor for DiscoveryBundle.
+
+    Args:
+      entries: dict, map from discovery URI to _DiscoveryCacheEntry.
+      created: float, time.time() when the documents were fetched.
+    """
+    self.entries = entries
+    self.created = created
+    # Whether the bundle was found stale already, so that it is only logged
+    # once.
+    self._stale_logged = False
+
+  @staticmethod
+  def load(path):
+    """Load a bundle from a file.
+
+    Args:
+      path: string, path of the bundle.
+
+    Returns:
+      The DiscoveryBundle, or None if the file is missing, unreadable, or was
+      written in another format or by another version of Python.
+    """
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      return None
+    try:
+      try:
+        data = marshal.load(f)
+      except (EOFError, ValueError, TypeError), e:
+        logger.warning('Ignoring unreadable discovery bundle %s: %s', path, e)
+        return None
+    finally:
+      f.close()
+    if (not isinstance(data, dict) or
+        data.get('format') != BUNDLE_FORMAT_VERSION or
+        data.get('marshal') != marshal.version):
+      logger.warning('Ignoring discovery bundle %s in another format', path)
+      return None
+    entries = {}
+    for url, document in data['documents'].iteritems():
+      entries[url] = _DiscoveryCacheEntry(
+          document['service'], document['content'], document['etag'],
+          data['created'])
+    return DiscoveryBundle(entries, data['created'])
+
+  def save(self, path):
+    """Write the bundle to a file.
+
+    Args:
+      path: string, path of the bundle.
+    """
+    documents = {}
+    for url, entry in self.entries.iteritems():
+      documents[url] = {
+          'service': entry.service,
+          'content': entry.content,
+          'etag': entry.etag,
+          }
+    data = {
+        'format': BUNDLE_FORMAT_VERSION,
+        'marshal': marshal.version,
+        'created': self.created,
+        'documents': documents,
+        }
+    f = open(path, 'wb')
+    try:
+      marshal.dump(data, f, marshal.version)
+    finally:
+      f.close()
+
+  def is_stale(self, max_age=BUNDLE_MAX_AGE):
+    """True if the documents are too old to be used."""
+    return time.time() - self.created >= max_age
+
+  def get(self, url):
+    """Look up the discovery document for a URI.
+
+    Args:
+      url: string, the discovery URI.
+
+    Returns:
+      A _DiscoveryCacheEntry that counts as just fetched, or None if the
+      bundle doesn't have the document or is stale.
+    """
+    entry = self.entries.get(url)
+    if entry is None:
+      return None
+    if self.is_stale():
+      if not self._stale_logged:
+        self._stale_logged = True
+        logger.warning('Ignoring discovery bundle created %s, it is older '
+                       'than %d seconds',
+                       time.strftime('%Y-%m-%d %H:%M:%S',
+                                     time.gmtime(self.created)),
+                       BUNDLE_MAX_AGE)
+      return None
+    return _DiscoveryCacheEntry(entry.service, entry.content, entry.etag,
+                                time.time())
+
+
 @positional(2)
 def build(serviceName,
           version,
@@ -146,12 +372,19 @@ def build(serviceName,
           discoveryServiceUrl=DISCOVERY_URI,
           developerKey=None,
           model=None,
-          requestBuilder=HttpRequest):
+          requestBuilder=HttpRequest,
+          cache=None,
+          bundle=None):
   """Construct a Resource for interacting with an API.
 
   Construct a Resource object for interacting with an API. The serviceName and
   version are the names from the Discovery service.
 
+  Discovery documents are cached for the lifetime of the process, so only the
+  first call for a given service and version goes to the network. Once a
+  document is older than DISCOVERY_CACHE_TTL it is revalidated with its ETag.
+  Documents found in a DiscoveryBundle are used before going to the network.
+
   Args:
     serviceName: string, name of the service.
     version: string, the version of the service.
@@ -166,6 +399,11 @@ def build(serviceName,
     model: apiclient.Model, converts to and from the wire format.
     requestBuilder: apiclient.http.HttpRequest, encapsulator for an HTTP
       request.
+    cache: object, an optional second tier cache for discovery documents
+      shared between processes. It must support get(), set() and delete(),
+      e.g. the App Engine memcache module or an httplib2.FileCache.
+    bundle: DiscoveryBundle, optional snapshot of discovery documents used
+      before the second tier cache and the network.
 
   Returns:
     A Resource object with methods for interacting with the service.
@@ -178,8 +416,40 @@ def build(serviceName,
   if http is None:
     http = httplib2.Http()
 
-  requested_url = uritemplate.expand(discoveryServiceUrl, params)
+  cache_key = uritemplate.expand(discoveryServiceUrl, params)
+  entry = _discovery_cache.get(cache_key)
+  if entry is None and bundle is not None:
+    entry = bundle.get(cache_key)
+    if entry is not None:
+      _discovery_cache.set(cache_key, entry)
+  if entry is None:
+    entry = _discovery_cache.get(cache_key, cache)
+
+  if entry is None or not entry.is_fresh(DISCOVERY_CACHE_TTL):
+    entry = _fetch_discovery_document(http, cache_key, serviceName, version,
+                                      entry)
+    _discovery_cache.set(cache_key, entry, cache)
+
+  return build_from_document(entry.service, base=discoveryServiceUrl,
+      http=http, developerKey=developerKey, model=model,
+      requestBuilder=requestBuilder)
+
 
+def _fetch_discovery_document(http, requested_url, serviceName, version,
+                              entry=None):
+  """Retrieve a discovery document over HTTP.
+
+  Args:
+    http: httplib2.Http, the http object to make the request with.
+    requested_url: string, the discovery URI.
+    serviceName: string, name of the service.
+    version: string, the version of the service.
+    entry: _DiscoveryCacheEntry, a stale cached copy of the document, or None.
+      If it has an ETag the request is made conditional on it.
+
+  Returns:
+    A _DiscoveryCacheEntry holding the current document.
+  """
   # REMOTE_ADDR is defined by the CGI spec [RFC3875] as the environment
   # variable that contains the network address of the client sending the
   # request. If it exists then add that to the request for the discovery
@@ -189,8 +459,15 @@ def build(serviceName,
                                          os.environ['REMOTE_ADDR'])
   logger.info('URL being requested: %s' % requested_url)
 
-  resp, content = http.request(requested_url)
+  headers = {}
+  if entry is not None and entry.etag:
+    headers['if-none-match'] = entry.etag
+
+  resp, content = http.request(requested_url, headers=headers)
 
+  if resp.status == 304 and entry is not None:
+    return _DiscoveryCacheEntry(entry.service, entry.content, entry.etag,
+                                time.time())
   if resp.status == 404:
     raise UnknownApiNameOrVersion("name: %s  version: %s" % (serviceName,
                                                             version))
@@ -203,8 +480,7 @@ def build(serviceName,
     logger.error('Failed to parse as JSON: ' + content)
     raise InvalidJsonError()
 
-  return build_from_document(content, base=discoveryServiceUrl, http=http,
-      developerKey=developerKey, model=model, requestBuilder=requestBuilder)
+  return _DiscoveryCacheEntry(service, content, resp.get('etag'), time.time())
 
 
 @positional(1)
@@ -247,14 +523,16 @@ def build_from_document(
   if isinstance(service, basestring):
     service = simplejson.loads(service)
   base = urlparse.urljoin(service['rootUrl'], service['servicePath'])
-  schema = Schemas(service)
+  template = _get_service_template(service)
 
   if model is None:
     features = service.get('features', [])
     model = JsonModel('dataWrapper' in features)
   return Resource(http=http, baseUrl=base, model=model,
                   developerKey=developerKey, requestBuilder=requestBuilder,
-                  resourceDesc=service, rootDesc=service, schema=schema)
+                  resourceDesc=template.resourceDesc,
+                  rootDesc=template.rootDesc, schema=template.schema,
+                  template=template)
 
 
 def _cast(value, schema_type):
@@ -270,22 +548,24 @@ def _cast(value, schema_type):
   Returns:
     A string representation of 'value' based on the schema_type.
   """
-  if schema_type == 'string':
-    if type(value) == type('') or type(value) == type(u''):
-      return value
-    else:
-      return str(value)
-  elif schema_type == 'integer':
-    return str(int(value))
-  elif schema_type == 'number':
-    return str(float(value))
-  elif schema_type == 'boolean':
-    return str(bool(value)).lower()
+  return _CASTS.get(schema_type, _cast_string)(value)
+
+
+def _cast_string(value):
+  """Convert value to a string, leaving strings untouched."""
+  if type(value) == type('') or type(value) == type(u''):
+    return value
   else:
-    if type(value) == type('') or type(value) == type(u''):
-      return value
-    else:
-      return str(value)
+    return str(value)
+
+
+# Map from JSON Schema type to the function converting values to a string.
+_CASTS = {
+    'string': _cast_string,
+    'integer': lambda value: str(int(value)),
+    'number': lambda value: str(float(value)),
+    'boolean': lambda value: str(bool(value)).lower(),
+    }
 
 
 def _media_size_to_long(maxSize):
@@ -549,80 +829,288 @@ class ResourceMethodParameters(object):
           self.query_params.remove(name)
 
 
-def createMethod(methodName, methodDesc, rootDesc, schema):
-  """Creates a method for attaching to a Resource.
+class _ArgumentPlan(object):
+  """Checks and converts the keyword arguments of a generated method.
 
-  Args:
-    methodName: string, name of the method to use.
-    methodDesc: object, fragment of deserialized discovery document that
-      describes the method.
-    rootDesc: object, the entire deserialized discovery document.
-    schema: object, mapping of schema names to schema descriptions.
+  Everything that only depends on the method description, the regular
+  expressions, allowed values, cast functions and where each parameter goes,
+  is worked out once when the method is created, so that a call only does a
+  single lookup per argument passed.
   """
-  methodName = fix_method_name(methodName)
-  (pathUrl, httpMethod, methodId, accept,
-   maxSize, mediaPathUrl) = _fix_up_method_description(methodDesc, rootDesc)
 
-  parameters = ResourceMethodParameters(methodDesc)
+  def __init__(self, parameters):
+    """Constructor for _ArgumentPlan.
 
-  def method(self, **kwargs):
-    # Don't bother with doc string, it will be over-written by createMethod.
+    Args:
+      parameters: ResourceMethodParameters, the parameters of the method.
+    """
+    self.known = frozenset(parameters.argmap)
+    self.required = tuple(parameters.required_params)
+
+    # Map from parameter name to a tuple (query name or None, path name or
+    # None, cast function, repeated, pattern or None, compiled pattern or
+    # None, allowed values or None).
+    self.specs = {}
+    repeated_params = frozenset(parameters.repeated_params)
+    query_params = frozenset(parameters.query_params)
+    for name, arg in parameters.argmap.iteritems():
+      pattern = parameters.pattern_params.get(name)
+      enums = parameters.enum_params.get(name)
+      self.specs[name] = (
+          arg if name in query_params else None,
+          arg if name in parameters.path_params else None,
+          _CASTS.get(parameters.param_types.get(name, 'string'), _cast_string),
+          name in repeated_params,
+          pattern,
+          re.compile(pattern) if pattern else None,
+          frozenset(enums) if enums else None)
+    # Allowed values in the order of the discovery document, for errors.
+    self.enum_params = parameters.enum_params
+
+  def clean(self, kwargs):
+    """Reject unknown arguments and drop the ones whose value is None.
 
-    for name in kwargs.iterkeys():
-      if name not in parameters.argmap:
-        raise TypeError('Got an unexpected keyword argument "%s"' % name)
+    Args:
+      kwargs: dict, the keyword arguments of the call, modified in place.
 
-    # Remove args that have a value of None.
-    keys = kwargs.keys()
-    for name in keys:
-      if kwargs[name] is None:
+    Raises:
+      TypeError if an argument is not a parameter of the method.
+    """
+    for name, value in kwargs.items():
+      if name not in self.known:
+        raise TypeError('Got an unexpected keyword argument "%s"' % name)
+      if value is None:
         del kwargs[name]
 
-    for name in parameters.required_params:
+  def convert(self, kwargs):
+    """Check the arguments and cast them into path and query parameters.
+
+    Args:
+      kwargs: dict, the keyword arguments of the call, already cleaned.
+
+    Returns:
+      A tuple (path parameters, query parameters) of dicts from the names of
+      the parameters in the discovery document to their values as strings.
+
+    Raises:
+      TypeError if a required argument is missing or an argument doesn't
+      match the pattern or allowed values of its parameter.
+    """
+    for name in self.required:
       if name not in kwargs:
         raise TypeError('Missing required parameter "%s"' % name)
 
-    for name, regex in parameters.pattern_params.iteritems():
-      if name in kwargs:
-        if isinstance(kwargs[name], basestring):
-          pvalues = [kwargs[name]]
+    path_params = {}
+    query_params = {}
+    for name, value in kwargs.iteritems():
+      (query_name, path_name, cast, repeated, pattern, regex,
+       enums) = self.specs[name]
+      if regex is not None:
+        if isinstance(value, basestring):
+          pvalues = [value]
         else:
-          pvalues = kwargs[name]
+          pvalues = value
         for pvalue in pvalues:
-          if re.match(regex, pvalue) is None:
+          if regex.match(pvalue) is None:
             raise TypeError(
                 'Parameter "%s" value "%s" does not match the pattern "%s"' %
-                (name, pvalue, regex))
-
-    for name, enums in parameters.enum_params.iteritems():
-      if name in kwargs:
+                (name, pvalue, pattern))
+      if enums is not None:
         # We need to handle the case of a repeated enum
         # name differently, since we want to handle both
         # arg='value' and arg=['value1', 'value2']
-        if (name in parameters.repeated_params and
-            not isinstance(kwargs[name], basestring)):
-          values = kwargs[name]
+        if repeated and not isinstance(value, basestring):
+          values = value
         else:
-          values = [kwargs[name]]
-        for value in values:
-          if value not in enums:
+          values = [value]
+        for v in values:
+          if v not in enums:
             raise TypeError(
                 'Parameter "%s" value "%s" is not an allowed value in "%s"' %
-                (name, value, str(enums)))
-
-    actual_query_params = {}
-    actual_path_params = {}
-    for key, value in kwargs.iteritems():
-      to_type = parameters.param_types.get(key, 'string')
+                (name, v, str(self.enum_params[name])))
+      if query_name is None and path_name is None:
+        continue
       # For repeated parameters we cast each member of the list.
-      if key in parameters.repeated_params and type(value) == type([]):
-        cast_value = [_cast(x, to_type) for x in value]
+      if repeated and type(value) == type([]):
+        cast_value = [cast(x) for x in value]
       else:
-        cast_value = _cast(value, to_type)
-      if key in parameters.query_params:
-        actual_query_params[parameters.argmap[key]] = cast_value
-      if key in parameters.path_params:
-        actual_path_params[parameters.argmap[key]] = cast_value
+        cast_value = cast(value)
+      if query_name is not None:
+        query_params[query_name] = cast_value
+      if path_name is not None:
+        path_params[path_name] = cast_value
+    return path_params, query_params
+
+
+def _validate_field_mask(fields, methodName, methodDesc, schema, validMasks):
+  """Validates the partial response field mask passed to a method.
+
+  Args:
+    fields: string or list of strings, the field mask, lists are joined with
+      commas (e.g. ['nextPageToken', 'items(id,title)']).
+    methodName: string, name of the method.
+    methodDesc: object, fragment of deserialized discovery document that
+      describes the method.
+    schema: object, mapping of schema names to schema descriptions.
+    validMasks: set, masks known to be valid for the method, updated with
+      fields once it is validated.
+
+  Returns:
+    The field mask as a string.
+
+  Raises:
+    TypeError if the mask selects fields the method doesn't return.
+  """
+  if isinstance(fields, (list, tuple)):
+    fields = ','.join(fields)
+  if fields in validMasks:
+    return fields
+  if 'response' in methodDesc and not methodName.endswith('_media'):
+    try:
+      schema.validate_fields(methodDesc['response'], fields)
+    except ValueError, e:
+      raise TypeError('Parameter "fields" is invalid: %s' % e)
+  validMasks.add(fields)
+  return fields
+
+
+class _LazyDocMethod(object):
+  """A method of a generated Resource, whose docstring is built when needed.
+
+  Rendering the docstrings means pretty printing the request and response
+  schemas of every method, which is most of the work of building a service,
+  so that is deferred until the docstring is first read, e.g. by help().
+  """
+
+  def __init__(self, func, makeDoc):
+    """Constructor for _LazyDocMethod.
+
+    Args:
+      func: function implementing the method.
+      makeDoc: callable taking no arguments and returning the docstring.
+    """
+    self._func = func
+    self._makeDoc = makeDoc
+    self._doc = None
+    self.__name__ = func.__name__
+
+  @property
+  def __doc__(self):
+    if self._doc is None:
+      self._doc = self._makeDoc()
+    return self._doc
+
+  def __call__(self, *args, **kwargs):
+    return self._func(*args, **kwargs)
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    return types.MethodType(self, instance, owner)
+
+
+def _method_doc(methodName, methodDesc, rootDesc, schema, parameters):
+  """Builds the docstring of a method created by createMethod.
+
+  Args:
+    methodName: string, name of the method.
+    methodDesc: object, fragment of deserialized discovery document that
+      describes the method.
+    rootDesc: object, the entire deserialized discovery document.
+    schema: object, mapping of schema names to schema descriptions.
+    parameters: ResourceMethodParameters, the parameters of the method.
+
+  Returns:
+    string, the docstring.
+  """
+  docs = [methodDesc.get('description', DEFAULT_METHOD_DOC), '\n\n']
+  if len(parameters.argmap) > 0:
+    docs.append('Args:\n')
+
+  # Skip undocumented params and params common to all methods.
+  skip_parameters = rootDesc.get('parameters', {}).keys()
+  skip_parameters.extend(STACK_QUERY_PARAMETERS)
+
+  all_args = parameters.argmap.keys()
+  args_ordered = [key2param(s) for s in methodDesc.get('parameterOrder', [])]
+
+  # Move body to the front of the line.
+  if 'body' in all_args:
+    args_ordered.append('body')
+
+  for name in all_args:
+    if name not in args_ordered:
+      args_ordered.append(name)
+
+  for arg in args_ordered:
+    if arg in skip_parameters:
+      continue
+
+    repeated = ''
+    if arg in parameters.repeated_params:
+      repeated = ' (repeated)'
+    required = ''
+    if arg in parameters.required_params:
+      required = ' (required)'
+    paramdesc = methodDesc['parameters'][parameters.argmap[arg]]
+    paramdoc = paramdesc.get('description', 'A parameter')
+    if '$ref' in paramdesc:
+      docs.append(
+          ('  %s: object, %s%s%s\n    The object takes the'
+          ' form of:\n\n%s\n\n') % (arg, paramdoc, required, repeated,
+            schema.prettyPrintByName(paramdesc['$ref'])))
+    else:
+      paramtype = paramdesc.get('type', 'string')
+      docs.append('  %s: %s, %s%s%s\n' % (arg, paramtype, paramdoc, required,
+                                          repeated))
+    enum = paramdesc.get('enum', [])
+    enumDesc = paramdesc.get('enumDescriptions', [])
+    if enum and enumDesc:
+      docs.append('    Allowed values\n')
+      for (name, desc) in zip(enum, enumDesc):
+        docs.append('      %s - %s\n' % (name, desc))
+  if 'response' in methodDesc:
+    if methodName.endswith('_media'):
+      docs.append('\nReturns:\n  The media object as a string.\n\n    ')
+    else:
+      docs.append('\nReturns:\n  An object of the form:\n\n    ')
+      docs.append(schema.prettyPrintSchema(methodDesc['response']))
+
+  return ''.join(docs)
+
+
+def createMethod(methodName, methodDesc, rootDesc, schema):
+  """Creates a method for attaching to a Resource.
+
+  Args:
+    methodName: string, name of the method to use.
+    methodDesc: object, fragment of deserialized discovery document that
+      describes the method.
+    rootDesc: object, the entire deserialized discovery document.
+    schema: object, mapping of schema names to schema descriptions.
+  """
+  methodName = fix_method_name(methodName)
+  (pathUrl, httpMethod, methodId, accept,
+   maxSize, mediaPathUrl) = _fix_up_method_description(methodDesc, rootDesc)
+
+  parameters = ResourceMethodParameters(methodDesc)
+  plan = _ArgumentPlan(parameters)
+
+  # Field masks already checked against the response schema.
+  validFieldMasks = set()
+
+  def method(self, **kwargs):
+    # Don't bother with doc string, _LazyDocMethod builds it when asked for.
+
+    # Reject unknown args and remove args that have a value of None.
+    plan.clean(kwargs)
+
+    if 'fields' in kwargs:
+      kwargs['fields'] = _validate_field_mask(
+          kwargs['fields'], methodName, methodDesc, schema, validFieldMasks)
+
+    actual_path_params, actual_query_params = plan.convert(kwargs)
+
     body_value = kwargs.get('body', None)
     media_filename = kwargs.get('media_body', None)
 
@@ -716,61 +1204,10 @@ def createMethod(methodName, methodDesc, rootDesc, schema):
                                 methodId=methodId,
                                 resumable=resumable)
 
-  docs = [methodDesc.get('description', DEFAULT_METHOD_DOC), '\n\n']
-  if len(parameters.argmap) > 0:
-    docs.append('Args:\n')
-
-  # Skip undocumented params and params common to all methods.
-  skip_parameters = rootDesc.get('parameters', {}).keys()
-  skip_parameters.extend(STACK_QUERY_PARAMETERS)
-
-  all_args = parameters.argmap.keys()
-  args_ordered = [key2param(s) for s in methodDesc.get('parameterOrder', [])]
+  def makeDoc():
+    return _method_doc(methodName, methodDesc, rootDesc, schema, parameters)
 
-  # Move body to the front of the line.
-  if 'body' in all_args:
-    args_ordered.append('body')
-
-  for name in all_args:
-    if name not in args_ordered:
-      args_ordered.append(name)
-
-  for arg in args_ordered:
-    if arg in skip_parameters:
-      continue
-
-    repeated = ''
-    if arg in parameters.repeated_params:
-      repeated = ' (repeated)'
-    required = ''
-    if arg in parameters.required_params:
-      required = ' (required)'
-    paramdesc = methodDesc['parameters'][parameters.argmap[arg]]
-    paramdoc = paramdesc.get('description', 'A parameter')
-    if '$ref' in paramdesc:
-      docs.append(
-          ('  %s: object, %s%s%s\n    The object takes the'
-          ' form of:\n\n%s\n\n') % (arg, paramdoc, required, repeated,
-            schema.prettyPrintByName(paramdesc['$ref'])))
-    else:
-      paramtype = paramdesc.get('type', 'string')
-      docs.append('  %s: %s, %s%s%s\n' % (arg, paramtype, paramdoc, required,
-                                          repeated))
-    enum = paramdesc.get('enum', [])
-    enumDesc = paramdesc.get('enumDescriptions', [])
-    if enum and enumDesc:
-      docs.append('    Allowed values\n')
-      for (name, desc) in zip(enum, enumDesc):
-        docs.append('      %s - %s\n' % (name, desc))
-  if 'response' in methodDesc:
-    if methodName.endswith('_media'):
-      docs.append('\nReturns:\n  The media object as a string.\n\n    ')
-    else:
-      docs.append('\nReturns:\n  An object of the form:\n\n    ')
-      docs.append(schema.prettyPrintSchema(methodDesc['response']))
-
-  setattr(method, '__doc__', ''.join(docs))
-  return (methodName, method)
+  return (methodName, _LazyDocMethod(method, makeDoc))
 
 
 def createNextMethod(methodName):
@@ -821,124 +1258,102 @@ Returns:
   return (methodName, methodNext)
 
 
-class Resource(object):
-  """A class for interacting with a resource."""
+def createResourceMethod(methodName, template):
+  """Creates a method on a Resource to access a nested Resource.
 
-  def __init__(self, http, baseUrl, model, requestBuilder, developerKey,
-               resourceDesc, rootDesc, schema):
-    """Build a Resource from the API description.
+  Args:
+    methodName: string, name of the method to use.
+    template: _ResourceTemplate, the template of the nested resource.
+  """
+  methodName = fix_method_name(methodName)
 
-    Args:
-      http: httplib2.Http, Object to make http requests with.
-      baseUrl: string, base URL for the API. All requests are relative to this
-          URI.
-      model: apiclient.Model, converts to and from the wire format.
-      requestBuilder: class or callable that instantiates an
-          apiclient.HttpRequest object.
-      developerKey: string, key obtained from
-          https://code.google.com/apis/console
-      resourceDesc: object, section of deserialized discovery document that
-          describes a resource. Note that the top level discovery document
-          is considered a resource.
-      rootDesc: object, the entire deserialized discovery document.
-      schema: object, mapping of schema names to schema descriptions.
-    """
-    self._dynamic_attrs = []
+  def methodResource(self):
+    return template.resource_class(
+        http=self._http, baseUrl=self._baseUrl, model=self._model,
+        developerKey=self._developerKey, requestBuilder=self._requestBuilder,
+        resourceDesc=template.resourceDesc, rootDesc=template.rootDesc,
+        schema=template.schema)
 
-    self._http = http
-    self._baseUrl = baseUrl
-    self._model = model
-    self._developerKey = developerKey
-    self._requestBuilder = requestBuilder
-    self._resourceDesc = resourceDesc
-    self._rootDesc = rootDesc
-    self._schema = schema
+  setattr(methodResource, '__doc__', 'A collection resource.')
+  setattr(methodResource, '__is_resource__', True)
 
-    self._set_service_methods()
+  return (methodName, methodResource)
 
-  def _set_dynamic_attr(self, attr_name, value):
-    """Sets an instance attribute and tracks it in a list of dynamic attributes.
 
-    Args:
-      attr_name: string; The name of the attribute to be set
-      value: The value being set on the object and tracked in the dynamic cache.
-    """
-    self._dynamic_attrs.append(attr_name)
-    self.__dict__[attr_name] = value
+class _ResourceTemplate(object):
+  """The credential-independent parts of a Resource.
 
-  def __getstate__(self):
-    """Trim the state down to something that can be pickled.
+  Generating the methods of a Resource from its description is by far the
+  most expensive part of building a service, and none of that work depends on
+  the http object, credentials or model the Resource is bound to. A template
+  does it once, for the resource and all of its nested resources, and defines
+  the methods on a Resource subclass generated for the resource, so binding a
+  Resource is nothing more than instantiating that class.
 
-    Uses the fact that the instance variable _dynamic_attrs holds attrs that
-    will be wiped and restored on pickle serialization.
-    """
-    state_dict = copy.copy(self.__dict__)
-    for dynamic_attr in self._dynamic_attrs:
-      del state_dict[dynamic_attr]
-    del state_dict['_dynamic_attrs']
-    return state_dict
+  Attributes:
+    resourceDesc: object, section of deserialized discovery document that
+        describes the resource.
+    rootDesc: object, the entire deserialized discovery document.
+    schema: object, mapping of schema names to schema descriptions.
+    methods: list of (name, function) pairs, the methods of the Resource
+        including accessors for nested resources and _next methods.
+    resources: dict, map from nested resource name to its _ResourceTemplate.
+    path: tuple of nested resource names leading from the top level resource
+        to this one, or None if the template was built outside of a service
+        template.
+    resource_class: the Resource subclass with the methods defined on it.
+  """
 
-  def __setstate__(self, state):
-    """Reconstitute the state of the object from being pickled.
+  def __init__(self, resourceDesc, rootDesc, schema, path=None):
+    """Constructor for _ResourceTemplate.
 
-    Uses the fact that the instance variable _dynamic_attrs holds attrs that
-    will be wiped and restored on pickle serialization.
+    Args:
+      resourceDesc: object, section of deserialized discovery document that
+          describes a resource. Note that the top level discovery document
+          is considered a resource.
+      rootDesc: object, the entire deserialized discovery document.
+      schema: object, mapping of schema names to schema descriptions.
+      path: tuple, names of the nested resources leading from the top level
+          resource to this one, or None if unknown.
     """
-    self.__dict__.update(state)
-    self._dynamic_attrs = []
-    self._set_service_methods()
-
-  def _set_service_methods(self):
-    self._add_basic_methods(self._resourceDesc, self._rootDesc, self._schema)
-    self._add_nested_resources(self._resourceDesc, self._rootDesc, self._schema)
-    self._add_next_methods(self._resourceDesc, self._schema)
+    self.resourceDesc = resourceDesc
+    self.rootDesc = rootDesc
+    self.schema = schema
+    self.path = path
+    self.methods = []
+    self.resources = {}
+
+    self._add_basic_methods(resourceDesc, rootDesc, schema)
+    self._add_nested_resources(resourceDesc, rootDesc, schema)
+    self._add_next_methods(resourceDesc, schema)
+
+    attrs = dict(self.methods)
+    attrs['__slots__'] = ()
+    attrs['_template'] = self
+    self.resource_class = type('Resource', (Resource,), attrs)
 
   def _add_basic_methods(self, resourceDesc, rootDesc, schema):
     # Add basic methods to Resource
     if 'methods' in resourceDesc:
       for methodName, methodDesc in resourceDesc['methods'].iteritems():
-        fixedMethodName, method = createMethod(
-            methodName, methodDesc, rootDesc, schema)
-        self._set_dynamic_attr(fixedMethodName,
-                               method.__get__(self, self.__class__))
+        self.methods.append(
+            createMethod(methodName, methodDesc, rootDesc, schema))
         # Add in _media methods. The functionality of the attached method will
         # change when it sees that the method name ends in _media.
         if methodDesc.get('supportsMediaDownload', False):
-          fixedMethodName, method = createMethod(
-              methodName + '_media', methodDesc, rootDesc, schema)
-          self._set_dynamic_attr(fixedMethodName,
-                                 method.__get__(self, self.__class__))
+          self.methods.append(createMethod(
+              methodName + '_media', methodDesc, rootDesc, schema))
 
   def _add_nested_resources(self, resourceDesc, rootDesc, schema):
     # Add in nested resources
     if 'resources' in resourceDesc:
-
-      def createResourceMethod(methodName, methodDesc):
-        """Create a method on the Resource to access a nested Resource.
-
-        Args:
-          methodName: string, name of the method to use.
-          methodDesc: object, fragment of deserialized discovery document that
-            describes the method.
-        """
-        methodName = fix_method_name(methodName)
-
-        def methodResource(self):
-          return Resource(http=self._http, baseUrl=self._baseUrl,
-                          model=self._model, developerKey=self._developerKey,
-                          requestBuilder=self._requestBuilder,
-                          resourceDesc=methodDesc, rootDesc=rootDesc,
-                          schema=schema)
-
-        setattr(methodResource, '__doc__', 'A collection resource.')
-        setattr(methodResource, '__is_resource__', True)
-
-        return (methodName, methodResource)
-
       for methodName, methodDesc in resourceDesc['resources'].iteritems():
-        fixedMethodName, method = createResourceMethod(methodName, methodDesc)
-        self._set_dynamic_attr(fixedMethodName,
-                               method.__get__(self, self.__class__))
+        path = None
+        if self.path is not None:
+          path = self.path + (methodName,)
+        template = _ResourceTemplate(methodDesc, rootDesc, schema, path=path)
+        self.resources[methodName] = template
+        self.methods.append(createResourceMethod(methodName, template))
 
   def _add_next_methods(self, resourceDesc, schema):
     # Add _next() methods
@@ -954,6 +1369,129 @@ class Resource(object):
                                                                    {})
           hasPageToken = 'pageToken' in methodDesc.get('parameters', {})
           if hasNextPageToken and hasPageToken:
-            fixedMethodName, method = createNextMethod(methodName + '_next')
-            self._set_dynamic_attr(fixedMethodName,
-                                   method.__get__(self, self.__class__))
+            self.methods.append(createNextMethod(methodName + '_next'))
+
+
+# Map from (id, version, revision, etag) of a discovery document to the
+# _ResourceTemplate of its top level resource.
+_service_templates = {}
+_service_templates_lock = threading.Lock()
+
+
+def _get_service_template(service):
+  """Returns the _ResourceTemplate for a discovery document.
+
+  Templates are built once per discovery document and version and then shared
+  by every Resource built from it, so that binding a new http object costs no
+  more than an object instantiation.
+
+  Args:
+    service: object, the deserialized discovery document.
+
+  Returns:
+    The _ResourceTemplate of the top level resource of the service.
+  """
+  if 'id' not in service:
+    # Without an id there is no safe way to tell documents apart.
+    return _ResourceTemplate(service, service, Schemas(service), path=())
+
+  key = (service['id'], service.get('version'), service.get('revision'),
+         service.get('etag'))
+  template = _service_templates.get(key)
+  if template is None:
+    with _service_templates_lock:
+      template = _service_templates.get(key)
+      if template is None:
+        template = _ResourceTemplate(service, service, Schemas(service),
+                                     path=())
+        _service_templates[key] = template
+  return template
+
+
+def _unpickle_resource(path, state):
+  """Rebuild a pickled Resource.
+
+  Args:
+    path: tuple, names of the nested resources leading from the top level
+        resource to the pickled one, or None if unknown.
+    state: dict, the state returned by Resource.__getstate__().
+
+  Returns:
+    A Resource equivalent to the pickled one.
+  """
+  if path is None:
+    template = _ResourceTemplate(state['_resourceDesc'], state['_rootDesc'],
+                                 state['_schema'])
+  else:
+    template = _get_service_template(state['_rootDesc'])
+    for name in path:
+      template = template.resources[name]
+  resource = object.__new__(template.resource_class)
+  resource.__setstate__(state)
+  return resource
+
+
+class Resource(object):
+  """A class for interacting with a resource.
+
+  Resource itself is never instantiated. Constructing one returns an instance
+  of the subclass generated for the resource description by its
+  _ResourceTemplate, which has the API methods defined on the class.
+  """
+
+  __slots__ = ('_http', '_baseUrl', '_model', '_developerKey',
+               '_requestBuilder', '_resourceDesc', '_rootDesc', '_schema')
+
+  def __new__(cls, http, baseUrl, model, requestBuilder, developerKey,
+              resourceDesc, rootDesc, schema, template=None):
+    if cls is Resource:
+      if template is None:
+        template = _ResourceTemplate(resourceDesc, rootDesc, schema)
+      cls = template.resource_class
+    return object.__new__(cls)
+
+  def __init__(self, http, baseUrl, model, requestBuilder, developerKey,
+               resourceDesc, rootDesc, schema, template=None):
+    """Build a Resource from the API description.
+
+    Args:
+      http: httplib2.Http, Object to make http requests with.
+      baseUrl: string, base URL for the API. All requests are relative to this
+          URI.
+      model: apiclient.Model, converts to and from the wire format.
+      requestBuilder: class or callable that instantiates an
+          apiclient.HttpRequest object.
+      developerKey: string, key obtained from
+          https://code.google.com/apis/console
+      resourceDesc: object, section of deserialized discovery document that
+          describes a resource. Note that the top level discovery document
+          is considered a resource.
+      rootDesc: object, the entire deserialized discovery document.
+      schema: object, mapping of schema names to schema descriptions.
+      template: _ResourceTemplate, prebuilt methods for resourceDesc. If None
+          the methods are generated from resourceDesc.
+    """
+    self._http = http
+    self._baseUrl = baseUrl
+    self._model = model
+    self._developerKey = developerKey
+    self._requestBuilder = requestBuilder
+    self._resourceDesc = resourceDesc
+    self._rootDesc = rootDesc
+    self._schema = schema
+
+  def __getstate__(self):
+    """Trim the state down to something that can be pickled.
+
+    The methods live on the generated class, so only the slots are saved.
+    """
+    return dict((name, getattr(self, name)) for name in Resource.__slots__)
+
+  def __setstate__(self, state):
+    """Reconstitute the state of the object from being pickled."""
+    for name, value in state.iteritems():
+      setattr(self, name, value)
+
+  def __reduce__(self):
+    """Pickle by reference to the template rather than the generated class."""
+    return (_unpickle_resource, (self._template.path, self.__getstate__()))
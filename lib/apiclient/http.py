@@ -29,15 +29,15 @@ import httplib2
 import mimeparse
 import mimetypes
 import os
+import random
+import re
 import sys
+import threading
 import urllib
 import urlparse
 import uuid
 
-from email.generator import Generator
-from email.mime.multipart import MIMEMultipart
-from email.mime.nonmultipart import MIMENonMultipart
-from email.parser import FeedParser
+from email.message import Message
 from errors import BatchError
 from errors import HttpError
 from errors import InvalidChunkSizeError
@@ -53,6 +53,125 @@ DEFAULT_CHUNK_SIZE = 512*1024
 
 MAX_URI_LENGTH = 2048
 
+# Maximum number of requests sent in a single batch request, the server rejects
+# batches with more of them.
+MAX_BATCH_REQUESTS = 1000
+
+# Maximum size in bytes of the body of a single batch request.
+MAX_BATCH_BYTES = 8*1024*1024
+
+# Size of the MIME headers wrapping each request in a batch, not counting its
+# Content-ID.
+_BATCH_PART_OVERHEAD = 200
+
+# MIME headers of each request in a batch, up to the value of its Content-ID.
+_BATCH_PART_HEADERS = ('Content-Type: application/http\n'
+                       'MIME-Version: 1.0\n'
+                       'Content-Transfer-Encoding: binary\n'
+                       'Content-ID: ')
+
+# Lines starting with 'From ' are escaped by the email package when it writes
+# a message, batch bodies keep doing the same.
+_FROM_LINE = re.compile(r'^From ', re.MULTILINE)
+
+
+def _mangle_from(text):
+  """Escape the lines of text starting with 'From ' as '>From '."""
+  if 'From ' in text:
+    return _FROM_LINE.sub('>From ', text)
+  return text
+
+
+def _parse_headers(content, start, end):
+  """Parse the header lines of a MIME entity or HTTP message.
+
+  Args:
+    content: string, the text containing the headers.
+    start: int, index in content where the headers start.
+    end: int, index in content where the entity ends.
+
+  Returns:
+    A pair (headers, body_start): dict from lower-cased header names to their
+    values, and index in content of the first byte after the blank line ending
+    the headers, or end if there is none.
+  """
+  headers = {}
+  name = None
+  pos = start
+  while pos < end:
+    eol = content.find('\n', pos, end)
+    if eol == -1:
+      next_pos = eol = end
+    else:
+      next_pos = eol + 1
+    if eol > pos and content[eol - 1] == '\r':
+      line = content[pos:eol - 1]
+    else:
+      line = content[pos:eol]
+    pos = next_pos
+    if not line:
+      return headers, pos
+    if line[0] in ' \t' and name is not None:
+      # Continuation of a folded header.
+      headers[name] += '\r\n' + line
+      continue
+    i = line.find(':')
+    if i > 0:
+      name = line[:i].lower()
+      headers[name] = line[i + 1:].lstrip()
+  return headers, end
+
+
+def _find_delimiter(content, delimiter, pos):
+  """Find the next multipart delimiter line in content.
+
+  Args:
+    content: string, the body of a multipart message.
+    delimiter: string, the boundary of the message prefixed with '--'.
+    pos: int, index in content to search from.
+
+  Returns:
+    A tuple (start, close, next_line): index in content where the delimiter
+    starts, whether it is the close delimiter and index of the line after it.
+    start is -1 if there are no more delimiters.
+  """
+  while True:
+    start = content.find(delimiter, pos)
+    if start == -1:
+      return -1, False, len(content)
+    pos = start + len(delimiter)
+    if start > 0 and content[start - 1] != '\n':
+      continue
+    eol = content.find('\n', pos)
+    if eol == -1:
+      eol = len(content)
+    rest = content[pos:eol].rstrip('\r')
+    close = rest.startswith('--')
+    if close:
+      rest = rest[2:]
+    # Anything else than transport padding means it isn't a delimiter.
+    if not rest.strip(' \t'):
+      return start, close, eol + 1
+
+
+def _new_boundary(texts):
+  """Create a multipart boundary that doesn't appear in any of texts.
+
+  Args:
+    texts: list of strings, the parts the boundary separates.
+
+  Returns:
+    The boundary, in the format used by the email package.
+  """
+  boundary = '%s%0*d==' % ('=' * 15, len(repr(sys.maxint - 1)),
+                            random.randrange(sys.maxint))
+  candidate = boundary
+  counter = 0
+  while any(('--' + candidate) in text for text in texts):
+    candidate = '%s.%d' % (boundary, counter)
+    counter += 1
+  return candidate
+
 
 class MediaUploadProgress(object):
   """Status of a resumable upload."""
@@ -890,10 +1009,17 @@ class BatchHttpRequest(object):
     batch.add(service.animals().list(), list_animals)
     batch.add(service.farmers().list(), list_farmers)
     batch.execute(http=http)
+
+  Batches with more requests than the server accepts at once are sent as
+  several HTTP requests, each holding at most max_batch_requests requests and
+  max_batch_bytes bytes. Those can be sent at the same time, but the callbacks
+  are still called in the order the requests were added.
   """
 
   @util.positional(1)
-  def __init__(self, callback=None, batch_uri=None):
+  def __init__(self, callback=None, batch_uri=None,
+               max_batch_requests=MAX_BATCH_REQUESTS,
+               max_batch_bytes=MAX_BATCH_BYTES, max_concurrency=1):
     """Constructor for a BatchHttpRequest.
 
     Args:
@@ -903,11 +1029,24 @@ class BatchHttpRequest(object):
         third is an apiclient.errors.HttpError exception object if an HTTP error
         occurred while processing the request, or None if no error occurred.
       batch_uri: string, URI to send batch requests to.
+      max_batch_requests: int, Maximum number of requests sent in a single HTTP
+        request.
+      max_batch_bytes: int, Maximum size of the body of a single HTTP request.
+        A request larger than that on its own is still sent, alone.
+      max_concurrency: int, Maximum number of HTTP requests sent at the same
+        time when the batch has to be split. Values above 1 require an http
+        object that can be used from several threads at once, such as a
+        httplib2.Http taking its connections from a httplib2.ConnectionPool.
     """
     if batch_uri is None:
       batch_uri = 'https://www.googleapis.com/batch'
     self._batch_uri = batch_uri
 
+    # Bounds on each HTTP request the batch is split into.
+    self._max_batch_requests = max_batch_requests
+    self._max_batch_bytes = max_batch_bytes
+    self._max_concurrency = max_concurrency
+
     # Global callback to be called for each individual response in the batch.
     self._callback = callback
 
@@ -929,6 +1068,12 @@ class BatchHttpRequest(object):
     # A map from request id to (httplib2.Response, content) response pairs
     self._responses = {}
 
+    # Index in _order of the next request whose callbacks are to be called.
+    self._next_callback = 0
+
+    # Whether the requests that failed with a 401 have been sent again.
+    self._retried = False
+
     # A map of id(Credentials) that have been refreshed.
     self._refreshed_credentials = {}
 
@@ -1014,38 +1159,28 @@ class BatchHttpRequest(object):
         )
     status_line = request.method + ' ' + request_line + ' HTTP/1.1\n'
     major, minor = request.headers.get('content-type', 'application/json').split('/')
-    msg = MIMENonMultipart(major, minor)
     headers = request.headers.copy()
 
     if request.http is not None and hasattr(request.http.request,
         'credentials'):
       request.http.request.credentials.apply(headers)
 
-    # MIMENonMultipart adds its own Content-Type header.
+    # The Content-Type header is written first, followed by MIME-Version.
     if 'content-type' in headers:
       del headers['content-type']
 
+    lines = [status_line.encode('utf-8'),
+             'Content-Type: %s/%s\n' % (major, minor),
+             'MIME-Version: 1.0\n']
     for key, value in headers.iteritems():
-      msg[key] = value
-    msg['Host'] = parsed.netloc
-    msg.set_unixfrom(None)
+      lines.append('%s: %s\n' % (key, value))
+    lines.append('Host: %s' % parsed.netloc)
 
     if request.body is not None:
-      msg.set_payload(request.body)
-      msg['content-length'] = str(len(request.body))
+      lines.append('\ncontent-length: %d\n\n' % len(request.body))
+      lines.append(_mangle_from(request.body))
 
-    # Serialize the mime message.
-    fp = StringIO.StringIO()
-    # maxheaderlen=0 means don't line wrap headers.
-    g = Generator(fp, maxheaderlen=0)
-    g.flatten(msg, unixfrom=False)
-    body = fp.getvalue()
-
-    # Strip off the \n\n that the MIME lib tacks onto the end of the payload.
-    if request.body is None:
-      body = body[:-2]
-
-    return status_line.encode('utf-8') + body
+    return ''.join(lines)
 
   def _deserialize_response(self, payload):
     """Convert string into httplib2 response and content.
@@ -1056,24 +1191,96 @@ class BatchHttpRequest(object):
     Returns:
       A pair (resp, content), such as would be returned from httplib2.request.
     """
-    # Strip off the status line
-    status_line, payload = payload.split('\n', 1)
-    protocol, status, reason = status_line.split(' ', 2)
-
-    # Parse the rest of the response
-    parser = FeedParser()
-    parser.feed(payload)
-    msg = parser.close()
-    msg['status'] = status
-
-    # Create httplib2.Response from the parsed headers.
-    resp = httplib2.Response(msg)
+    return self._parse_response(payload, 0, len(payload))
+
+  def _parse_response(self, content, start, end):
+    """Parse the HTTP response held in content[start:end].
+
+    Args:
+      content: string, the text containing the response.
+      start: int, index in content of the status line of the response.
+      end: int, index in content where the response ends.
+
+    Returns:
+      A pair (resp, content), such as would be returned from httplib2.request.
+
+    Raises:
+      BatchError if there is no status line.
+    """
+    eol = content.find('\n', start, end)
+    if eol == -1:
+      raise BatchError('Invalid response in batch: %r' % content[start:end])
+    status_line = content[start:eol].rstrip('\r')
+    protocol, status, reason = (status_line.split(' ', 2) + [''])[:3]
+
+    headers, body_start = _parse_headers(content, eol + 1, end)
+    headers['status'] = status
+
+    resp = httplib2.Response(headers)
     resp.reason = reason
     resp.version = int(protocol.split('/', 1)[1].replace('.', ''))
 
-    content = payload.split('\r\n\r\n', 1)[1]
+    return resp, content[body_start:end]
 
-    return resp, content
+  def _iter_responses(self, resp, content):
+    """Parse the body of a batch response one part at a time.
+
+    The body is scanned once for the boundaries between its parts, and the
+    response of each part is only sliced out of it when it is reached, so the
+    caller can handle a response before the following ones are parsed.
+
+    Args:
+      resp: httplib2.Response, the response to the batch request.
+      content: string, the body of the response to the batch request.
+
+    Yields:
+      Tuples (request_id, resp, content), one per request of the batch, in
+      the order they appear in the response.
+
+    Raises:
+      BatchError if the response is not in multipart/mixed format.
+    """
+    # Let the email package pull the boundary out of the Content-Type.
+    content_type = Message()
+    content_type['content-type'] = resp.get('content-type', '')
+    boundary = content_type.get_boundary()
+    if content_type.get_content_maintype() != 'multipart' or not boundary:
+      raise BatchError("Response not in multipart/mixed format.", resp=resp,
+                       content=content)
+    delimiter = '--' + boundary
+
+    part_start = None
+    pos = 0
+    while True:
+      pos, close, next_line = _find_delimiter(content, delimiter, pos)
+      if pos == -1:
+        if part_start is None:
+          raise BatchError("Response not in multipart/mixed format.",
+                           resp=resp, content=content)
+        # Missing close delimiter, the last part runs to the end.
+        part_end = len(content)
+      else:
+        # The line break before a delimiter belongs to the delimiter.
+        part_end = pos
+        if part_end > 0 and content[part_end - 1] == '\n':
+          part_end -= 1
+          if part_end > 0 and content[part_end - 1] == '\r':
+            part_end -= 1
+
+      if part_start is not None:
+        part_headers, payload_start = _parse_headers(
+            content, part_start, part_end)
+        if 'content-id' not in part_headers:
+          raise BatchError("Missing Content-ID in batch response part.",
+                           resp=resp, content=content)
+        request_id = self._header_to_id(part_headers['content-id'])
+        response, response_content = self._parse_response(
+            content, payload_start, part_end)
+        yield request_id, response, response_content
+
+      if pos == -1 or close:
+        return
+      part_start = pos = next_line
 
   def _new_id(self):
     """Create a new id.
@@ -1127,9 +1334,44 @@ class BatchHttpRequest(object):
     self._callbacks[request_id] = callback
     self._order.append(request_id)
 
+  def is_empty(self):
+    """Return whether no request has been added to the batch."""
+    return not self._order
+
+  def _split(self, order, serialized):
+    """Split requests into groups that can each be sent as one HTTP request.
+
+    Args:
+      order: list, list of request ids in the order they were added to the
+        batch.
+      serialized: dict, map from request id to the serialized request.
+
+    Returns:
+      A list of lists of request ids, in order.
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for request_id in order:
+      part_size = (len(serialized[request_id]) + len(request_id) +
+                   _BATCH_PART_OVERHEAD)
+      if chunk and (len(chunk) >= self._max_batch_requests or
+                    size + part_size > self._max_batch_bytes):
+        chunks.append(chunk)
+        chunk = []
+        size = 0
+      chunk.append(request_id)
+      size += part_size
+    if chunk:
+      chunks.append(chunk)
+    return chunks
+
   def _execute(self, http, order, requests):
     """Serialize batch request, send to server, process response.
 
+    The requests are sent in as many HTTP requests as the bounds given to the
+    constructor require.
+
     Args:
       http: httplib2.Http, an http object to be used to make the request with.
       order: list, list of request ids in the order they were added to the
@@ -1140,27 +1382,97 @@ class BatchHttpRequest(object):
       httplib2.HttpLib2Error if a transport error has occured.
       apiclient.errors.BatchError if the response is the wrong format.
     """
-    message = MIMEMultipart('mixed')
-    # Message should not write out it's own headers.
-    setattr(message, '_write_headers', lambda self: None)
-
-    # Add all the individual requests.
+    serialized = {}
     for request_id in order:
-      request = requests[request_id]
+      serialized[request_id] = self._serialize_request(requests[request_id])
+    chunks = self._split(order, serialized)
+    if self._base_id is None:
+      self._base_id = uuid.uuid4()
 
-      msg = MIMENonMultipart('application', 'http')
-      msg['Content-Transfer-Encoding'] = 'binary'
-      msg['Content-ID'] = self._id_to_header(request_id)
+    if self._max_concurrency <= 1 or len(chunks) <= 1:
+      # Callbacks run as the last response is parsed, once every request has
+      # been sent.
+      for chunk in chunks:
+        self._execute_chunk(http, chunk, serialized,
+                            deliver=chunk is chunks[-1])
+      return
+
+    # Each thread sends chunks until there are none left.
+    remaining = list(reversed(chunks))
+    lock = threading.Lock()
+    failures = []
+
+    def send():
+      while True:
+        with lock:
+          if not remaining or failures:
+            return
+          chunk = remaining.pop()
+        try:
+          self._execute_chunk(http, chunk, serialized)
+        except:
+          with lock:
+            failures.append(sys.exc_info())
+
+    threads = [threading.Thread(target=send)
+               for _ in xrange(min(self._max_concurrency, len(chunks)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if failures:
+      raise failures[0][0], failures[0][1], failures[0][2]
+
+  def _multipart_body(self, order, serialized, boundary):
+    """Write serialized requests as the body of a multipart/mixed message.
+
+    The body is assembled from a list of segments joined once, rather than
+    built as email.mime messages and flattened by email.generator, which
+    copies every part several times. The output is the same.
 
-      body = self._serialize_request(request)
-      msg.set_payload(body)
-      message.attach(msg)
+    Args:
+      order: list, list of the ids of the requests to send, in order.
+      serialized: dict, map from request id to the serialized request, as
+        returned by _serialize_request.
+      boundary: string, the boundary between the parts.
+
+    Returns:
+      The body of the batch request as a string.
+    """
+    delimiter = '\n--%s\n' % boundary
+    segments = [None] * (4 * len(order) + 1)
+    i = 0
+    for request_id in order:
+      segments[i] = delimiter
+      segments[i + 1] = _BATCH_PART_HEADERS
+      segments[i + 2] = self._id_to_header(request_id) + '\n\n'
+      segments[i + 3] = _mangle_from(serialized[request_id])
+      i += 4
+    # The first boundary isn't preceded by a line break.
+    segments[0] = delimiter[1:]
+    segments[i] = '\n--%s--\n' % boundary
+    return ''.join(segments)
+
+  def _execute_chunk(self, http, order, serialized, deliver=False):
+    """Send serialized requests as a single HTTP request, process response.
+
+    Args:
+      http: httplib2.Http, an http object to be used to make the request with.
+      order: list, list of the ids of the requests to send, in order.
+      serialized: dict, map from request id to the serialized request.
+      deliver: bool, whether to call the callbacks of responses as soon as
+        they are parsed rather than once the whole response has been.
 
-    body = message.as_string()
+    Raises:
+      httplib2.HttpLib2Error if a transport error has occured.
+      apiclient.errors.BatchError if the response is the wrong format.
+    """
+    boundary = _new_boundary([serialized[request_id] for request_id in order])
+    body = self._multipart_body(order, serialized, boundary)
 
     headers = {}
     headers['content-type'] = ('multipart/mixed; '
-                               'boundary="%s"') % message.get_boundary()
+                               'boundary="%s"') % boundary
 
     resp, content = http.request(self._batch_uri, 'POST', body=body,
                                  headers=headers)
@@ -1169,24 +1481,44 @@ class BatchHttpRequest(object):
       raise HttpError(resp, content, uri=self._batch_uri)
 
     # Now break out the individual responses and store each one.
-    boundary, _ = content.split(None, 1)
-
-    # Prepend with a content-type header so FeedParser can handle it.
-    header = 'content-type: %s\r\n\r\n' % resp['content-type']
-    for_parser = header + content
+    for request_id, response, response_content in self._iter_responses(
+        resp, content):
+      self._responses[request_id] = (response, response_content)
+      if deliver:
+        self._deliver_ready()
+
+  def _deliver_ready(self):
+    """Call the callbacks of the requests whose response is final, in order.
+
+    Until the requests that failed with a 401 have been sent again, their
+    responses aren't final. Callbacks are called in the order the requests were
+    added, so they stop at the first request without a final response.
+    """
+    while self._next_callback < len(self._order):
+      request_id = self._order[self._next_callback]
+      if request_id not in self._responses:
+        return
+      resp, content = self._responses[request_id]
+      if resp['status'] == '401' and not self._retried:
+        return
+      self._next_callback += 1
 
-    parser = FeedParser()
-    parser.feed(for_parser)
-    mime_response = parser.close()
+      request = self._requests[request_id]
+      callback = self._callbacks[request_id]
 
-    if not mime_response.is_multipart():
-      raise BatchError("Response not in multipart/mixed format.", resp=resp,
-                       content=content)
+      response = None
+      exception = None
+      try:
+        if resp.status >= 300:
+          raise HttpError(resp, content, uri=request.uri)
+        response = request.postproc(resp, content)
+      except HttpError, e:
+        exception = e
 
-    for part in mime_response.get_payload():
-      request_id = self._header_to_id(part['Content-ID'])
-      response, content = self._deserialize_response(part.get_payload())
-      self._responses[request_id] = (response, content)
+      if callback is not None:
+        callback(request_id, response, exception)
+      if self._callback is not None:
+        self._callback(request_id, response, exception)
 
   @util.positional(1)
   def execute(self, http=None):
@@ -1216,6 +1548,8 @@ class BatchHttpRequest(object):
     if http is None:
       raise ValueError("Missing a valid http object.")
 
+    self._next_callback = 0
+    self._retried = False
     self._execute(http, self._order, self._requests)
 
     # Loop over all the requests and check for 401s. For each 401 request the
@@ -1230,33 +1564,18 @@ class BatchHttpRequest(object):
         request = self._requests[request_id]
         self._refresh_and_apply_credentials(request, http)
         redo_requests[request_id] = request
+        # Callbacks wait for the response to the retry instead.
+        del self._responses[request_id]
 
+    # Responses are final from now on, even if they are still 401s.
+    self._retried = True
     if redo_requests:
       self._execute(http, redo_order, redo_requests)
 
     # Now process all callbacks that are erroring, and raise an exception for
     # ones that return a non-2xx response? Or add extra parameter to callback
     # that contains an HttpError?
-
-    for request_id in self._order:
-      resp, content = self._responses[request_id]
-
-      request = self._requests[request_id]
-      callback = self._callbacks[request_id]
-
-      response = None
-      exception = None
-      try:
-        if resp.status >= 300:
-          raise HttpError(resp, content, uri=request.uri)
-        response = request.postproc(resp, content)
-      except HttpError, e:
-        exception = e
-
-      if callback is not None:
-        callback(request_id, response, exception)
-      if self._callback is not None:
-        self._callback(request_id, response, exception)
+    self._deliver_ready()
 
 
 class HttpRequestMock(object):
@@ -62,6 +62,7 @@ The constructor takes a discovery document in which to look up named schema.
 __author__ = 'jcgregorio@google.com (Joe Gregorio)'
 
 import copy
+import re
 
 from oauth2client import util
 from oauth2client.anyjson import simplejson
@@ -163,6 +164,92 @@ class Schemas(object):
     """
     return self.schemas[name]
 
+  def validate_fields(self, schema, fields):
+    """Check that a partial response field mask only selects known fields.
+
+    The mask uses the syntax of the 'fields' query parameter, e.g.
+    'nextPageToken,items(id,title),items/notification/level'. Schemas that
+    don't describe their properties accept any field below them.
+
+    Args:
+      schema: object, Parsed JSON schema of the response, or a {'$ref': name}
+        reference to it.
+      fields: string, The field mask.
+
+    Raises:
+      ValueError if the mask is malformed or selects an unknown field.
+    """
+    tokens = _FIELD_MASK_TOKEN.findall(fields)
+    if ''.join(tokens) != fields:
+      raise ValueError('Malformed field mask "%s"' % fields)
+    pos = self._validate_selection(schema, tokens, 0, fields)
+    if pos != len(tokens):
+      raise ValueError('Malformed field mask "%s"' % fields)
+
+  def _resolve(self, schema):
+    """Returns the schema with references and arrays resolved to their items."""
+    while True:
+      if '$ref' in schema:
+        schema = self.schemas.get(schema['$ref'], {})
+      elif schema.get('type') == 'array':
+        schema = schema.get('items', {})
+      else:
+        return schema
+
+  def _validate_selection(self, schema, tokens, pos, fields):
+    """Validates a comma separated selection starting at tokens[pos].
+
+    Returns:
+      int, Position of the first token after the selection.
+    """
+    while True:
+      pos = self._validate_path(schema, tokens, pos, fields)
+      if pos < len(tokens) and tokens[pos] == ',':
+        pos += 1
+      else:
+        return pos
+
+  def _validate_path(self, schema, tokens, pos, fields):
+    """Validates a single path, with its sub-selection, at tokens[pos].
+
+    Returns:
+      int, Position of the first token after the path.
+    """
+    while True:
+      if pos >= len(tokens) or tokens[pos] in _FIELD_MASK_SEPARATORS:
+        raise ValueError('Malformed field mask "%s"' % fields)
+      schema = self._field_schema(schema, tokens[pos].strip(), fields)
+      pos += 1
+      if pos < len(tokens) and tokens[pos] == '/':
+        pos += 1
+        continue
+      if pos < len(tokens) and tokens[pos] == '(':
+        pos = self._validate_selection(schema, tokens, pos + 1, fields)
+        if pos >= len(tokens) or tokens[pos] != ')':
+          raise ValueError('Malformed field mask "%s"' % fields)
+        pos += 1
+      return pos
+
+  def _field_schema(self, schema, name, fields):
+    """Returns the schema of the field name of objects described by schema."""
+    schema = self._resolve(schema)
+    properties = schema.get('properties')
+    if name == '*':
+      return {}
+    if properties and name in properties:
+      return properties[name]
+    if 'additionalProperties' in schema:
+      return schema['additionalProperties']
+    if properties is None and schema.get('type', 'any') in ('object', 'any'):
+      return {}
+    raise ValueError('Field mask "%s" selects unknown field "%s"' %
+                     (fields, name))
+
+
+# Tokens of a partial response field mask.
+_FIELD_MASK_TOKEN = re.compile(r'[(),/]|[^(),/]+')
+_FIELD_MASK_SEPARATORS = frozenset('(),/')
+
 
 class _SchemaToStruct(object):
   """Convert schema to a prototype object."""
@@ -54,6 +54,12 @@ except ImportError:
 import hmac
 from gettext import gettext as _
 import socket
+import threading
+try:
+    import select
+except ImportError:
+    # Not available on every platform, e.g. in some sandboxes.
+    select = None
 
 try:
     from httplib2 import socks
@@ -107,7 +113,7 @@ __all__ = [
     'RedirectLimit', 'FailedToDecompressContent',
     'UnimplementedDigestAuthOptionError',
     'UnimplementedHmacDigestAuthOptionError',
-    'debuglevel', 'ProxiesUnavailableError']
+    'debuglevel', 'ProxiesUnavailableError', 'ConnectionPool']
 
 
 # The httplib debug level, set to a non-zero value to get debug output
@@ -1122,6 +1128,102 @@ except (ImportError, AttributeError):
     pass
 
 
+class ConnectionPool(object):
+    """A thread-safe pool of idle connections that Http objects can share.
+
+    Connections are keyed on "scheme:authority", the same key an Http object
+    uses for its own connections. An Http object created with a pool checks a
+    connection out at the start of each request and hands it back once the
+    response has been read, so many short-lived Http objects (for example one
+    per user, each authorized with that user's credentials) can reuse the same
+    TCP and TLS sessions without owning them.
+
+    Http objects sharing a pool should use the same timeout, proxy and
+    certificate validation settings, since a pooled connection keeps the
+    settings of the Http object that opened it.
+
+    Only connections with an open socket are reused. On Google App Engine,
+    where httplib goes through urlfetch, connections have no socket of their
+    own and the pool saves no handshakes.
+    """
+    def __init__(self, max_per_host=4, idle_timeout=60):
+        """'max_per_host' is the number of idle connections kept per
+        "scheme:authority", extra connections are closed when returned.
+
+        'idle_timeout' is the number of seconds a connection may sit idle in
+        the pool before it is closed instead of reused.
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        # Map conn_key to a list of (connection, time returned) pairs.
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, conn_key):
+        """Check out an idle connection for 'conn_key', or None if there is
+        no healthy one available."""
+        now = time.time()
+        discard = []
+        conn = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(conn_key, [])
+            while idle:
+                candidate, returned = idle.pop()
+                if self._is_healthy(candidate, now - returned):
+                    conn = candidate
+                    break
+                discard.append(candidate)
+        finally:
+            self._lock.release()
+        for stale in discard:
+            stale.close()
+        return conn
+
+    def put(self, conn_key, conn):
+        """Return a connection to the pool once its response has been read."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(conn_key, [])
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def clear(self):
+        """Close every idle connection in the pool."""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for conn, returned in connections:
+                conn.close()
+
+    def _is_healthy(self, conn, idle_for):
+        """A connection is reusable if it has not been idle for too long and
+        the server has not closed it. A connection without a socket was
+        closed, or never opened, so it is not reused. An open socket that is
+        readable while no request is outstanding has either been closed by
+        the server or has unexpected data on it, so it is not reused
+        either."""
+        if idle_for > self.idle_timeout:
+            return False
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        if select is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError, TypeError):
+            return False
+        return not readable
+
+
 class Http(object):
     """An HTTP client that handles:
 
@@ -1135,10 +1237,16 @@ class Http(object):
     - WSSE
 
     and more.
+
+    By default an Http object keeps one connection per host for itself, so it
+    must not be used by more than one thread at a time. An Http object created
+    with a connection_pool checks a connection out of the pool for every
+    request and returns it afterwards, and can be shared between threads.
     """
     def __init__(self, cache=None, timeout=None,
                  proxy_info=proxy_info_from_environment,
-                 ca_certs=None, disable_ssl_certificate_validation=False):
+                 ca_certs=None, disable_ssl_certificate_validation=False,
+                 connection_pool=None):
         """If 'cache' is a string then it is used as a directory name for
         a disk cache. Otherwise it must be an object that supports the
         same interface as FileCache.
@@ -1161,6 +1269,11 @@ class Http(object):
 
         If disable_ssl_certificate_validation is true, SSL cert validation will
         not be performed.
+
+        If 'connection_pool' is a ConnectionPool then connections are borrowed
+        from it for the duration of each request instead of being kept by this
+        object, which lets them outlive it and makes this object safe to
+        use from several threads at once.
         """
         self.proxy_info = proxy_info
         self.ca_certs = ca_certs
@@ -1169,6 +1282,8 @@ class Http(object):
 
         # Map domain name to an httplib connection
         self.connections = {}
+        # Shared pool to borrow connections from instead, or None.
+        self.connection_pool = connection_pool
         # The location of the cache, for now a directory
         # where cached responses are held.
         if cache and isinstance(cache, basestring):
@@ -1184,6 +1299,7 @@ class Http(object):
 
         # authorization objects
         self.authorizations = []
+        self._authorizations_lock = threading.Lock()
 
         # If set to False then no redirects are followed, even safe ones.
         self.follow_redirects = True
@@ -1213,11 +1329,16 @@ class Http(object):
             del state_dict['request']
         if 'connections' in state_dict:
             del state_dict['connections']
+        if 'connection_pool' in state_dict:
+            del state_dict['connection_pool']
+        del state_dict['_authorizations_lock']
         return state_dict
 
     def __setstate__(self, state):
         self.__dict__.update(state)
         self.connections = {}
+        self.connection_pool = None
+        self._authorizations_lock = threading.Lock()
 
     def _auth_from_challenge(self, host, request_uri, headers, response, content):
         """A generator that creates Authorization objects
@@ -1243,7 +1364,11 @@ class Http(object):
         """Remove all the names and passwords
         that are used for authentication"""
         self.credentials.clear()
-        self.authorizations = []
+        self._authorizations_lock.acquire()
+        try:
+            self.authorizations = []
+        finally:
+            self._authorizations_lock.release()
 
     def _conn_request(self, conn, request_uri, method, body, headers):
         for i in range(RETRIES):
@@ -1327,7 +1452,11 @@ class Http(object):
                 authorization.request(method, request_uri, headers, body)
                 (response, content) = self._conn_request(conn, request_uri, method, body, headers, )
                 if response.status != 401:
-                    self.authorizations.append(authorization)
+                    self._authorizations_lock.acquire()
+                    try:
+                        self.authorizations.append(authorization)
+                    finally:
+                        self._authorizations_lock.release()
                     authorization.response(response, body)
                     break
 
@@ -1406,6 +1535,8 @@ class Http(object):
         being and instance of the 'Response' class, the second being
         a string that contains the response entity body.
         """
+        # Connection borrowed from self.connection_pool for this request.
+        pooled_conn = None
         try:
             if headers is None:
                 headers = {}
@@ -1426,15 +1557,22 @@ class Http(object):
             proxy_info = self._get_proxy_info(scheme, authority)
 
             conn_key = scheme+":"+authority
-            if conn_key in self.connections:
+            certs = list(self.certificates.iter(authority))
+            # Connections using a client certificate are never shared.
+            use_pool = (self.connection_pool is not None and not certs
+                        and not connection_type)
+            if use_pool:
+                pooled_conn = self.connection_pool.get(conn_key)
+            if pooled_conn is not None:
+                conn = pooled_conn
+            elif not use_pool and conn_key in self.connections:
                 conn = self.connections[conn_key]
             else:
                 if not connection_type:
                     connection_type = SCHEME_TO_CONNECTION[scheme]
-                certs = list(self.certificates.iter(authority))
                 if scheme == 'https':
                     if certs:
-                        conn = self.connections[conn_key] = connection_type(
+                        conn = connection_type(
                                 authority, key_file=certs[0][0],
                                 cert_file=certs[0][1], timeout=self.timeout,
                                 proxy_info=proxy_info,
@@ -1442,17 +1580,21 @@ class Http(object):
                                 disable_ssl_certificate_validation=
                                         self.disable_ssl_certificate_validation)
                     else:
-                        conn = self.connections[conn_key] = connection_type(
+                        conn = connection_type(
                                 authority, timeout=self.timeout,
                                 proxy_info=proxy_info,
                                 ca_certs=self.ca_certs,
                                 disable_ssl_certificate_validation=
                                         self.disable_ssl_certificate_validation)
                 else:
-                    conn = self.connections[conn_key] = connection_type(
+                    conn = connection_type(
                             authority, timeout=self.timeout,
                             proxy_info=proxy_info)
                 conn.set_debuglevel(debuglevel)
+                if use_pool:
+                    pooled_conn = conn
+                else:
+                    self.connections[conn_key] = conn
 
             if 'range' not in headers and 'accept-encoding' not in headers:
                 headers['accept-encoding'] = 'gzip, deflate'
@@ -1527,6 +1669,8 @@ class Http(object):
                         response = Response(info)
                         if cached_value:
                             response.fromcache = True
+                        if pooled_conn is not None:
+                            self.connection_pool.put(conn_key, pooled_conn)
                         return (response, content)
 
                     if entry_disposition == "STALE":
@@ -1569,6 +1713,10 @@ class Http(object):
                 else:
                     (response, content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
         except Exception, e:
+            if pooled_conn is not None:
+                # The state of the connection is unknown, so don't reuse it.
+                pooled_conn.close()
+                pooled_conn = None
             if self.force_exception_to_status_code:
                 if isinstance(e, HttpLib2ErrorWithResponse):
                     response = e.response
@@ -1594,6 +1742,8 @@ class Http(object):
             else:
                 raise
 
+        if pooled_conn is not None:
+            self.connection_pool.put(conn_key, pooled_conn)
 
         return (response, content)
 
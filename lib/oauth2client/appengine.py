@@ -62,6 +62,15 @@ OAUTH2CLIENT_NAMESPACE = 'oauth2client#ns'
 
 XSRF_MEMCACHE_ID = 'xsrf_secret_key'
 
+# A lease taken by StorageByKeyName.acquire_lock() expires after this many
+# seconds, in case its holder dies without releasing it.
+LEASE_EXPIRATION_SECONDS = 30
+
+# How long StorageByKeyName.acquire_lock() waits for a lease held by another
+# instance before going ahead without it, and how often it checks.
+LEASE_WAIT_SECONDS = 5
+LEASE_POLL_SECONDS = 0.1
+
 
 def _safe_html(s):
   """Escape text to make it safe to display.
@@ -364,6 +373,11 @@ class StorageByKeyName(Storage):
   This Storage helper presumes the Credentials have been stored as a
   CredentialsProperty or CredentialsNDBProperty on a datastore model class, and
   that entities are stored by key_name.
+
+  The Storage lock is a lease kept in memcache, so it is shared by every
+  instance of the application. While one of them refreshes the access token
+  the others wait, and then find the new token in the datastore instead of
+  refreshing it again themselves.
   """
 
   @util.positional(4)
@@ -383,6 +397,11 @@ class StorageByKeyName(Storage):
     self._key_name = key_name
     self._property_name = property_name
     self._cache = cache
+    # Value of the lease held in memcache, None when it isn't held.
+    self._lease = None
+    # Whether acquire_lock() returned, with or without the lease, and
+    # release_lock() wasn't called since.
+    self._locked = False
 
   def _is_ndb(self):
     """Determine whether the model of the instance is an NDB model.
@@ -400,6 +419,65 @@ class StorageByKeyName(Storage):
 
     raise TypeError('Model class not an NDB or DB model: %s.' % (self._model,))
 
+  def _lease_key(self):
+    """Returns the memcache key of the lease on this credential."""
+    return 'lease#%s#%s' % (self._model.__name__, self._key_name)
+
+  def acquire_lock(self):
+    """Acquires the lease on this credential.
+
+    Waits up to LEASE_WAIT_SECONDS for another holder to release it. The lease
+    only exists to avoid redundant refreshes, so if it can't be had in time,
+    because memcache is unavailable or the holder died, this goes ahead
+    without it.
+    """
+    self._locked = True
+    key = self._lease_key()
+    lease = os.urandom(8).encode('hex')
+    deadline = time.time() + LEASE_WAIT_SECONDS
+    while not self._add_lease(key, lease):
+      if memcache.get(key, namespace=OAUTH2CLIENT_NAMESPACE) is None:
+        # add() also fails when memcache is unavailable. Unless the lease was
+        # released just now, in which case it can be taken, nobody holds it
+        # and there is nothing to wait for.
+        if self._add_lease(key, lease):
+          break
+        logger.warning('Memcache unavailable, proceeding without the lease '
+                       'on %s', key)
+        return
+      if time.time() >= deadline:
+        logger.warning('Proceeding without the lease on %s', key)
+        return
+      time.sleep(LEASE_POLL_SECONDS)
+    self._lease = lease
+
+  def _add_lease(self, key, lease):
+    """Takes the lease if nobody holds it, returns whether it was taken."""
+    return memcache.add(key, lease, time=LEASE_EXPIRATION_SECONDS,
+                        namespace=OAUTH2CLIENT_NAMESPACE)
+
+  def release_lock(self):
+    """Releases the lease on this credential if it is held."""
+    self._locked = False
+    if self._lease is None:
+      return
+    key = self._lease_key()
+    # Don't release a lease that expired and was taken by someone else.
+    if memcache.get(key, namespace=OAUTH2CLIENT_NAMESPACE) == self._lease:
+      memcache.delete(key, namespace=OAUTH2CLIENT_NAMESPACE)
+    self._lease = None
+
+  def get(self):
+    """Retrieve credential.
+
+    Reading a single entity is atomic, so unlike put() and delete() this does
+    not take the lease.
+
+    Returns:
+      oauth2client.Credentials
+    """
+    return self.locked_get()
+
   def _get_entity(self):
     """Retrieve entity from datastore.
 
@@ -426,6 +504,23 @@ class StorageByKeyName(Storage):
       entity_key = db.Key.from_path(self._model.kind(), self._key_name)
       db.delete(entity_key)
 
+  def _read_cache(self):
+    """Read the credentials from the cache.
+
+    A cache with a tier local to the instance, such as a TwoTierCache, can
+    still hold credentials another instance refreshed while this one waited
+    for the lease. While the lock is held, the shared tier of such a cache is
+    read instead, so that the refreshed credentials are seen and not refreshed
+    again.
+
+    Returns:
+      The credentials as JSON, or None.
+    """
+    get_shared = getattr(self._cache, 'get_shared', None)
+    if self._locked and get_shared is not None:
+      return get_shared(self._key_name)
+    return self._cache.get(self._key_name)
+
   def locked_get(self):
     """Retrieve Credential from datastore.
 
@@ -433,9 +528,11 @@ class StorageByKeyName(Storage):
       oauth2client.Credentials
     """
     if self._cache:
-      json = self._cache.get(self._key_name)
+      json = self._read_cache()
       if json:
-        return Credentials.new_from_json(json)
+        credentials = Credentials.new_from_json(json)
+        credentials.set_store(self)
+        return credentials
 
     credentials = None
     entity = self._get_entity()
@@ -451,6 +548,9 @@ class StorageByKeyName(Storage):
   def locked_put(self, credentials):
     """Write a Credentials to the datastore.
 
+    Called by put() and by a refresh once the lock is held, the credentials
+    are written to the datastore and then to every tier of the cache.
+
     Args:
       credentials: Credentials, the credentials to store.
     """
@@ -27,6 +27,7 @@ import httplib2
 import logging
 import os
 import sys
+import threading
 import time
 import urllib
 import urlparse
@@ -66,6 +67,15 @@ OOB_CALLBACK_URN = 'urn:ietf:wg:oauth:2.0:oob'
 # Google Data client libraries may need to set this to [401, 403].
 REFRESH_STATUS_CODES = [401]
 
+# Refreshes of the same refresh_token are serialized within the process, and
+# the outcome of the latest one is remembered so that callers which waited for
+# it can reuse the new access_token instead of refreshing again. Both maps only
+# hold refresh tokens that are being refreshed or waited for: entries are
+# dropped when the last thread using them releases the lock.
+_refresh_locks = {}
+_refresh_locks_lock = threading.Lock()
+_latest_refresh = {}
+
 
 class Error(Exception):
   """Base error for this module."""
@@ -342,6 +352,45 @@ class Storage(object):
       self.release_lock()
 
 
+def _acquire_refresh_lock(refresh_token):
+  """Acquires the lock serializing refreshes of a refresh_token.
+
+  Args:
+    refresh_token: string, the refresh token.
+  """
+  _refresh_locks_lock.acquire()
+  try:
+    entry = _refresh_locks.get(refresh_token)
+    if entry is None:
+      # The lock and the number of threads holding or waiting for it.
+      entry = _refresh_locks[refresh_token] = [threading.Lock(), 0]
+    entry[1] += 1
+  finally:
+    _refresh_locks_lock.release()
+  entry[0].acquire()
+
+
+def _release_refresh_lock(refresh_token):
+  """Releases the lock taken by _acquire_refresh_lock.
+
+  Once no other thread waits for it, the lock and the outcome of the latest
+  refresh of refresh_token are forgotten.
+
+  Args:
+    refresh_token: string, the refresh token.
+  """
+  _refresh_locks_lock.acquire()
+  try:
+    entry = _refresh_locks[refresh_token]
+    entry[0].release()
+    entry[1] -= 1
+    if not entry[1]:
+      del _refresh_locks[refresh_token]
+      _latest_refresh.pop(refresh_token, None)
+  finally:
+    _refresh_locks_lock.release()
+
+
 def clean_headers(headers):
   """Forces header keys and values to be strings, i.e not unicode.
 
@@ -638,10 +687,44 @@ class OAuth2Credentials(Credentials):
   def _refresh(self, http_request):
     """Refreshes the access_token.
 
-    This method first checks by reading the Storage object if available.
+    Only one refresh per refresh_token runs at a time in this process. A
+    caller that had to wait for another one to finish reuses the access_token
+    it obtained, provided it differs from the caller's own and has not
+    expired yet.
+
+    Otherwise this method checks by reading the Storage object if available.
     If a refresh is still needed, it holds the Storage lock until the
     refresh is completed.
 
+    Args:
+      http_request: callable, a callable that matches the method signature of
+        httplib2.Http.request, used to make the refresh request.
+
+    Raises:
+      AccessTokenRefreshError: When the refresh fails.
+    """
+    if not self.refresh_token:
+      self._locked_refresh(http_request)
+      return
+
+    refresh_token = self.refresh_token
+    _acquire_refresh_lock(refresh_token)
+    try:
+      latest = _latest_refresh.get(self.refresh_token)
+      if (latest is not None and
+          latest['access_token'] != self.access_token and
+          (latest['token_expiry'] is None or
+           latest['token_expiry'] > datetime.datetime.utcnow())):
+        logger.info('Reusing access_token from a concurrent refresh')
+        self.__dict__.update(latest)
+      else:
+        self._locked_refresh(http_request)
+    finally:
+      _release_refresh_lock(refresh_token)
+
+  def _locked_refresh(self, http_request):
+    """Refreshes the access_token, using the Storage lock if available.
+
     Args:
       http_request: callable, a callable that matches the method signature of
         httplib2.Http.request, used to make the refresh request.
@@ -683,6 +766,7 @@ class OAuth2Credentials(Credentials):
     if resp.status == 200:
       # TODO(jcgregorio) Raise an error if loads fails?
       d = simplejson.loads(content)
+      old_refresh_token = self.refresh_token
       self.token_response = d
       self.access_token = d['access_token']
       self.refresh_token = d.get('refresh_token', self.refresh_token)
@@ -691,6 +775,13 @@ class OAuth2Credentials(Credentials):
             seconds=int(d['expires_in'])) + datetime.datetime.utcnow()
       else:
         self.token_expiry = None
+      if old_refresh_token:
+        _latest_refresh[old_refresh_token] = {
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'token_expiry': self.token_expiry,
+            'token_response': self.token_response,
+            }
       if self.store:
         self.store.locked_put(self)
     else:
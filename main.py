@@ -27,11 +27,12 @@ from attachmentproxy.handler import ATTACHMENT_PROXY_ROUTES
 from main_handler import MAIN_ROUTES
 from oauth.handler import OAUTH_ROUTES
 from signout.handler import SIGNOUT_ROUTES
+from tasks.handler import TASKS_ROUTES
 
 
 ROUTES = (
     ATTACHMENT_PROXY_ROUTES + MAIN_ROUTES + OAUTH_ROUTES +
-    SIGNOUT_ROUTES)
+    SIGNOUT_ROUTES + TASKS_ROUTES)
 
 
 app = webapp2.WSGIApplication(ROUTES)
@@ -17,22 +17,23 @@
 __author__ = 'alainv@google.com (Alain Vongsouvanh)'
 
 
+import datetime
 import jinja2
 import logging
 import os
 import webapp2
 
-import httplib2
 import json
 from FeedlyKey import FEEDLY_USER, FEEDLY_SECRET
-from random import randint
 from apiclient import errors
 from apiclient.http import MediaIoBaseUpload
 from apiclient.http import BatchHttpRequest
-from oauth2client.appengine import StorageByKeyName
 from lib.FeedlySDK.FeedlyApi import FeedlyAPI
-from model import Credentials, FeedlyUser, RefreshCards
-from google.appengine.ext import db
+from feedly_users import FeedlyUserRepository
+import notifications
+import parallel
+import refresh_cards
+import subscriptions
 import util
 
 
@@ -42,6 +43,21 @@ jinja_environment = jinja2.Environment(
 FEEDLY_REDIRECT = "https://feedly-glass.appspot.com" #http://localhost
 CARD_COVER_TITLE = "COVER"
 CARD_REFRESH_TITLE = "REFRESH"
+# The timeline is listed page by page, up to a limit, with only the fields
+# needed to recognize the cards. Writes only ask for the id of the item back.
+TIMELINE_PAGE_SIZE = 20
+MAX_TIMELINE_PAGES = 5
+TIMELINE_LIST_FIELDS = ['nextPageToken', 'items(id,title,sourceItemId,isDeleted,displayTime)']
+
+
+def _display_time(card):
+    """Return the displayTime of a timeline card as a datetime, or None."""
+    value = card.get('displayTime')
+    if not value:
+        return None
+    return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
 class _BatchCallback(object):
   """Class used to track batch request responses."""
 
@@ -49,6 +65,8 @@ class _BatchCallback(object):
     """Initialize a new _BatchCallback object."""
     self.success = 0
     self.failure = 0
+    # Ids of the requests that succeeded.
+    self.succeeded = set()
 
   def callback(self, request_id, response, exception):
     """Method called on each HTTP Response from a batch request.
@@ -58,12 +76,40 @@ class _BatchCallback(object):
     """
     if exception is None:
       self.success += 1
+      self.succeeded.add(request_id)
     else:
       self.failure += 1
       logging.error(
           'Failed to insert item for user %s: %s', request_id, exception)
 
-class LandingPage(webapp2.RequestHandler):
+class _NotificationContext(object):
+  """What the actions of a notification job are run against."""
+
+  def __init__(self, job, token, mirror_service, timeline_item):
+    """Initialize a new _NotificationContext object.
+
+    Args:
+      job: dict, the notification job.
+      token: string, Feedly access token of the user.
+      mirror_service: Mirror service authorized for the user.
+      timeline_item: dict, the timeline item the actions were taken on.
+    """
+    self.job = job
+    self.token = token
+    self.mirror_service = mirror_service
+    self.timeline_item = timeline_item
+
+
+class _FeedlyRequestHandler(webapp2.RequestHandler):
+    """Base class of the handlers reading the users' Feedly tokens."""
+
+    def initialize(self, request, response):
+        super(_FeedlyRequestHandler, self).initialize(request, response)
+        # A new repository per request keeps the memoized entities fresh.
+        self.feedly_users = FeedlyUserRepository()
+
+
+class LandingPage(_FeedlyRequestHandler):
     def get(self):
         if self.request.get("code"):
             self._handle_feedly_auth(self.request.get("code"))
@@ -84,7 +130,7 @@ class LandingPage(webapp2.RequestHandler):
 
     @util.auth_required
     def _check_feedly_auth(self):
-        user = db.GqlQuery("SELECT * FROM FeedlyUser WHERE id = :1", self.userid).get()
+        user = self.feedly_users.mark_seen(self.userid)
         if user and user.feedly_access_token != '':
             return True
         return False
@@ -93,72 +139,109 @@ class LandingPage(webapp2.RequestHandler):
     def _handle_feedly_auth(self, code):
         fa = FeedlyAPI(FEEDLY_USER, FEEDLY_SECRET)
         resp = fa.getToken(code, FEEDLY_REDIRECT)
-        user = db.GqlQuery("SELECT * FROM FeedlyUser WHERE id = :1", self.userid).get()
         logging.debug(resp)
         if 'access_token' in resp:
-            if not user:
-                user = FeedlyUser(id=self.userid)
-            user.feedly_access_token=resp['access_token']
-            user.feedly_refresh_token=resp['refresh_token']
             logging.debug("insert "+str(self.userid))
-            user.put()
+            self.feedly_users.save_tokens(
+                self.userid, resp['access_token'], resp['refresh_token'],
+                util.feedly_token_expiry(resp))
 
 
 
-class FeedlyHandler(webapp2.RequestHandler):
+class FeedlyHandler(_FeedlyRequestHandler):
 
     @util.auth_required
     def get(self):
         self._refresh_stream(self.mirror_service)
 
     def post(self):
-        data = json.loads(self.request.body)
-        actions  = data.get('userActions', [])
-        for action in actions:
-            if 'payload' in action:
-                credentials = StorageByKeyName(Credentials, data['userToken'], 'credentials').get()
-                token = self._get_auth_token(data['userToken'])
-                if credentials and token:
-                    mirror_service = util.create_service('mirror', 'v1', credentials)
-                    timeline_item = mirror_service.timeline().get(id=data['itemId']).execute()
-                    if  action['payload'] == 'save':
-                        logging.debug('save to feedly')
-                        fa = FeedlyAPI(FEEDLY_USER, FEEDLY_SECRET)
-                        id_parts = self._parse_source_id(timeline_item['sourceItemId'])
-                        fa.addTagSave(id_parts['userId'], id_parts['entryId'], token)
-                    elif action['payload'] == 'refresh':
-                        logging.debug('sourceId:'+timeline_item['sourceItemId'])
-                        #refreshCard = db.GqlQuery("SELECT * FROM RefreshCards WHERE id = :1", timeline_item['sourceItemId']).get()
-                        #if memcache.get(key=timeline_item['sourceItemId']):
-                            #memcache.delete(timeline_item['sourceItemId'])
-                        if self._del_refresh_card(timeline_item['sourceItemId']):
-                            logging.debug('refresh items')
-                            logging.debug(data)
-                            self._refresh_stream(mirror_service, token=token)
+        try:
+            jobs = notifications.make_jobs(json.loads(self.request.body))
+        except ValueError:
+            logging.warning('Ignoring malformed notification')
+            jobs = []
+        dispatched = 0
+        try:
+            for job in jobs:
+                NOTIFICATION_DISPATCHER.dispatch(job)
+                dispatched += 1
+        except Exception:
+            # Jobs already queued stay remembered, so that the redelivery
+            # of the notification doesn't queue them twice.
+            notifications.forget_jobs(jobs[dispatched:])
+            raise
         self.response.set_status(200)
         self.response.out.write("")
 
+    def handle_notification(self, job):
+        """Run the user actions of a job queued by post.
+
+        The credentials, Feedly token, Mirror service and timeline item are
+        loaded once and shared by all the actions of the job.
+        """
+        context = self._load_notification_context(job)
+        if context is None:
+            return
+        handlers = {
+            'save': self._handle_save,
+            'refresh': self._handle_refresh
+        }
+        done = set()
+        for payload in job['payloads']:
+            # Repeating an action on the same item has no further effect.
+            if payload in handlers and payload not in done:
+                done.add(payload)
+                handlers[payload](context)
+
+    def _load_notification_context(self, job):
+        credentials = util.credentials_storage(job['userToken']).get()
+        self.feedly_users.mark_seen(job['userToken'])
+        token = self._get_auth_token(job['userToken'])
+        if not credentials or not token:
+            return None
+        mirror_service = util.create_service('mirror', 'v1', credentials)
+        timeline_item = mirror_service.timeline().get(id=job['itemId'], fields='sourceItemId').execute()
+        return _NotificationContext(job, token, mirror_service, timeline_item)
+
+    def _handle_save(self, context):
+        logging.debug('save to feedly')
+        fa = FeedlyAPI(FEEDLY_USER, FEEDLY_SECRET)
+        id_parts = self._parse_source_id(context.timeline_item['sourceItemId'])
+        fa.addTagSave(id_parts['userId'], id_parts['entryId'], context.token)
+
+    def _handle_refresh(self, context):
+        source_id = context.timeline_item['sourceItemId']
+        logging.debug('sourceId:'+source_id)
+        if refresh_cards.consume(source_id):
+            logging.debug('refresh items')
+            logging.debug(context.job)
+            try:
+                self._refresh_stream(context.mirror_service, token=context.token,
+                                     userid=context.job['userToken'])
+            except Exception:
+                # Let the retry of the job refresh again.
+                refresh_cards.register(source_id)
+                raise
+
     def _get_auth_token(self, userId=None):
         if not userId:
             userId = self.userid
-        user = db.GqlQuery("SELECT * FROM FeedlyUser WHERE id = :1", userId).get()
+        user = self.feedly_users.get(userId)
         if user:
             return user.feedly_access_token
         else:
             return None
 
-    def _set_auth_token(self, token, userId=None):
+    def _set_auth_token(self, token, userId=None, expiry=None):
         if not userId:
             userId = self.userid
-        user = db.GqlQuery("SELECT * FROM FeedlyUser WHERE id = :1", userId).get()
-        if user:
-            user.feedly_access_token = token
-            user.put()
+        if self.feedly_users.get(userId):
+            self.feedly_users.save_tokens(userId, token, expiry=expiry)
 
     def _get_refresh_token(self, userId=None):
         if not userId:
             userId = self.userid
-        user = db.GqlQuery("SELECT * FROM FeedlyUser WHERE id = :1", userId).get()
+        user = self.feedly_users.get(userId)
         if user:
             return user.feedly_refresh_token
         else:
@@ -182,89 +265,111 @@ class FeedlyHandler(webapp2.RequestHandler):
             'entryId' : pieces[1]
         }
 
-    def _get_refresh_id(self, feedlyUserId):
-        return feedlyUserId + "#REFRESH#"+str(randint(1,1000))
-
-    def _set_refresh_card(self, id):
-        RefreshCards(id=id).put()
-
-    def _del_refresh_card(self, id):
-        refreshCard = db.GqlQuery("SELECT * FROM RefreshCards WHERE id = :1", id).get()
-        if refreshCard:
-            refreshCard.delete()
-            return True
-        return False
-
-    def _refresh_stream(self, mirror_service, token=None):
+    def _refresh_stream(self, mirror_service, token=None, userid=None):
+        # Handlers run by the notification worker have no userid of their own.
+        if userid is None:
+            userid = self.userid
         if not token:
-            token = self._get_auth_token()
+            token = self._get_auth_token(userid)
         if token:
-            fa = FeedlyAPI(FEEDLY_USER, FEEDLY_SECRET)
-            profile = fa.getProfile(token)
-            if 'errorCode' in profile:
-                refresh_token = self._get_refresh_token()
-                resp = fa.refreshToken(refresh_token)
-                if 'access_token' in resp:
-                    token = resp['access_token']
-                    self._set_auth_token(token)
-                    profile = fa.getProfile(None)
-            userId = profile['id']
-            if hasattr(self,'userid'):
-                self._subscribeTimelineEvent(mirror_service, self.userid)
-            existing_cards = self._clearTimeline(mirror_service)
-            batch = BatchHttpRequest()
-            if not existing_cards[CARD_COVER_TITLE]:
-                cardCover = self._create_bundle_cover(1)
-                batch.add(
-                    mirror_service.timeline().insert(body=cardCover),
-                    request_id=str(userId)+'-cover'
-                )
-            else:
-                batch.add(
-                    mirror_service.timeline().update(id=existing_cards[CARD_COVER_TITLE]['id'], body=existing_cards[CARD_COVER_TITLE]),
-                    request_id=str(userId)+'-cover'
-                )
-            if not existing_cards[CARD_REFRESH_TITLE]:
-                cardRefresh = self._create_refresh_card(self._get_refresh_id(userId), 1)
-                batch.add(
-                    mirror_service.timeline().insert(body=cardRefresh),
-                    request_id=str(userId)+'-refresh'
-                )
-            else:
-                self._del_refresh_card(existing_cards[CARD_REFRESH_TITLE]['sourceItemId'])
-                id = self._get_refresh_id(userId)
-                self._set_refresh_card(id)
-                existing_cards[CARD_REFRESH_TITLE]['sourceItemId'] = id
-                batch.add(
-                    mirror_service.timeline().update(id=existing_cards[CARD_REFRESH_TITLE]['id'], body=existing_cards[CARD_REFRESH_TITLE]),
-                    request_id=str(userId)+'-refresh'
-                )
-
-            feed_content = fa.getStreamContentUser(token, userId, count=5, unreadOnly='true')
-            logging.debug(feed_content)
-            if feed_content['items']:
-                markEntryIds = []
-                for item in feed_content['items']:
-                    logging.debug(item['title'])
-                    image = None
-                    if 'thumbnail' in item:
-                        image = item['thumbnail'][0]['url']
-                    elif 'visual' in item and 'url' in item['visual']:
-                        image = item['visual']['url']
-                    elif 'summary' in item and 'content' in item['summary'] and 'src=' in item['summary']['content']:
-                        start_loc = item['summary']['content'].find('src="')
-                        end_loc = item['summary']['content'].find('"', start_loc+5)
-                        if start_loc != -1 and end_loc != -1:
-                            image = item['summary']['content'][start_loc+5:end_loc]
-                    markEntryIds.append(item['id'])
-                    source_id = self._get_source_id(userId,item['id'])
-                    body = self._create_card(source_id, item['title'], item['origin']['title'], image, item['alternate'][0]['href'], 1)
+            user = self.feedly_users.mark_seen(userid)
+            watermark = user.timeline_watermark if user else None
+            synced = datetime.datetime.utcnow()
+            # The Mirror calls preparing the timeline don't depend on Feedly,
+            # they run while the stream is being fetched.
+            pending = []
+            try:
+                pending.append(parallel.submit(self._subscribeTimelineEvent, mirror_service, userid))
+                listed = parallel.submit(self._listTimeline, mirror_service, watermark)
+                pending.append(listed)
+
+                fa = FeedlyAPI(FEEDLY_USER, FEEDLY_SECRET)
+                profile = fa.getProfile(token)
+                if 'errorCode' in profile:
+                    refresh_token = self._get_refresh_token(userid)
+                    resp = fa.refreshToken(refresh_token)
+                    if 'access_token' in resp:
+                        token = resp['access_token']
+                        self._set_auth_token(token, userid, expiry=util.feedly_token_expiry(resp))
+                        profile = fa.getProfile(token)
+                userId = profile['id']
+                feed_content = fa.getStreamContentUser(token, userId, count=5, unreadOnly='true')
+                logging.debug(feed_content)
+
+                # Only the difference between the timeline and the unread entries
+                # is written, in a single batch.
+                existing_cards, entry_cards = listed.result()
+                batch_responses = _BatchCallback()
+                batch = BatchHttpRequest(batch_responses.callback)
+                if not existing_cards[CARD_COVER_TITLE]:
+                    cardCover = self._create_bundle_cover(1)
                     batch.add(
-                        mirror_service.timeline().insert(body=body),
-                        request_id=item['id']
+                        mirror_service.timeline().insert(body=cardCover, fields='id'),
+                        request_id=str(userId)+'-cover'
                     )
-                batch.execute(httplib2.Http())
-                fa.markAsRead(token, markEntryIds)
+                if not existing_cards[CARD_REFRESH_TITLE]:
+                    cardRefresh = self._create_refresh_card(refresh_cards.new_refresh_id(userId), 1)
+                    batch.add(
+                        mirror_service.timeline().insert(body=cardRefresh, fields='id'),
+                        request_id=str(userId)+'-refresh'
+                    )
+                else:
+                    # The card keeps its ID, registered again so that it can
+                    # trigger the next refresh, which spares a write to Mirror.
+                    refresh_cards.register(existing_cards[CARD_REFRESH_TITLE]['sourceItemId'])
+
+                unread = set(item['id'] for item in feed_content['items'])
+                for entryId, card in entry_cards.iteritems():
+                    if entryId not in unread:
+                        batch.add(
+                            mirror_service.timeline().delete(id=card['id']),
+                            request_id=card['id'])
+                if feed_content['items']:
+                    for item in feed_content['items']:
+                        if item['id'] in entry_cards:
+                            continue
+                        logging.debug(item['title'])
+                        image = None
+                        if 'thumbnail' in item:
+                            image = item['thumbnail'][0]['url']
+                        elif 'visual' in item and 'url' in item['visual']:
+                            image = item['visual']['url']
+                        elif 'summary' in item and 'content' in item['summary'] and 'src=' in item['summary']['content']:
+                            start_loc = item['summary']['content'].find('src="')
+                            end_loc = item['summary']['content'].find('"', start_loc+5)
+                            if start_loc != -1 and end_loc != -1:
+                                image = item['summary']['content'][start_loc+5:end_loc]
+                        source_id = self._get_source_id(userId,item['id'])
+                        body = self._create_card(source_id, item['title'], item['origin']['title'], image, item['alternate'][0]['href'], 1)
+                        batch.add(
+                            mirror_service.timeline().insert(body=body, fields='id'),
+                            request_id=item['id']
+                        )
+                # Nothing is sent when the timeline is already up to date.
+                if not batch.is_empty():
+                    batch.execute(util.SHARED_HTTP)
+                parallel.wait_all(pending)
+
+                # Entries are only marked as read once their card is on the
+                # timeline, the others are fetched again by the next refresh.
+                markEntryIds = [item['id'] for item in feed_content['items']
+                                if item['id'] in entry_cards or
+                                item['id'] in batch_responses.succeeded]
+                if markEntryIds:
+                    fa.markAsRead(token, markEntryIds)
+
+                # The next sync reads the timeline down to the oldest entry
+                # card kept, the cards inserted now are newer than synced.
+                kept = [_display_time(card) for entryId, card in entry_cards.iteritems()
+                        if entryId in unread and card.get('displayTime')]
+                new_watermark = min(kept) if kept else synced
+                if user and user.timeline_watermark != new_watermark:
+                    user.timeline_watermark = new_watermark
+                    user.put()
+            finally:
+                # The calls still running use the Http instances and
+                # credentials of this request, don't leave them behind.
+                parallel.wait(pending)
 
 
     def _create_card(self, id, title, source, image, link, bundleId):
@@ -319,7 +424,7 @@ class FeedlyHandler(webapp2.RequestHandler):
 
     def _create_refresh_card(self, id, bundleId):
         logging.debug("refresh id:"+str(id))
-        self._set_refresh_card(id)
+        refresh_cards.register(id)
         #memcache.set(key=id, value=True)
         body = {
             'bundleId' : bundleId,
@@ -341,51 +446,111 @@ class FeedlyHandler(webapp2.RequestHandler):
         return body
 
     def _subscribeTimelineEvent(self,mirror_service,userId):
-        #callback_url = 'https://mirrornotifications.appspot.com/forward?url=http://ec2-23-20-178-62.compute-1.amazonaws.com:28000/subscriptions'
-        callback_url = 'https://feedly-glass.appspot.com/subscriptions'
-        subscriptions = mirror_service.subscriptions().list().execute()
-        should_set = True
-        for subscription in subscriptions.get('items', []):
-            if subscription.get('collection') == 'timeline':
-                if subscription['callbackUrl'] == callback_url or subscription['userToken'] == userId:
-                    should_set = False
-
-        if should_set:
+        user = self.feedly_users.get(userId)
+        if user and subscriptions.is_verified(user):
+            return
+        existing = mirror_service.subscriptions().list(fields=subscriptions.LIST_FIELDS).execute()
+        if not subscriptions.has_timeline_subscription(existing, userId):
             body = {
                 'collection': 'timeline',
                 'userToken': userId,
-                'callbackUrl': callback_url
+                'callbackUrl': subscriptions.CALLBACK_URL
             }
-            mirror_service.subscriptions().insert(body=body).execute()
+            mirror_service.subscriptions().insert(body=body, fields='id').execute()
+        if user:
+            subscriptions.record(user, True)
+            user.put()
 
-    def _clearTimeline(self, mirror_service):
+    def _listTimeline(self, mirror_service, watermark=None):
+        """Return the cover and refresh cards and the entry cards by entry id.
+
+        The timeline is read a page at a time, newest cards first, until the
+        cover and refresh cards were found and a page reaches a card older
+        than watermark, the oldest entry card kept by the previous sync.
+        Without a watermark it goes on until a page holds no more untitled
+        cards. Leftover cards, duplicates and untitled cards that aren't entry
+        cards, are deleted as their page arrives.
+        """
         existing_cards = {
             CARD_REFRESH_TITLE : False,
             CARD_COVER_TITLE : False
         }
-        timeline_items = mirror_service.timeline().list(maxResults=20).execute()
-        cards = timeline_items.get('items', [])
-        if cards:
-            batch_responses = _BatchCallback()
-            batch = BatchHttpRequest(batch_responses.callback)
-            run_request = False
-            for card in cards:
+        entry_cards = {}
+        timeline = mirror_service.timeline()
+        request = timeline.list(maxResults=TIMELINE_PAGE_SIZE, fields=TIMELINE_LIST_FIELDS)
+        for page_number, page in enumerate(util.iter_pages(timeline, request)):
+            leftover_cards = []
+            has_untitled = False
+            passed_watermark = False
+            for card in page.get('items', []):
+                if watermark is not None and not passed_watermark:
+                    display_time = _display_time(card)
+                    passed_watermark = display_time is not None and display_time < watermark
+                if card.get('isDeleted'):
+                    continue
                 if not 'title' in card:
-                    run_request = True
-                    batch.add(
-                        mirror_service.timeline().delete(id=card['id']),
-                        request_id=card['id'])
-                elif card['title'] == CARD_REFRESH_TITLE:
-                    existing_cards[CARD_REFRESH_TITLE] = card
-                elif card['title'] == CARD_COVER_TITLE:
-                    existing_cards[CARD_COVER_TITLE] = card
-            if run_request:
-                batch.execute(httplib2.Http())
-        return existing_cards
+                    has_untitled = True
+                    source_id = card.get('sourceItemId', '')
+                    if '#*#' in source_id:
+                        entryId = self._parse_source_id(source_id)['entryId']
+                        if entryId not in entry_cards:
+                            entry_cards[entryId] = card
+                            continue
+                    leftover_cards.append(card)
+                elif card['title'] in existing_cards:
+                    if existing_cards[card['title']]:
+                        leftover_cards.append(card)
+                    else:
+                        existing_cards[card['title']] = card
+            if leftover_cards:
+                self._deleteCards(mirror_service, leftover_cards)
+            found = existing_cards[CARD_COVER_TITLE] and existing_cards[CARD_REFRESH_TITLE]
+            if watermark is not None:
+                done = found and passed_watermark
+            else:
+                done = found and not has_untitled
+            if done or page_number + 1 >= MAX_TIMELINE_PAGES:
+                break
+        return existing_cards, entry_cards
+
+    def _deleteCards(self, mirror_service, cards):
+        batch_responses = _BatchCallback()
+        batch = BatchHttpRequest(batch_responses.callback)
+        for card in cards:
+            batch.add(
+                mirror_service.timeline().delete(id=card['id']),
+                request_id=card['id'])
+        batch.execute(util.SHARED_HTTP)
+
+
+def process_notification(job):
+    """Run a notification job outside of any request to the callback."""
+    FeedlyHandler().handle_notification(job)
+
+
+# Dispatches the jobs queued by FeedlyHandler.post. Replace with a
+# notifications.LocalDispatcher(process_notification) to run them in process.
+NOTIFICATION_DISPATCHER = notifications.TaskQueueDispatcher()
+
+
+class NotificationWorker(webapp2.RequestHandler):
+    """Runs the notification jobs posted by the task queue."""
+
+    def post(self):
+        job = json.loads(self.request.body)
+        try:
+            notifications.run_job(job, process_notification)
+        except notifications.UserBusyError:
+            # Tried again by a new task, waiting for the other jobs of the
+            # user doesn't count against the retries of this one.
+            logging.info('Postponing notification of busy user %s', job['userToken'])
+            notifications.TaskQueueDispatcher().postpone(job)
+
 
 MAIN_ROUTES = [
     ('/', LandingPage),
     ('/feeds', FeedlyHandler),
     ('/subscriptions', FeedlyHandler),
-    ('/notify', FeedlyHandler)
+    ('/notify', FeedlyHandler),
+    (notifications.WORKER_URL, NotificationWorker)
 ]
@@ -0,0 +1,68 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""State of the data migrations, shared by every instance."""
+
+
+import datetime
+import threading
+import time
+
+from model import Migration
+
+
+# How long an instance trusts that a migration is still running before it
+# checks the datastore again.
+CHECK_INTERVAL_SECONDS = 60
+
+# Names of the migrations known to be finished, which is permanent, and when
+# the others were last checked.
+_finished = set()
+_checked = {}
+_lock = threading.Lock()
+
+
+def is_finished(name):
+  """Return whether the migration called name is finished.
+
+  Finished migrations are remembered by the instance, the others are read
+  from the datastore at most every CHECK_INTERVAL_SECONDS.
+  """
+  if name in _finished:
+    return True
+  now = time.time()
+  with _lock:
+    if now < _checked.get(name, 0) + CHECK_INTERVAL_SECONDS:
+      return False
+    _checked[name] = now
+  migration = Migration.get_by_key_name(name)
+  if migration is not None and migration.finished is not None:
+    _finished.add(name)
+    return True
+  return False
+
+
+def start(name):
+  """Return when the migration called name started, recording it if needed."""
+  migration = Migration.get_or_insert(name, started=datetime.datetime.utcnow())
+  return migration.started
+
+
+def mark_finished(name):
+  """Record that the migration called name is finished."""
+  migration = Migration.get_by_key_name(name) or Migration(key_name=name)
+  migration.finished = datetime.datetime.utcnow()
+  migration.put()
+  _finished.add(name)
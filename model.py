@@ -34,6 +34,16 @@ class FeedlyUser(db.Model):
   id = db.StringProperty()
   feedly_access_token = db.StringProperty()
   feedly_refresh_token = db.StringProperty()
+  feedly_token_expiry = db.DateTimeProperty()
+  subscription_verified = db.DateTimeProperty()
+  timeline_watermark = db.DateTimeProperty()
+  last_seen = db.DateTimeProperty()
+
+class Migration(db.Model):
+  """State of a data migration, keyed by the name of the migration."""
+  started = db.DateTimeProperty()
+  finished = db.DateTimeProperty()
 
 class RefreshCards(db.Model):
   id = db.StringProperty()
+  expires = db.DateTimeProperty()
@@ -0,0 +1,384 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Queueing of the Mirror notifications, processed outside of the callback.
+
+The subscription callback only validates a notification and queues jobs for
+it, so that Mirror gets its answer right away. Jobs are then run by a worker
+with retries, one at a time for each user and in the order they were queued.
+
+Repeated deliveries of the same action on the same item are dropped, and the
+actions for which only the last one matters, such as refreshes, are coalesced
+into a single job per user over a short window.
+"""
+
+
+import hashlib
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+
+# Name of the queue in queue.yaml and URL of the worker processing its tasks.
+NOTIFICATION_QUEUE = 'notifications'
+WORKER_URL = '/tasks/notifications'
+
+# How long the lease on a user's notifications lasts, in seconds. It is
+# extended every LEASE_SECONDS / 3 for as long as the job holding it runs.
+LEASE_SECONDS = 60
+
+# Value of a lease given up by its job, free to be taken by the next one.
+_RELEASED = ''
+
+# How long a job waits for the jobs of the same user queued before it, in
+# seconds, before running anyway. Covers jobs that were lost or gave up.
+ORDER_WAIT_SECONDS = 60
+
+# Delay in seconds before a job of a busy user is tried again.
+BUSY_COUNTDOWN_SECONDS = 2
+
+# Number of times LocalDispatcher runs a job before giving up on it.
+MAX_ATTEMPTS = 5
+
+# Payloads of the actions coalesced per user, and the length in seconds of the
+# window over which they are.
+COALESCED_PAYLOADS = frozenset(['refresh'])
+COALESCE_SECONDS = 5
+
+# How long a delivered action is remembered to drop its repeated deliveries,
+# in seconds. Coalesced actions are only remembered for COALESCE_SECONDS: their
+# item and payload stay the same from one use to the next, such as tapping
+# Refresh on the same card again, so a longer window would drop real uses.
+IDEMPOTENCY_SECONDS = 120
+
+
+class UserBusyError(Exception):
+  """Another job of the same user is being processed."""
+
+
+def _idempotency_key(item_id, payload):
+  """Return the memcache key recording the delivery of an action."""
+  return 'notification#%s#%s' % (item_id, payload)
+
+
+def make_jobs(data):
+  """Validate a notification and return the jobs processing it.
+
+  Actions already delivered within IDEMPOTENCY_SECONDS, COALESCE_SECONDS for
+  the ones in COALESCED_PAYLOADS, are left out. Each
+  action in COALESCED_PAYLOADS gets a job of its own, marked as coalesced, and
+  the other ones share a single job.
+
+  Args:
+    data: dict, notification posted by Mirror to the subscription callback.
+  Returns:
+    list of dicts with the userToken, itemId and the payloads of the user
+    actions, empty if the notification has nothing to process.
+  """
+  if not isinstance(data, dict):
+    return []
+  user_token = data.get('userToken')
+  item_id = data.get('itemId')
+  actions = data.get('userActions')
+  if not user_token or not item_id or not isinstance(actions, list):
+    return []
+  payloads = []
+  for action in actions:
+    if not isinstance(action, dict) or 'payload' not in action:
+      continue
+    payload = action['payload']
+    if payload in payloads:
+      continue
+    if payload in COALESCED_PAYLOADS:
+      remembered = COALESCE_SECONDS
+    else:
+      remembered = IDEMPOTENCY_SECONDS
+    if not memcache.add(_idempotency_key(item_id, payload), 1,
+                        time=remembered):
+      logging.info('Dropping repeated %s of item %s', payload, item_id)
+      continue
+    payloads.append(payload)
+
+  jobs = []
+  single = [p for p in payloads if p not in COALESCED_PAYLOADS]
+  if single:
+    jobs.append({'userToken': user_token, 'itemId': item_id,
+                 'payloads': single})
+  for payload in payloads:
+    if payload in COALESCED_PAYLOADS:
+      jobs.append({'userToken': user_token, 'itemId': item_id,
+                   'payloads': [payload], 'coalesce': True})
+  return jobs
+
+
+def forget_jobs(jobs):
+  """Forget the delivery of the actions of jobs that could not be queued.
+
+  Mirror delivers the notification again when the callback fails. The actions
+  of these jobs must not then be dropped as repeats, unlike the ones of jobs
+  that were queued, so only pass the former.
+  """
+  memcache.delete_multi([_idempotency_key(job['itemId'], payload)
+                         for job in jobs for payload in job['payloads']])
+
+
+def coalesce_key(job):
+  """Return the key under which job is coalesced, None if it isn't."""
+  if not job.get('coalesce'):
+    return None
+  return '%s-%s' % (hashlib.md5(job['userToken']).hexdigest(),
+                    '-'.join(job['payloads']))
+
+
+def _lease_key(user_token):
+  """Return the memcache key of the lease on a user's notifications."""
+  return 'notification-lease#' + user_token
+
+
+def _sequence_key(user_token):
+  """Return the memcache key counting the jobs queued for a user."""
+  return 'notification-seq#' + user_token
+
+
+def _next_key(user_token):
+  """Return the memcache key of the sequence number of the next job to run."""
+  return 'notification-next#' + user_token
+
+
+def _number(job):
+  """Give job the next sequence number of its user and its dispatch time.
+
+  Coalesced jobs, which may be dropped, aren't numbered since others would
+  then wait for them. Neither are jobs when memcache is unavailable.
+  """
+  if job.get('coalesce'):
+    return
+  user_token = job['userToken']
+  seq = memcache.incr(_sequence_key(user_token), initial_value=0)
+  if seq is None:
+    return
+  if seq == 1:
+    memcache.add(_next_key(user_token), 1)
+  job['seq'] = seq
+  job['dispatched'] = time.time()
+
+
+def _extend_lease(key, lease, stop):
+  """Keep the lease under key alive until stop is set.
+
+  The lease is only extended with a compare-and-set, so that a lease that
+  expired and was taken by another job is never overwritten.
+  """
+  client = memcache.Client()
+  while not stop.wait(LEASE_SECONDS / 3.0):
+    if (client.gets(key) != lease or
+        not client.cas(key, lease, time=LEASE_SECONDS)):
+      logging.warning('Lost the lease %s', key)
+      return
+
+
+def _acquire_lease(key, lease):
+  """Take the lease under key, return whether it was free."""
+  if memcache.add(key, lease, time=LEASE_SECONDS):
+    return True
+  client = memcache.Client()
+  return (client.gets(key) == _RELEASED and
+          client.cas(key, lease, time=LEASE_SECONDS))
+
+
+def _release_lease(key, lease):
+  """Give up the lease under key, unless another job took it meanwhile.
+
+  Deletes can't be conditional, so the lease is replaced by _RELEASED with a
+  compare-and-set instead.
+  """
+  client = memcache.Client()
+  if client.gets(key) == lease:
+    client.cas(key, _RELEASED, time=LEASE_SECONDS)
+
+
+def run_job(job, processor):
+  """Run processor on job while holding the lease of its user.
+
+  A numbered job only runs once the jobs of its user numbered before it ran,
+  or once it waited ORDER_WAIT_SECONDS for them. The lease is extended while
+  processor runs, so that it doesn't expire under a long job.
+
+  Args:
+    job: dict, job returned by make_job.
+    processor: callable taking the job.
+  Raises:
+    UserBusyError: another job of the same user holds the lease or must run
+      first.
+  """
+  user_token = job['userToken']
+  seq = job.get('seq')
+  if seq is not None:
+    expected = memcache.get(_next_key(user_token))
+    if (expected is not None and seq > expected and
+        time.time() < job['dispatched'] + ORDER_WAIT_SECONDS):
+      raise UserBusyError(user_token)
+  key = _lease_key(user_token)
+  lease = os.urandom(8).encode('hex')
+  if not _acquire_lease(key, lease):
+    raise UserBusyError(user_token)
+  stop = threading.Event()
+  heartbeat = threading.Thread(target=_extend_lease, args=(key, lease, stop))
+  heartbeat.daemon = True
+  heartbeat.start()
+  try:
+    processor(job)
+    if seq is not None:
+      expected = memcache.get(_next_key(user_token))
+      if expected is None or seq >= expected:
+        memcache.set(_next_key(user_token), seq + 1)
+  finally:
+    stop.set()
+    heartbeat.join()
+    _release_lease(key, lease)
+
+
+class TaskQueueDispatcher(object):
+  """Dispatches jobs to the App Engine task queue.
+
+  The tasks are posted to WORKER_URL, which retries them as configured in
+  queue.yaml. Jobs are numbered per user so that the worker runs them in
+  order. Coalesced jobs are added as named tasks that run at the end of their
+  window, a job finding its task already added is dropped.
+  """
+
+  def __init__(self, queue_name=NOTIFICATION_QUEUE, url=WORKER_URL):
+    """Create a new TaskQueueDispatcher.
+
+    Args:
+      queue_name: string, name of the queue the tasks are added to.
+      url: string, URL of the worker handling the tasks.
+    """
+    self._queue_name = queue_name
+    self._url = url
+
+  def dispatch(self, job):
+    """Add a task running job."""
+    _number(job)
+    name = None
+    countdown = None
+    key = coalesce_key(job)
+    if key is not None:
+      now = time.time()
+      window = int(now // COALESCE_SECONDS)
+      name = 'coalesce-%s-%d' % (key, window)
+      countdown = (window + 1) * COALESCE_SECONDS - now
+    try:
+      taskqueue.add(queue_name=self._queue_name, url=self._url,
+                    payload=json.dumps(job), name=name, countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.info('Coalesced job %s', name)
+
+  def postpone(self, job, countdown=BUSY_COUNTDOWN_SECONDS):
+    """Add a new task running job after countdown seconds.
+
+    Used for jobs whose user is busy, which would otherwise use up the retries
+    of their task while waiting.
+    """
+    taskqueue.add(queue_name=self._queue_name, url=self._url,
+                  payload=json.dumps(job), countdown=countdown)
+
+
+class LocalDispatcher(object):
+  """Runs jobs on threads of the instance in place of the task queue.
+
+  Meant for tests and the development server. The jobs of a user always run
+  on the same thread, in the order they were dispatched. Coalesced jobs wait
+  COALESCE_SECONDS before being queued, and are dropped while another job
+  with the same key is waiting.
+  """
+
+  def __init__(self, processor, workers=4, max_attempts=MAX_ATTEMPTS,
+               backoff=0.1):
+    """Create a new LocalDispatcher and start its threads.
+
+    Args:
+      processor: callable taking a job, raising an exception to be retried.
+      workers: Number of threads running jobs.
+      max_attempts: Number of times a job is run before giving up on it.
+      backoff: Seconds waited before the first retry, doubled on each retry.
+    """
+    self._processor = processor
+    self._max_attempts = max_attempts
+    self._backoff = backoff
+    self._queues = []
+    self._pending = set()
+    self._pending_lock = threading.Lock()
+    for _ in xrange(workers):
+      queue = Queue.Queue()
+      thread = threading.Thread(target=self._work, args=(queue,))
+      thread.daemon = True
+      thread.start()
+      self._queues.append(queue)
+
+  def dispatch(self, job):
+    """Queue job on the thread of its user."""
+    key = coalesce_key(job)
+    if key is None:
+      self._queue(job)
+      return
+    with self._pending_lock:
+      if key in self._pending:
+        logging.info('Coalesced job %s', key)
+        return
+      self._pending.add(key)
+    timer = threading.Timer(COALESCE_SECONDS, self._queue, (job,))
+    timer.daemon = True
+    timer.start()
+
+  def join(self):
+    """Wait until every queued job ran, coalesced ones may still be waiting."""
+    for queue in self._queues:
+      queue.join()
+
+  def _queue(self, job):
+    """Put job on the queue of the thread of its user."""
+    key = coalesce_key(job)
+    if key is not None:
+      # Jobs dispatched from now on are run after this one.
+      with self._pending_lock:
+        self._pending.discard(key)
+    index = hash(job['userToken']) % len(self._queues)
+    self._queues[index].put(job)
+
+  def _work(self, queue):
+    """Run the jobs put in queue, forever."""
+    while True:
+      job = queue.get()
+      try:
+        self._run(job)
+      finally:
+        queue.task_done()
+
+  def _run(self, job):
+    """Run a job, retrying it with exponential backoff when it fails."""
+    for attempt in xrange(self._max_attempts):
+      try:
+        self._processor(job)
+        return
+      except Exception:
+        logging.exception('Attempt %d at notification job failed', attempt + 1)
+        time.sleep(self._backoff * 2 ** attempt)
+    logging.error('Giving up on notification job %s', job)
@@ -21,11 +21,9 @@ import logging
 import webapp2
 from urlparse import urlparse
 
-from oauth2client.appengine import StorageByKeyName
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
 
-from model import Credentials
 import util
 
 
@@ -82,13 +80,13 @@ class OAuthCodeExchangeHandler(OAuthBaseRequestHandler):
 
     users_service = util.create_service('oauth2', 'v2', creds)
     # TODO: Check for errors.
-    user = users_service.userinfo().get().execute()
+    user = users_service.userinfo().get(fields='id').execute()
 
     userid = user.get('id')
 
     # Store the credentials in the data store using the userid as the key.
     # TODO: Hash the userid the same way the userToken is.
-    StorageByKeyName(Credentials, userid, 'credentials').put(creds)
+    util.credentials_storage(userid).put(creds)
     logging.info('Successfully stored credentials for user: %s', userid)
     util.store_userid(self, userid)
 
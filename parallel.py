@@ -0,0 +1,120 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Running independent API calls at the same time.
+
+Each call submitted runs on a thread of its own, up to MAX_THREADS at a time
+for the instance, and returns a Future, whose result() waits for the call and
+returns its value or raises its exception:
+
+  cleared = parallel.submit(clear_timeline, mirror_service)
+  profile = feedly.getProfile(token)
+  existing_cards = cleared.result()
+
+Http instances taking their connections from a httplib2.ConnectionPool, such
+as the ones of util.create_http, can be used by several calls at once.
+"""
+
+
+import sys
+import threading
+
+
+# Maximum number of calls running on threads of their own at the same time.
+# Calls submitted beyond it run in the calling thread instead.
+MAX_THREADS = 10
+
+_thread_slots = threading.BoundedSemaphore(MAX_THREADS)
+
+
+class Future(object):
+  """Result of a call running on another thread."""
+
+  def __init__(self):
+    """Initialize a new Future object, whose call has not completed."""
+    self._done = threading.Event()
+    self._value = None
+    self._exc_info = None
+
+  def _run(self, fn, args, kwargs):
+    """Run the call and record its outcome."""
+    try:
+      self._value = fn(*args, **kwargs)
+    except:
+      self._exc_info = sys.exc_info()
+    finally:
+      self._done.set()
+
+  def done(self):
+    """Return whether the call has completed."""
+    return self._done.is_set()
+
+  def result(self):
+    """Wait for the call to complete and return its value.
+
+    Raises:
+      The exception raised by the call, with its original traceback.
+    """
+    self._done.wait()
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._value
+
+
+def _run_in_slot(future, fn, args, kwargs):
+  """Run the call of future on a thread holding one of the slots."""
+  try:
+    future._run(fn, args, kwargs)
+  finally:
+    _thread_slots.release()
+
+
+def submit(fn, *args, **kwargs):
+  """Start calling fn(*args, **kwargs) on a new thread.
+
+  When MAX_THREADS calls are already running, fn is called right away in the
+  calling thread instead.
+
+  Returns:
+    Future of the call.
+  """
+  future = Future()
+  if not _thread_slots.acquire(False):
+    future._run(fn, args, kwargs)
+    return future
+  thread = threading.Thread(target=_run_in_slot,
+                            args=(future, fn, args, kwargs))
+  thread.daemon = True
+  thread.start()
+  return future
+
+
+def wait(futures):
+  """Wait for every call of futures to complete, ignoring their outcome.
+
+  Meant for finally clauses, so that no call outlives the code that started
+  it, and what it uses, when that code fails.
+  """
+  for future in futures:
+    future._done.wait()
+
+
+def wait_all(futures):
+  """Wait for every call of futures to complete and return their values.
+
+  All the calls are waited for even when some of them fail, the first
+  exception is then raised.
+  """
+  wait(futures)
+  return [future.result() for future in futures]
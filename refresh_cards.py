@@ -0,0 +1,133 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Registry of the refresh card IDs that can still trigger a refresh."""
+
+
+import datetime
+import uuid
+
+from google.appengine.ext import db
+
+from model import RefreshCards
+import migrations
+
+
+# How long a refresh card can trigger a refresh after it was sent.
+REFRESH_CARD_TTL = datetime.timedelta(days=7)
+
+# Number of expired entities deleted at a time by purge_expired.
+PURGE_BATCH_SIZE = 500
+
+# Name of the migration keying the refresh card IDs by ID. Cards registered
+# before that have no expiry; purge_expired gives them REFRESH_CARD_TTL from
+# its first run, then deletes them and finishes the migration.
+MIGRATION = 'refresh_cards_by_key_name'
+
+
+def new_refresh_id(feedly_user_id):
+  """Return a new, unique refresh card ID for a Feedly user."""
+  return feedly_user_id + '#REFRESH#' + uuid.uuid4().hex
+
+
+def register(refresh_id):
+  """Allow refresh_id to trigger one refresh until REFRESH_CARD_TTL elapses."""
+  RefreshCards(
+      key_name=refresh_id,
+      id=refresh_id,
+      expires=datetime.datetime.utcnow() + REFRESH_CARD_TTL).put()
+
+
+def discard(refresh_id):
+  """Forget refresh_id without looking it up."""
+  db.delete(db.Key.from_path(RefreshCards.kind(), refresh_id))
+
+
+def consume(refresh_id):
+  """Atomically check that refresh_id is registered and forget it.
+
+  Args:
+    refresh_id: string, ID of the refresh card that was selected.
+  Returns:
+    True if refresh_id was registered and had not expired, in which case no
+    other call will return True for it.
+  """
+  def txn():
+    card = RefreshCards.get_by_key_name(refresh_id)
+    if card is None:
+      return None
+    card.delete()
+    return card.expires
+
+  expires = db.run_in_transaction(txn)
+  if expires is None:
+    if migrations.is_finished(MIGRATION):
+      return False
+    # Cards registered before they were keyed by ID last until the migration
+    # is finished.
+    legacy = RefreshCards.all().filter('id =', refresh_id).get()
+    if legacy is None or legacy.key().name() is not None:
+      return False
+    legacy.delete()
+    return True
+  return datetime.datetime.utcnow() < expires
+
+
+def purge_expired():
+  """Delete the expired refresh card IDs.
+
+  Returns:
+    Number of IDs deleted.
+  """
+  purged = 0
+  now = datetime.datetime.utcnow()
+  while True:
+    keys = RefreshCards.all(keys_only=True).filter(
+        'expires <', now).fetch(PURGE_BATCH_SIZE)
+    if not keys:
+      break
+    db.delete(keys)
+    purged += len(keys)
+  return purged + _purge_legacy(now)
+
+
+def _purge_legacy(now):
+  """Delete the refresh card IDs registered before they were keyed by ID.
+
+  They are only deleted, and MIGRATION finished, once REFRESH_CARD_TTL has
+  elapsed since the first purge.
+
+  Args:
+    now: datetime.datetime, the current time in UTC.
+  Returns:
+    Number of IDs deleted.
+  """
+  if migrations.is_finished(MIGRATION):
+    return 0
+  if now < migrations.start(MIGRATION) + REFRESH_CARD_TTL:
+    return 0
+  purged = 0
+  legacy = []
+  for key in RefreshCards.all(keys_only=True).run(batch_size=PURGE_BATCH_SIZE):
+    if key.name() is None:
+      legacy.append(key)
+    if len(legacy) >= PURGE_BATCH_SIZE:
+      db.delete(legacy)
+      purged += len(legacy)
+      legacy = []
+  if legacy:
+    db.delete(legacy)
+    purged += len(legacy)
+  migrations.mark_finished(MIGRATION)
+  return purged
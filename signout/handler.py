@@ -21,7 +21,6 @@ import webapp2
 
 from google.appengine.api import urlfetch
 
-from model import Credentials
 import util
 
 
@@ -36,9 +35,7 @@ class SignoutHandler(webapp2.RequestHandler):
     """Delete the user's credentials from the datastore."""
     urlfetch.fetch(OAUTH2_REVOKE_ENDPOINT % self.credentials.refresh_token)
     util.store_userid(self, '')
-    credentials_entity = Credentials.get_by_key_name(self.userid)
-    if credentials_entity:
-      credentials_entity.delete()
+    util.credentials_storage(self.userid).delete()
     self.redirect('/')
 
 
@@ -0,0 +1,112 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""State of the users' subscriptions to their Mirror timeline.
+
+Whether a user is subscribed is recorded on their FeedlyUser entity, so that
+refreshes only ask Mirror when the record is missing or older than
+SUBSCRIPTION_TTL. A cron task reconciles the records with Mirror in bulk.
+"""
+
+
+import datetime
+import logging
+
+from apiclient.http import BatchHttpRequest
+from google.appengine.ext import db
+
+import util
+
+
+CALLBACK_URL = 'https://feedly-glass.appspot.com/subscriptions'
+
+# Fields of subscriptions.list responses has_timeline_subscription looks at.
+LIST_FIELDS = 'items(collection,callbackUrl,userToken)'
+
+# How long a verified subscription is trusted without asking Mirror again.
+SUBSCRIPTION_TTL = datetime.timedelta(days=1)
+
+
+def has_timeline_subscription(subscriptions, user_token):
+  """Return whether a subscriptions.list response covers the user's timeline.
+
+  Args:
+    subscriptions: dict, response of mirror_service.subscriptions().list().
+    user_token: string, userToken the subscription was made with.
+  """
+  for subscription in subscriptions.get('items', []):
+    if subscription.get('collection') == 'timeline':
+      if (subscription.get('callbackUrl') == CALLBACK_URL or
+          subscription.get('userToken') == user_token):
+        return True
+  return False
+
+
+def is_verified(user):
+  """Return whether user was found subscribed within SUBSCRIPTION_TTL."""
+  verified = user.subscription_verified
+  return (verified is not None and
+          datetime.datetime.utcnow() - verified < SUBSCRIPTION_TTL)
+
+
+def record(user, subscribed):
+  """Record whether user was found subscribed, without storing it."""
+  if subscribed:
+    user.subscription_verified = datetime.datetime.utcnow()
+  else:
+    user.subscription_verified = None
+
+
+def reconcile(users):
+  """Check the subscriptions of users against Mirror and store the results.
+
+  The subscriptions of all the users are listed in a single batch request,
+  each authorized with the credentials of its user. Users whose credentials
+  are gone are left alone.
+
+  Args:
+    users: list of FeedlyUser entities.
+  Returns:
+    Number of users found not to be subscribed.
+  """
+  results = {}
+
+  def callback(request_id, response, exception):
+    if exception is not None:
+      logging.warning('Unable to list subscriptions of user %s: %s',
+                      request_id, exception)
+    else:
+      results[request_id] = has_timeline_subscription(response, request_id)
+
+  batch = BatchHttpRequest(callback)
+  checked = []
+  for user in users:
+    credentials = util.credentials_storage(user.id).get()
+    if credentials is None or credentials.invalid:
+      continue
+    mirror_service = util.create_service('mirror', 'v1', credentials)
+    batch.add(mirror_service.subscriptions().list(fields=LIST_FIELDS),
+              request_id=user.id)
+    checked.append(user)
+  if not checked:
+    return 0
+  batch.execute(util.SHARED_HTTP)
+
+  changed = []
+  for user in checked:
+    if user.id in results:
+      record(user, results[user.id])
+      changed.append(user)
+  db.put(changed)
+  return len([user for user in changed if user.subscription_verified is None])
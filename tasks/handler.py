@@ -0,0 +1,248 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request Handlers for the background tasks run by cron."""
+
+
+import datetime
+import logging
+import Queue
+import threading
+import webapp2
+
+from oauth2client.client import AccessTokenRefreshError
+
+from model import Credentials, FeedlyUser
+import feedly_users
+import migrations
+import refresh_cards
+import subscriptions
+import util
+
+
+# Tokens expiring within this window are refreshed by the scheduler. It must be
+# longer than the interval between two runs in cron.yaml plus the refresh skew
+# of util.auth_required, so that request handlers never have to refresh.
+REFRESH_WINDOW = datetime.timedelta(minutes=20)
+
+# Number of entities loaded from the datastore at a time.
+BATCH_SIZE = 50
+
+# Maximum number of token refreshes in flight at the same time.
+MAX_CONCURRENT_REFRESHES = 5
+
+
+def _run_bounded(jobs, max_workers=MAX_CONCURRENT_REFRESHES):
+  """Run callables on at most max_workers threads and wait for all of them.
+
+  Args:
+    jobs: list of callables taking no arguments.
+    max_workers: Maximum number of jobs running at the same time.
+  Returns:
+    Number of jobs that returned a true value.
+  """
+  queue = Queue.Queue()
+  for job in jobs:
+    queue.put(job)
+  results = []
+
+  def worker():
+    while True:
+      try:
+        job = queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results.append(bool(job()))
+      except Exception:
+        logging.exception('Background token refresh failed')
+
+  threads = [threading.Thread(target=worker)
+             for _ in xrange(min(max_workers, len(jobs)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sum(results)
+
+
+def _iter_batches(query):
+  """Yield the entities matched by query, BATCH_SIZE at a time."""
+  cursor = None
+  while True:
+    if cursor:
+      query.with_cursor(cursor)
+    entities = query.fetch(BATCH_SIZE)
+    if not entities:
+      return
+    yield entities
+    if len(entities) < BATCH_SIZE:
+      return
+    cursor = query.cursor()
+
+
+def _refresh_credentials_job(key_name, credentials):
+  """Return a job refreshing the Google credentials stored under key_name."""
+  def job():
+    credentials.set_store(util.credentials_storage(key_name))
+    try:
+      credentials.refresh(util.SHARED_HTTP)
+    except AccessTokenRefreshError:
+      # Access has been revoked, util.auth_required cleans up on next visit.
+      logging.info('Unable to refresh credentials of user %s', key_name)
+      return False
+    return True
+  return job
+
+
+def _refresh_feedly_job(user):
+  """Return a job refreshing the Feedly token of user."""
+  def job():
+    if util.refresh_feedly_token(user) is None:
+      logging.info('Unable to refresh Feedly token of user %s', user.id)
+      return False
+    return True
+  return job
+
+
+def _active_since():
+  """Return the last_seen after which a user counts as active."""
+  return datetime.datetime.utcnow() - feedly_users.ACTIVE_PERIOD
+
+
+def refresh_expiring_credentials(window=REFRESH_WINDOW):
+  """Refresh the Google credentials of active users expiring within window.
+
+  Credentials are pickled in the datastore and cannot be filtered on their
+  expiry, so the credentials of every user seen within
+  feedly_users.ACTIVE_PERIOD are loaded and checked. The others are
+  refreshed by util.auth_required when the user comes back.
+
+  Returns:
+    Number of credentials refreshed.
+  """
+  query = FeedlyUser.all(keys_only=True).filter('last_seen >', _active_since())
+  refreshed = 0
+  for keys in _iter_batches(query):
+    jobs = []
+    key_names = [key.name() for key in keys if key.name() is not None]
+    for entity in Credentials.get_by_key_name(key_names):
+      if entity is None:
+        continue
+      credentials = entity.credentials
+      if (credentials is None or credentials.invalid or
+          not credentials.refresh_token):
+        continue
+      if util.credentials_need_refresh(credentials, skew=window):
+        jobs.append(_refresh_credentials_job(entity.key().name(), credentials))
+    refreshed += _run_bounded(jobs)
+  return refreshed
+
+
+def refresh_expiring_feedly_tokens(window=REFRESH_WINDOW):
+  """Refresh the stored Feedly tokens of active users expiring within window.
+
+  Returns:
+    Number of tokens refreshed.
+  """
+  deadline = datetime.datetime.utcnow() + window
+  since = _active_since()
+  query = FeedlyUser.all().filter('feedly_token_expiry <', deadline)
+  refreshed = 0
+  for users in _iter_batches(query):
+    # The datastore allows a single inequality filter per query.
+    refreshed += _run_bounded(
+        [_refresh_feedly_job(user) for user in users
+         if user.feedly_refresh_token and user.last_seen is not None and
+         user.last_seen > since])
+  return refreshed
+
+
+def migrate_feedly_users():
+  """Key every FeedlyUser still stored under an automatic ID by user ID.
+
+  Once they all are, requests stop looking for legacy entities.
+
+  Returns:
+    Number of entities migrated.
+  """
+  migrated = 0
+  for users in _iter_batches(FeedlyUser.all()):
+    for user in users:
+      if user.key().name() is None and user.id:
+        feedly_users.migrate_legacy_user(user)
+        migrated += 1
+  migrations.mark_finished(feedly_users.MIGRATION)
+  return migrated
+
+
+def reconcile_subscriptions():
+  """Check the recorded subscriptions of every user against Mirror.
+
+  Returns:
+    Number of users found not to be subscribed.
+  """
+  unsubscribed = 0
+  for users in _iter_batches(FeedlyUser.all()):
+    unsubscribed += subscriptions.reconcile(
+        [user for user in users if user.key().name() is not None])
+  return unsubscribed
+
+
+class RefreshTokensHandler(webapp2.RequestHandler):
+  """Request Handler refreshing access tokens before they expire."""
+
+  def get(self):
+    """Refresh every Google and Feedly token about to expire."""
+    google_count = refresh_expiring_credentials()
+    feedly_count = refresh_expiring_feedly_tokens()
+    logging.info('Refreshed %d Google and %d Feedly tokens',
+                 google_count, feedly_count)
+
+
+class MigrateFeedlyUsersHandler(webapp2.RequestHandler):
+  """Request Handler migrating the FeedlyUser entities in one go.
+
+  Entities are also migrated one at a time as users come back, until this
+  has run to completion once.
+  """
+
+  def get(self):
+    """Migrate every legacy FeedlyUser entity."""
+    logging.info('Migrated %d FeedlyUser entities', migrate_feedly_users())
+
+
+class PurgeRefreshCardsHandler(webapp2.RequestHandler):
+  """Request Handler deleting the expired refresh card IDs."""
+
+  def get(self):
+    """Delete every expired refresh card ID."""
+    logging.info('Purged %d refresh card IDs', refresh_cards.purge_expired())
+
+
+class ReconcileSubscriptionsHandler(webapp2.RequestHandler):
+  """Request Handler checking the recorded subscriptions against Mirror."""
+
+  def get(self):
+    """Check the recorded subscription of every user."""
+    logging.info('Found %d users without subscription',
+                 reconcile_subscriptions())
+
+
+TASKS_ROUTES = [
+    ('/tasks/refresh_tokens', RefreshTokensHandler),
+    ('/tasks/migrate_feedly_users', MigrateFeedlyUsersHandler),
+    ('/tasks/purge_refresh_cards', PurgeRefreshCardsHandler),
+    ('/tasks/reconcile_subscriptions', ReconcileSubscriptionsHandler)
+]
@@ -0,0 +1,427 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the Resource classes generated by apiclient.discovery.
+
+Run from the root of the repository with:
+
+  python -m unittest discover -s tests
+"""
+
+
+import os
+import marshal
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from apiclient import discovery
+from apiclient.discovery import DiscoveryBundle
+from apiclient.discovery import build
+from apiclient.discovery import build_from_document
+from apiclient.http import HttpMock
+from apiclient.http import HttpMockSequence
+from apiclient.schema import Schemas
+from oauth2client.anyjson import simplejson
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def datafile(filename):
+  return os.path.join(DATA_DIR, filename)
+
+
+def read_datafile(filename):
+  f = open(datafile(filename), 'r')
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+
+def build_mirror():
+  """Build the Mirror API service from the fixture discovery document."""
+  return build_from_document(read_datafile('mirror.json'),
+                             http=HttpMock(None, {'status': '200'}))
+
+
+def parse_uri(uri):
+  """Split a URI into its path and a dict of its query parameters."""
+  parsed = urlparse.urlparse(uri)
+  return parsed.path, dict(urlparse.parse_qsl(parsed.query))
+
+
+class ResourceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.mirror = build_mirror()
+
+  def test_method_uris(self):
+    request = self.mirror.timeline().get(id='card 1')
+    self.assertEqual('GET', request.method)
+    self.assertEqual(
+        'https://www.googleapis.com/mirror/v1/timeline/card%201?alt=json',
+        request.uri)
+
+    request = self.mirror.timeline().delete(id='card1')
+    self.assertEqual('DELETE', request.method)
+    path, query = parse_uri(request.uri)
+    self.assertEqual('/mirror/v1/timeline/card1', path)
+
+    request = self.mirror.timeline().list(maxResults=5, sourceItemId='a&b')
+    path, query = parse_uri(request.uri)
+    self.assertEqual('/mirror/v1/timeline', path)
+    self.assertEqual({'alt': 'json', 'maxResults': '5', 'sourceItemId': 'a&b'},
+                     query)
+
+  def test_nested_resource_uris(self):
+    request = self.mirror.timeline().attachments().get(itemId='card1',
+                                                       attachmentId='a1')
+    path, query = parse_uri(request.uri)
+    self.assertEqual('/mirror/v1/timeline/card1/attachments/a1', path)
+
+  def test_unexpected_argument(self):
+    try:
+      self.mirror.timeline().get(id='card1', colour='red')
+      self.fail('TypeError expected')
+    except TypeError, e:
+      self.assertEqual('Got an unexpected keyword argument "colour"', str(e))
+
+  def test_missing_required_argument(self):
+    try:
+      self.mirror.timeline().attachments().get(itemId='card1')
+      self.fail('TypeError expected')
+    except TypeError, e:
+      self.assertEqual('Missing required parameter "attachmentId"', str(e))
+
+  def test_none_arguments_are_dropped(self):
+    request = self.mirror.timeline().list(pageToken=None, maxResults=None)
+    path, query = parse_uri(request.uri)
+    self.assertEqual({'alt': 'json'}, query)
+
+  def test_list_next(self):
+    timeline = self.mirror.timeline()
+    request = timeline.list(maxResults=5)
+
+    next_request = timeline.list_next(request, {'nextPageToken': 'page2'})
+    path, query = parse_uri(next_request.uri)
+    self.assertEqual('/mirror/v1/timeline', path)
+    self.assertEqual({'alt': 'json', 'maxResults': '5', 'pageToken': 'page2'},
+                     query)
+    # The request passed in is left alone.
+    self.assertEqual({'alt': 'json', 'maxResults': '5'},
+                     parse_uri(request.uri)[1])
+
+    last_request = timeline.list_next(next_request, {'nextPageToken': 'page3'})
+    self.assertEqual('page3', parse_uri(last_request.uri)[1]['pageToken'])
+
+    self.assertEqual(None, timeline.list_next(last_request, {'items': []}))
+
+  def test_next_only_for_methods_with_page_token(self):
+    self.assertTrue(hasattr(self.mirror.timeline(), 'list_next'))
+    self.assertFalse(hasattr(self.mirror.subscriptions(), 'list_next'))
+
+  def test_services_share_generated_classes(self):
+    other = build_mirror()
+    self.assertTrue(type(self.mirror) is type(other))
+    self.assertTrue(type(self.mirror.timeline()) is type(other.timeline()))
+    self.assertTrue(type(self.mirror.timeline().attachments()) is
+                    type(other.timeline().attachments()))
+    self.assertFalse(type(self.mirror.timeline()) is
+                     type(self.mirror.subscriptions()))
+
+  def test_resources_have_no_instance_dict(self):
+    self.assertFalse(hasattr(self.mirror, '__dict__'))
+    self.assertFalse(hasattr(self.mirror.timeline(), '__dict__'))
+
+  def test_pickle_round_trip(self):
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+      mirror = pickle.loads(pickle.dumps(self.mirror, protocol))
+      self.assertTrue(type(mirror) is type(self.mirror))
+      self.assertEqual(self.mirror.timeline().get(id='card1').uri,
+                       mirror.timeline().get(id='card1').uri)
+
+  def test_pickle_round_trip_nested_resource(self):
+    attachments = self.mirror.timeline().attachments()
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+      unpickled = pickle.loads(pickle.dumps(attachments, protocol))
+      self.assertTrue(type(unpickled) is type(attachments))
+      self.assertEqual(
+          '/mirror/v1/timeline/card1/attachments',
+          parse_uri(unpickled.list(itemId='card1').uri)[0])
+      self.assertEqual(None, getattr(unpickled, 'list_next', None))
+
+  def test_unpickle_without_cached_templates(self):
+    # As in a process that has not built the service yet.
+    pickled = pickle.dumps(self.mirror.timeline().attachments())
+    discovery._service_templates.clear()
+    attachments = pickle.loads(pickled)
+    self.assertEqual(
+        '/mirror/v1/timeline/card1/attachments/a1',
+        parse_uri(attachments.get(itemId='card1', attachmentId='a1').uri)[0])
+
+
+class FieldMaskTest(unittest.TestCase):
+
+  def setUp(self):
+    self.mirror = build_mirror()
+    self.schemas = Schemas(simplejson.loads(
+        read_datafile('mirror.json')))
+
+  def test_valid_masks(self):
+    response = {'$ref': 'TimelineListResponse'}
+    for fields in ['nextPageToken',
+                   'items(id,title)',
+                   'nextPageToken,items(id,displayTime,isDeleted)',
+                   'items/notification/level',
+                   'items(attachments(id,contentType))',
+                   'items/*',
+                   'items(notification)']:
+      self.schemas.validate_fields(response, fields)
+
+  def test_unknown_field(self):
+    try:
+      self.schemas.validate_fields({'$ref': 'TimelineListResponse'},
+                                   'items(id,colour)')
+      self.fail('ValueError expected')
+    except ValueError, e:
+      self.assertEqual(
+          'Field mask "items(id,colour)" selects unknown field "colour"',
+          str(e))
+
+  def test_malformed_masks(self):
+    for fields in ['', 'items(id', 'items)', 'items//id', 'items(id))',
+                   ',items', 'items/']:
+      self.assertRaises(ValueError, self.schemas.validate_fields,
+                        {'$ref': 'TimelineListResponse'}, fields)
+
+  def test_method_fields(self):
+    request = self.mirror.timeline().list(
+        fields='nextPageToken,items(id,isDeleted)')
+    self.assertEqual('nextPageToken,items(id,isDeleted)',
+                     parse_uri(request.uri)[1]['fields'])
+
+  def test_method_fields_list(self):
+    request = self.mirror.timeline().list(
+        fields=['nextPageToken', 'items(id,isDeleted)'])
+    self.assertEqual('nextPageToken,items(id,isDeleted)',
+                     parse_uri(request.uri)[1]['fields'])
+
+  def test_method_invalid_fields(self):
+    try:
+      self.mirror.timeline().get(id='card1', fields='id,colour')
+      self.fail('TypeError expected')
+    except TypeError, e:
+      self.assertEqual(
+          'Parameter "fields" is invalid: '
+          'Field mask "id,colour" selects unknown field "colour"', str(e))
+
+  def test_method_without_response_accepts_any_fields(self):
+    request = self.mirror.timeline().delete(id='card1', fields='colour')
+    self.assertEqual('colour', parse_uri(request.uri)[1]['fields'])
+
+
+MIRROR_URI = 'https://www.googleapis.com/discovery/v1/apis/mirror/v1/rest'
+
+
+def mirror_bundle(created):
+  """Return a DiscoveryBundle holding the fixture Mirror API document."""
+  content = read_datafile('mirror.json')
+  entry = discovery._DiscoveryCacheEntry(simplejson.loads(content), content,
+                                         '"etag"', created)
+  return DiscoveryBundle({MIRROR_URI: entry}, created)
+
+
+class DiscoveryBundleTest(unittest.TestCase):
+
+  def setUp(self):
+    discovery._discovery_cache.clear()
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'discovery.bundle')
+
+  def tearDown(self):
+    discovery._discovery_cache.clear()
+    shutil.rmtree(self.tempdir)
+
+  def write(self, data):
+    f = open(self.path, 'wb')
+    try:
+      marshal.dump(data, f)
+    finally:
+      f.close()
+
+  def test_save_and_load(self):
+    created = time.time()
+    mirror_bundle(created).save(self.path)
+    bundle = DiscoveryBundle.load(self.path)
+    self.assertEqual(created, bundle.created)
+    self.assertEqual([MIRROR_URI], bundle.entries.keys())
+    entry = bundle.get(MIRROR_URI)
+    self.assertEqual('mirror:v1', entry.service['id'])
+    self.assertEqual(read_datafile('mirror.json'), entry.content)
+    self.assertEqual('"etag"', entry.etag)
+    self.assertEqual(None, bundle.get(MIRROR_URI + '?other'))
+
+  def test_load_missing_file(self):
+    self.assertEqual(None, DiscoveryBundle.load(self.path))
+
+  def test_load_unreadable_file(self):
+    f = open(self.path, 'wb')
+    f.write('not a bundle')
+    f.close()
+    self.assertEqual(None, DiscoveryBundle.load(self.path))
+
+  def test_load_other_format(self):
+    self.write({'format': discovery.BUNDLE_FORMAT_VERSION + 1,
+                'marshal': marshal.version, 'created': time.time(),
+                'documents': {}})
+    self.assertEqual(None, DiscoveryBundle.load(self.path))
+    self.write(['not', 'a', 'dict'])
+    self.assertEqual(None, DiscoveryBundle.load(self.path))
+
+  def test_stale(self):
+    self.assertFalse(mirror_bundle(time.time()).is_stale())
+    bundle = mirror_bundle(time.time() - discovery.BUNDLE_MAX_AGE - 1)
+    self.assertTrue(bundle.is_stale())
+
+    warnings = []
+    warning = discovery.logger.warning
+    discovery.logger.warning = lambda *args: warnings.append(args)
+    try:
+      self.assertEqual(None, bundle.get(MIRROR_URI))
+      self.assertEqual(None, bundle.get(MIRROR_URI))
+    finally:
+      discovery.logger.warning = warning
+    # Logged once per bundle.
+    self.assertEqual(1, len(warnings))
+
+  def test_build_from_bundle_without_network(self):
+    mirror_bundle(time.time()).save(self.path)
+    bundle = DiscoveryBundle.load(self.path)
+    # Any request fails, the sequence is empty.
+    http = HttpMockSequence([])
+    mirror = build('mirror', 'v1', http=http, bundle=bundle)
+    self.assertEqual('/mirror/v1/timeline/card1',
+                     parse_uri(mirror.timeline().get(id='card1').uri)[0])
+    # Later builds find the document in the process cache.
+    build('mirror', 'v1', http=http)
+
+  def test_build_with_stale_bundle_fetches(self):
+    bundle = mirror_bundle(time.time() - discovery.BUNDLE_MAX_AGE - 1)
+    http = HttpMockSequence([
+        ({'status': '200', 'etag': '"new"'}, read_datafile('mirror.json')),
+        ])
+    mirror = build('mirror', 'v1', http=http, bundle=bundle)
+    self.assertEqual([], http._iterable)
+    self.assertTrue(hasattr(mirror, 'timeline'))
+
+
+class ArgumentPlanTest(unittest.TestCase):
+
+  def setUp(self):
+    self.mirror = build_mirror()
+    self.plan = discovery._ArgumentPlan(discovery.ResourceMethodParameters({
+        'path': 'items/{item-id}',
+        'parameters': {
+            'item-id': {'type': 'string', 'location': 'path',
+                        'required': True, 'pattern': '^[0-9]+$'},
+            'labels': {'type': 'string', 'location': 'query',
+                       'repeated': True, 'enum': ['red', 'blue']},
+            'count': {'type': 'integer', 'location': 'query'},
+            'ratio': {'type': 'number', 'location': 'query'},
+            'strict': {'type': 'boolean', 'location': 'query'},
+            },
+        }))
+
+  def convert(self, **kwargs):
+    self.plan.clean(kwargs)
+    return self.plan.convert(kwargs)
+
+  def test_convert(self):
+    path_params, query_params = self.convert(
+        item_id='42', labels=['red', 'blue'], count='3', ratio=1, strict=0)
+    self.assertEqual({'item-id': '42'}, path_params)
+    self.assertEqual({'labels': ['red', 'blue'], 'count': '3', 'ratio': '1.0',
+                      'strict': 'false'}, query_params)
+
+  def test_none_dropped(self):
+    self.assertEqual(({'item-id': '42'}, {}),
+                     self.convert(item_id='42', count=None, labels=None))
+
+  def test_unexpected_argument(self):
+    self.assertRaises(TypeError, self.convert, item_id='42', colour='red')
+
+  def test_missing_required(self):
+    try:
+      self.convert(count=3)
+      self.fail('TypeError expected')
+    except TypeError, e:
+      self.assertEqual('Missing required parameter "item_id"', str(e))
+
+  def test_pattern(self):
+    try:
+      self.convert(item_id='4a')
+      self.fail('TypeError expected')
+    except TypeError, e:
+      self.assertEqual(
+          'Parameter "item_id" value "4a" does not match the pattern '
+          '"^[0-9]+$"', str(e))
+
+  def test_repeated_enum(self):
+    self.assertEqual({'labels': 'red'},
+                     self.convert(item_id='42', labels='red')[1])
+    try:
+      self.convert(item_id='42', labels=['red', 'green'])
+      self.fail('TypeError expected')
+    except TypeError, e:
+      self.assertEqual(
+          'Parameter "labels" value "green" is not an allowed value in '
+          '"[\'red\', \'blue\']"', str(e))
+
+  def test_bad_integer(self):
+    self.assertRaises(ValueError, self.convert, item_id='42', count='many')
+
+  def test_method_pattern(self):
+    request = self.mirror.timeline().attachments().list(itemId='card-1')
+    self.assertEqual('/mirror/v1/timeline/card-1/attachments',
+                     parse_uri(request.uri)[0])
+    self.assertRaises(TypeError, self.mirror.timeline().attachments().list,
+                      itemId='Card_1')
+
+  def test_method_enum(self):
+    request = self.mirror.timeline().list(orderBy='writeTime')
+    self.assertEqual('writeTime', parse_uri(request.uri)[1]['orderBy'])
+    try:
+      self.mirror.timeline().list(orderBy='title')
+      self.fail('TypeError expected')
+    except TypeError, e:
+      self.assertEqual(
+          'Parameter "orderBy" value "title" is not an allowed value in '
+          '"[u\'displayTime\', u\'writeTime\']"', str(e))
+
+  def test_method_integer(self):
+    request = self.mirror.timeline().list(maxResults='7')
+    self.assertEqual('7', parse_uri(request.uri)[1]['maxResults'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,586 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the batch requests of apiclient.http.
+
+Run from the root of the repository with:
+
+  python -m unittest discover -s tests
+"""
+
+
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import httplib2
+
+from apiclient import http as apiclient_http
+from apiclient.errors import BatchError
+from apiclient.errors import HttpError
+from apiclient.http import BatchHttpRequest
+from apiclient.http import HttpRequest
+from apiclient.model import JsonModel
+
+
+CONTENT_ID = re.compile(r'^Content-ID: <([^>]*)>', re.MULTILINE)
+
+
+def make_request(name, method='GET', body=None, headers=None):
+  """Return a request for the timeline card name of the Mirror API."""
+  return HttpRequest(
+      None, JsonModel().response,
+      'https://www.googleapis.com/mirror/v1/timeline/%s?alt=json' % name,
+      method=method, body=body, headers=headers or {})
+
+
+def batch_response(parts, boundary='batch_boundary'):
+  """Return the body of a batch response, with CRLF line breaks.
+
+  Args:
+    parts: list of (Content-ID, status, body) tuples.
+    boundary: string, the boundary between the parts.
+  """
+  lines = []
+  for content_id, status, body in parts:
+    lines.extend([
+        '--' + boundary,
+        'Content-Type: application/http',
+        'Content-ID: <response-%s>' % content_id,
+        '',
+        'HTTP/1.1 %s Status' % status,
+        'Content-Type: application/json',
+        '',
+        body])
+  lines.append('--%s--' % boundary)
+  return '\r\n'.join(lines)
+
+
+class BatchHttp(object):
+  """Answers batch requests, with a JSON body holding the id of each request.
+
+  Attributes:
+    batches: list of the lists of the ids of the requests in each batch
+      received, in the order they were received.
+    bodies: list of the bodies of the batches received.
+  """
+
+  def __init__(self, statuses=None, delays=None):
+    """Constructor.
+
+    Args:
+      statuses: dict, map from request id to the statuses to answer with in
+        turn, 200 once they run out.
+      delays: list, seconds to wait before answering each batch in turn.
+    """
+    self.statuses = statuses or {}
+    self.delays = delays or []
+    self.batches = []
+    self.bodies = []
+    self._lock = threading.Lock()
+
+  def request(self, uri, method='GET', body=None, headers=None,
+              redirections=1, connection_type=None):
+    content_ids = CONTENT_ID.findall(body)
+    ids = [urllib.unquote(content_id.rsplit('+', 1)[1])
+           for content_id in content_ids]
+    with self._lock:
+      self.batches.append(ids)
+      self.bodies.append(body)
+      delay = self.delays.pop(0) if self.delays else 0
+      parts = []
+      for content_id, request_id in zip(content_ids, ids):
+        statuses = self.statuses.get(request_id)
+        status = statuses.pop(0) if statuses else '200'
+        parts.append((content_id, status, '{"id": "%s"}' % request_id))
+    time.sleep(delay)
+    resp = httplib2.Response({
+        'status': '200',
+        'content-type': 'multipart/mixed; boundary="batch_boundary"'})
+    return resp, batch_response(parts)
+
+
+class Callbacks(object):
+  """Records the calls of a batch callback."""
+
+  def __init__(self):
+    self.calls = []
+
+  def __call__(self, request_id, response, exception):
+    self.calls.append((request_id, response, exception))
+
+
+class SplitTest(unittest.TestCase):
+
+  def test_split_by_count(self):
+    batch = BatchHttpRequest(max_batch_requests=2)
+    order = ['1', '2', '3', '4', '5']
+    serialized = dict((request_id, 'x') for request_id in order)
+    self.assertEqual([['1', '2'], ['3', '4'], ['5']],
+                     batch._split(order, serialized))
+
+  def test_split_by_bytes(self):
+    batch = BatchHttpRequest(max_batch_bytes=1100)
+    order = ['1', '2', '3', '4', '5']
+    serialized = {'1': 'x' * 300, '2': 'x' * 300, '3': 'x' * 2000,
+                  '4': 'x' * 100, '5': 'x' * 100}
+    # The third request is larger than the bound and goes alone.
+    self.assertEqual([['1', '2'], ['3'], ['4', '5']],
+                     batch._split(order, serialized))
+
+  def test_no_split(self):
+    batch = BatchHttpRequest()
+    order = [str(i) for i in range(100)]
+    serialized = dict((request_id, 'x' * 1000) for request_id in order)
+    self.assertEqual([order], batch._split(order, serialized))
+
+
+class ExecuteTest(unittest.TestCase):
+
+  def test_is_empty(self):
+    batch = BatchHttpRequest()
+    self.assertTrue(batch.is_empty())
+    batch.add(make_request('card1'))
+    self.assertFalse(batch.is_empty())
+    # An empty batch still counts as a true value.
+    self.assertTrue(BatchHttpRequest())
+
+  def execute(self, http, count, **kwargs):
+    callbacks = Callbacks()
+    batch = BatchHttpRequest(callback=callbacks, **kwargs)
+    for i in range(count):
+      batch.add(make_request('card%d' % i))
+    batch.execute(http=http)
+    return callbacks.calls
+
+  def test_single_request(self):
+    http = BatchHttp()
+    calls = self.execute(http, 5)
+    self.assertEqual([['1', '2', '3', '4', '5']], http.batches)
+    self.assertEqual([(str(i), {'id': str(i)}, None) for i in range(1, 6)],
+                     calls)
+
+  def test_chunks_in_sequence(self):
+    http = BatchHttp()
+    calls = self.execute(http, 5, max_batch_requests=2)
+    self.assertEqual([['1', '2'], ['3', '4'], ['5']], http.batches)
+    self.assertEqual([(str(i), {'id': str(i)}, None) for i in range(1, 6)],
+                     calls)
+
+  def test_concurrent_chunks_keep_callback_order(self):
+    # The first chunk is answered last.
+    http = BatchHttp(delays=[0.2])
+    calls = self.execute(http, 7, max_batch_requests=2, max_concurrency=3)
+    self.assertEqual([['1', '2'], ['3', '4'], ['5', '6'], ['7']],
+                     sorted(http.batches, key=lambda ids: int(ids[0])))
+    self.assertEqual([(str(i), {'id': str(i)}, None) for i in range(1, 8)],
+                     calls)
+
+  def test_error_status_per_request(self):
+    http = BatchHttp(statuses={'2': ['404']})
+    calls = self.execute(http, 3, max_batch_requests=2, max_concurrency=2)
+    self.assertEqual(['1', '2', '3'], [call[0] for call in calls])
+    self.assertEqual(None, calls[1][1])
+    self.assertTrue(isinstance(calls[1][2], HttpError))
+    self.assertEqual(404, calls[1][2].resp.status)
+
+  def test_failed_chunk_raises(self):
+    class FailingHttp(BatchHttp):
+      def request(self, uri, method='GET', body=None, headers=None,
+                  redirections=1, connection_type=None):
+        resp, content = BatchHttp.request(self, uri, method, body, headers)
+        if '3' in self.batches[-1]:
+          return httplib2.Response({'status': '503'}), ''
+        return resp, content
+
+    for max_concurrency in [1, 2]:
+      callbacks = Callbacks()
+      batch = BatchHttpRequest(callback=callbacks, max_batch_requests=2,
+                               max_concurrency=max_concurrency)
+      for i in range(4):
+        batch.add(make_request('card%d' % i))
+      self.assertRaises(HttpError, batch.execute, http=FailingHttp())
+      self.assertEqual([], callbacks.calls)
+
+
+class SerializeRequestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.batch = BatchHttpRequest()
+
+  def test_without_body(self):
+    self.assertEqual(
+        'GET /mirror/v1/timeline/card1?alt=json HTTP/1.1\n'
+        'Content-Type: application/json\n'
+        'MIME-Version: 1.0\n'
+        'Host: www.googleapis.com',
+        self.batch._serialize_request(make_request('card1')))
+
+  def test_with_body(self):
+    request = make_request('card1', 'PATCH', 'From a\nb\nFrom c',
+                           {'content-type': 'text/plain'})
+    self.assertEqual(
+        'PATCH /mirror/v1/timeline/card1?alt=json HTTP/1.1\n'
+        'Content-Type: text/plain\n'
+        'MIME-Version: 1.0\n'
+        'Host: www.googleapis.com\n'
+        'content-length: 15\n'
+        '\n'
+        '>From a\nb\n>From c',
+        self.batch._serialize_request(request))
+
+  def test_with_empty_body(self):
+    request = make_request('card1', 'PUT', '',
+                           {'content-type': 'application/json'})
+    self.assertEqual(
+        'PUT /mirror/v1/timeline/card1?alt=json HTTP/1.1\n'
+        'Content-Type: application/json\n'
+        'MIME-Version: 1.0\n'
+        'Host: www.googleapis.com\n'
+        'content-length: 0\n'
+        '\n',
+        self.batch._serialize_request(request))
+
+  def test_headers(self):
+    request = make_request('card1', headers={'From odd': 'v'})
+    self.assertEqual(
+        'GET /mirror/v1/timeline/card1?alt=json HTTP/1.1\n'
+        'Content-Type: application/json\n'
+        'MIME-Version: 1.0\n'
+        'From odd: v\n'
+        'Host: www.googleapis.com',
+        self.batch._serialize_request(request))
+
+
+class MultipartBodyTest(unittest.TestCase):
+
+  # Body the email package wrote for the requests of serialized().
+  EXPECTED = (
+      '--BOUNDARY\n'
+      'Content-Type: application/http\n'
+      'MIME-Version: 1.0\n'
+      'Content-Transfer-Encoding: binary\n'
+      'Content-ID: <base+1>\n'
+      '\n'
+      'PATCH /mirror/v1/timeline/card1?alt=json HTTP/1.1\n'
+      'Content-Type: text/plain\n'
+      'MIME-Version: 1.0\n'
+      'Host: www.googleapis.com\n'
+      'content-length: 15\n'
+      '\n'
+      '>From a\nb\n>From c\n'
+      '--BOUNDARY\n'
+      'Content-Type: application/http\n'
+      'MIME-Version: 1.0\n'
+      'Content-Transfer-Encoding: binary\n'
+      'Content-ID: <base+a%20b>\n'
+      '\n'
+      'GET /mirror/v1/timeline/card2?alt=json HTTP/1.1\n'
+      'Content-Type: application/json\n'
+      'MIME-Version: 1.0\n'
+      '>From odd: v\n'
+      'Host: www.googleapis.com\n'
+      '--BOUNDARY\n'
+      'Content-Type: application/http\n'
+      'MIME-Version: 1.0\n'
+      'Content-Transfer-Encoding: binary\n'
+      'Content-ID: <base+3>\n'
+      '\n'
+      'PUT /mirror/v1/timeline/card3?alt=json HTTP/1.1\n'
+      'Content-Type: application/json\n'
+      'MIME-Version: 1.0\n'
+      'Host: www.googleapis.com\n'
+      'content-length: 0\n'
+      '\n'
+      '\n'
+      '--BOUNDARY--\n')
+
+  def setUp(self):
+    self.batch = BatchHttpRequest()
+    self.batch._base_id = 'base'
+    self.order = ['1', 'a b', '3']
+    requests = [
+        make_request('card1', 'PATCH', 'From a\nb\nFrom c',
+                     {'content-type': 'text/plain'}),
+        make_request('card2', headers={'From odd': 'v'}),
+        make_request('card3', 'PUT', '', {'content-type': 'application/json'}),
+        ]
+    self.serialized = dict(
+        (request_id, self.batch._serialize_request(request))
+        for request_id, request in zip(self.order, requests))
+
+  def test_body(self):
+    self.assertEqual(
+        self.EXPECTED,
+        self.batch._multipart_body(self.order, self.serialized, 'BOUNDARY'))
+
+  def test_execute_chunk(self):
+    class CaptureHttp(object):
+      def request(self, uri, method='GET', body=None, headers=None,
+                  redirections=1, connection_type=None):
+        self.uri, self.method, self.body, self.headers = (
+            uri, method, body, headers)
+        return httplib2.Response({'status': '503'}), ''
+
+    http = CaptureHttp()
+    self.assertRaises(HttpError, self.batch._execute_chunk, http, self.order,
+                      self.serialized)
+    self.assertEqual('https://www.googleapis.com/batch', http.uri)
+    self.assertEqual('POST', http.method)
+    boundary = re.match('multipart/mixed; boundary="(.*)"$',
+                        http.headers['content-type']).group(1)
+    self.assertEqual(self.EXPECTED.replace('BOUNDARY', boundary), http.body)
+
+
+class NewBoundaryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.random = apiclient_http.random
+
+    class FixedRandom(object):
+      def randrange(self, stop):
+        return 42
+
+    apiclient_http.random = FixedRandom()
+
+  def tearDown(self):
+    apiclient_http.random = self.random
+
+  def test_boundary(self):
+    boundary = apiclient_http._new_boundary(['a', 'b'])
+    self.assertTrue(re.match('^=+0*42==$', boundary))
+
+  def test_boundary_not_in_parts(self):
+    boundary = apiclient_http._new_boundary([])
+    texts = ['x\n--%s\n' % boundary, '--%s.0' % boundary]
+    self.assertEqual(boundary + '.1', apiclient_http._new_boundary(texts))
+
+
+class ParseResponseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.batch = BatchHttpRequest()
+
+  def test_lf(self):
+    resp, content = self.batch._deserialize_response(
+        'HTTP/1.1 200 OK\n'
+        'Content-Type: application/json\n'
+        'ETag: "abc"\n'
+        '\n'
+        '{"a": 1}')
+    self.assertEqual(200, resp.status)
+    self.assertEqual('OK', resp.reason)
+    self.assertEqual(11, resp.version)
+    self.assertEqual('application/json', resp['content-type'])
+    self.assertEqual('"abc"', resp['etag'])
+    self.assertEqual('{"a": 1}', content)
+
+  def test_crlf(self):
+    resp, content = self.batch._deserialize_response(
+        'HTTP/1.1 404 Not Found\r\n'
+        'Content-Type: application/json\r\n'
+        '\r\n'
+        '{"a":\r\n 1}')
+    self.assertEqual(404, resp.status)
+    self.assertEqual('Not Found', resp.reason)
+    self.assertEqual('application/json', resp['content-type'])
+    self.assertEqual('{"a":\r\n 1}', content)
+
+  def test_folded_header(self):
+    resp, content = self.batch._deserialize_response(
+        'HTTP/1.1 200 OK\n'
+        'X-Long: a\n'
+        '  b\n'
+        '\tc\n'
+        'Content-Type: application/json\n'
+        '\n'
+        '{}')
+    self.assertEqual('a\r\n  b\r\n\tc', resp['x-long'])
+    self.assertEqual('application/json', resp['content-type'])
+    self.assertEqual('{}', content)
+
+  def test_no_reason_no_body(self):
+    resp, content = self.batch._deserialize_response('HTTP/1.0 204\n\n')
+    self.assertEqual(204, resp.status)
+    self.assertEqual('', resp.reason)
+    self.assertEqual(10, resp.version)
+    self.assertEqual('', content)
+
+  def test_no_status_line(self):
+    self.assertRaises(BatchError, self.batch._deserialize_response,
+                      'HTTP/1.1 200 OK')
+
+
+class IterResponsesTest(unittest.TestCase):
+
+  CONTENT_TYPE = 'multipart/mixed; boundary="batch_boundary"'
+
+  def setUp(self):
+    self.batch = BatchHttpRequest()
+
+  def parse(self, content, content_type=CONTENT_TYPE):
+    resp = httplib2.Response({'status': '200', 'content-type': content_type})
+    return [(request_id, response.status, response_content)
+            for request_id, response, response_content
+            in self.batch._iter_responses(resp, content)]
+
+  def test_crlf(self):
+    content = batch_response([('base+1', '200', '{"a": 1}'),
+                              ('base+a%20b', '404', '{}')])
+    self.assertEqual([('1', 200, '{"a": 1}'), ('a b', 404, '{}')],
+                     self.parse(content))
+
+  def test_lf(self):
+    content = batch_response([('base+1', '200', '{"a": 1}'),
+                              ('base+2', '404', '{}')]).replace('\r\n', '\n')
+    self.assertEqual([('1', 200, '{"a": 1}'), ('2', 404, '{}')],
+                     self.parse(content))
+
+  def test_unquoted_boundary(self):
+    content = batch_response([('base+1', '200', '{}')])
+    self.assertEqual(
+        [('1', 200, '{}')],
+        self.parse(content, 'multipart/mixed; boundary=batch_boundary'))
+
+  def test_preamble_epilogue_and_padding(self):
+    content = ('This is a preamble.\r\n'
+               '--batch_boundary \t\r\n'
+               'Content-Type: application/http\r\n'
+               'Content-ID: <response-base+1>\r\n'
+               '\r\n'
+               'HTTP/1.1 200 OK\r\n'
+               '\r\n'
+               '{}\r\n'
+               '--batch_boundary--  \r\n'
+               'This is an epilogue.\r\n'
+               '--batch_boundary\r\n')
+    self.assertEqual([('1', 200, '{}')], self.parse(content))
+
+  def test_folded_part_headers(self):
+    content = ('--batch_boundary\n'
+               'Content-Type:\n'
+               ' application/http\n'
+               'Content-ID: <response-base+1>\n'
+               '\n'
+               'HTTP/1.1 200 OK\n'
+               '\n'
+               '{}\n'
+               '--batch_boundary--\n')
+    self.assertEqual([('1', 200, '{}')], self.parse(content))
+
+  def test_lines_like_delimiters(self):
+    body = ('--batch_boundary-ish\r\n'
+            'x--batch_boundary\r\n'
+            '--batch_boundaryish')
+    content = batch_response([('base+1', '200', body), ('base+2', '200', '{}')])
+    self.assertEqual([('1', 200, body), ('2', 200, '{}')], self.parse(content))
+
+  def test_missing_close_delimiter(self):
+    content = batch_response([('base+1', '200', '{}'),
+                              ('base+2', '200', '[]')])
+    content = content[:content.rindex('\r\n--batch_boundary--')]
+    self.assertEqual([('1', 200, '{}'), ('2', 200, '[]')],
+                     self.parse(content))
+
+  def test_not_multipart(self):
+    content = batch_response([('base+1', '200', '{}')])
+    self.assertRaises(BatchError, self.parse, content, 'application/json')
+    self.assertRaises(BatchError, self.parse, content, 'multipart/mixed')
+
+  def test_no_delimiter(self):
+    self.assertRaises(BatchError, self.parse, 'HTTP/1.1 200 OK\r\n\r\n{}')
+
+  def test_missing_content_id(self):
+    content = ('--batch_boundary\r\n'
+               'Content-Type: application/http\r\n'
+               '\r\n'
+               'HTTP/1.1 200 OK\r\n'
+               '\r\n'
+               '{}\r\n'
+               '--batch_boundary--')
+    self.assertRaises(BatchError, self.parse, content)
+
+  def test_invalid_content_id(self):
+    content = batch_response([('base+1', '200', '{}')]).replace(
+        '<response-base+1>', 'response-base+1')
+    self.assertRaises(BatchError, self.parse, content)
+
+
+class Credentials(object):
+  """Credentials whose access token changes on each refresh."""
+
+  def __init__(self):
+    self.refreshes = 0
+
+  def refresh(self, http):
+    self.refreshes += 1
+
+  def apply(self, headers):
+    headers['authorization'] = 'Bearer %d' % self.refreshes
+
+
+class AuthorizedHttp(object):
+  """Wraps an http object the way Credentials.authorize() does."""
+
+  def __init__(self, http, credentials):
+    def request(*args, **kwargs):
+      return http.request(*args, **kwargs)
+    request.credentials = credentials
+    self.request = request
+
+
+class UnauthorizedRetryTest(unittest.TestCase):
+
+  def execute(self, statuses, **kwargs):
+    self.http = BatchHttp(statuses=statuses)
+    self.credentials = Credentials()
+    callbacks = Callbacks()
+    batch = BatchHttpRequest(callback=callbacks, **kwargs)
+    for i in range(5):
+      batch.add(make_request('card%d' % i))
+    batch.execute(http=AuthorizedHttp(self.http, self.credentials))
+    return callbacks.calls
+
+  def test_retry(self):
+    for kwargs in [{}, {'max_batch_requests': 2, 'max_concurrency': 2}]:
+      calls = self.execute({'2': ['401'], '4': ['401']}, **kwargs)
+      self.assertEqual(['2', '4'], self.http.batches[-1])
+      self.assertEqual(1, self.credentials.refreshes)
+      self.assertTrue('authorization: Bearer 1\n' in self.http.bodies[-1])
+      self.assertEqual([(str(i), {'id': str(i)}, None) for i in range(1, 6)],
+                       calls)
+
+  def test_still_unauthorized(self):
+    calls = self.execute({'2': ['401', '401']})
+    self.assertEqual([['1', '2', '3', '4', '5'], ['2']], self.http.batches)
+    self.assertEqual(['1', '2', '3', '4', '5'], [call[0] for call in calls])
+    self.assertEqual(None, calls[1][1])
+    self.assertEqual(401, calls[1][2].resp.status)
+
+  def test_no_retry(self):
+    calls = self.execute({})
+    self.assertEqual([['1', '2', '3', '4', '5']], self.http.batches)
+    self.assertEqual(0, self.credentials.refreshes)
+    self.assertEqual(5, len(calls))
+
+
+if __name__ == '__main__':
+  unittest.main()
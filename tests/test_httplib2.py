@@ -0,0 +1,268 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the connection pool of httplib2.
+
+Run from the root of the repository with:
+
+  python -m unittest discover -s tests
+"""
+
+
+import BaseHTTPServer
+import os
+import pickle
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import httplib2
+
+
+class Connection(object):
+  """Connection whose socket is one end of a socket pair."""
+
+  def __init__(self):
+    self.sock, self.peer = socket.socketpair()
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+    self.peer.close()
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.pool = httplib2.ConnectionPool(max_per_host=2, idle_timeout=60)
+
+  def tearDown(self):
+    self.pool.clear()
+
+  def test_get_returns_last_connection_put(self):
+    first, second = Connection(), Connection()
+    self.pool.put('http:example.com', first)
+    self.pool.put('http:example.com', second)
+    self.assertTrue(self.pool.get('http:example.com') is second)
+    self.assertTrue(self.pool.get('http:example.com') is first)
+    self.assertEqual(None, self.pool.get('http:example.com'))
+
+  def test_connections_are_per_host(self):
+    conn = Connection()
+    self.pool.put('http:example.com', conn)
+    self.assertEqual(None, self.pool.get('https:example.com'))
+    self.assertEqual(None, self.pool.get('http:example.org'))
+    self.assertTrue(self.pool.get('http:example.com') is conn)
+
+  def test_max_per_host(self):
+    connections = [Connection() for _ in range(3)]
+    for conn in connections:
+      self.pool.put('http:example.com', conn)
+    self.pool.put('http:example.org', Connection())
+    self.assertEqual([False, False, True],
+                     [conn.closed for conn in connections])
+    self.assertEqual(2, len(self.pool._idle['http:example.com']))
+    self.assertEqual(1, len(self.pool._idle['http:example.org']))
+
+  def test_idle_expiry(self):
+    stale, fresh = Connection(), Connection()
+    self.pool.put('http:example.com', fresh)
+    self.pool.put('http:example.com', stale)
+    idle = self.pool._idle['http:example.com']
+    idle[1] = (stale, time.time() - 61)
+    self.assertTrue(self.pool.get('http:example.com') is fresh)
+    self.assertTrue(stale.closed)
+    self.assertFalse(fresh.closed)
+
+  def test_closed_by_server(self):
+    conn = Connection()
+    self.pool.put('http:example.com', conn)
+    conn.peer.close()
+    self.assertEqual(None, self.pool.get('http:example.com'))
+    self.assertTrue(conn.closed)
+
+  def test_unexpected_data(self):
+    conn = Connection()
+    self.pool.put('http:example.com', conn)
+    conn.peer.sendall('HTTP/1.1 408 Request Timeout\r\n\r\n')
+    self.assertEqual(None, self.pool.get('http:example.com'))
+    self.assertTrue(conn.closed)
+
+  def test_without_socket(self):
+    conn = Connection()
+    conn.sock.close()
+    conn.sock = None
+    self.pool.put('http:example.com', conn)
+    self.assertEqual(None, self.pool.get('http:example.com'))
+    self.assertTrue(conn.closed)
+
+  def test_clear(self):
+    connections = [Connection(), Connection()]
+    self.pool.put('http:example.com', connections[0])
+    self.pool.put('http:example.org', connections[1])
+    self.pool.clear()
+    self.assertEqual([True, True], [conn.closed for conn in connections])
+    self.assertEqual(None, self.pool.get('http:example.com'))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers /ok with a short body and drops the connection on /drop."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    with self.server.lock:
+      self.server.connections += 1
+
+  def do_GET(self):
+    if self.path == '/drop':
+      self.close_connection = 1
+      return
+    body = 'ok'
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Local keep-alive HTTP server counting the connections it accepts."""
+
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+    self.lock = threading.Lock()
+    self.connections = 0
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+class PooledHttpTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = Server()
+    self.pool = httplib2.ConnectionPool()
+    self.conn_key = 'http:' + self.server.url[len('http://'):]
+
+  def tearDown(self):
+    self.pool.clear()
+    self.server.stop()
+
+  def http(self):
+    return httplib2.Http(proxy_info=None, connection_pool=self.pool)
+
+  def test_connection_reused_between_http_objects(self):
+    for _ in range(3):
+      resp, content = self.http().request(self.server.url + '/ok')
+      self.assertEqual(200, resp.status)
+      self.assertEqual('ok', content)
+    self.assertEqual(1, self.server.connections)
+    self.assertEqual(1, len(self.pool._idle[self.conn_key]))
+
+  def test_connection_not_kept_by_http(self):
+    http = self.http()
+    http.request(self.server.url + '/ok')
+    self.assertEqual({}, http.connections)
+
+  def test_connection_not_returned_after_error(self):
+    http = self.http()
+    http.request(self.server.url + '/ok')
+    self.assertRaises(Exception, http.request, self.server.url + '/drop')
+    self.assertEqual([], self.pool._idle[self.conn_key])
+    # The next request opens a new connection.
+    connections = self.server.connections
+    resp, content = http.request(self.server.url + '/ok')
+    self.assertEqual(200, resp.status)
+    self.assertEqual(connections + 1, self.server.connections)
+
+  def test_not_pooled_with_connection_type(self):
+    http = self.http()
+    http.request(self.server.url + '/ok',
+                 connection_type=httplib2.HTTPConnectionWithTimeout)
+    self.assertEqual(None, self.pool._idle.get(self.conn_key))
+
+
+class SharedHttpTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = Server()
+    self.pool = httplib2.ConnectionPool(max_per_host=4)
+    self.conn_key = 'http:' + self.server.url[len('http://'):]
+
+  def tearDown(self):
+    self.pool.clear()
+    self.server.stop()
+
+  def test_threads_share_http(self):
+    http = httplib2.Http(proxy_info=None, connection_pool=self.pool)
+    results = []
+    errors = []
+
+    def run():
+      try:
+        for _ in range(10):
+          resp, content = http.request(self.server.url + '/ok')
+          results.append((resp.status, content))
+      except Exception, e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual([], errors)
+    self.assertEqual([(200, 'ok')] * 80, results)
+    self.assertEqual({}, http.connections)
+    # At most one connection per thread is opened, and the pool keeps
+    # max_per_host of them.
+    self.assertTrue(self.server.connections <= 8)
+    self.assertTrue(len(self.pool._idle[self.conn_key]) <= 4)
+
+  def test_pickle(self):
+    http = httplib2.Http(proxy_info=None, connection_pool=self.pool)
+    http.request(self.server.url + '/ok')
+    unpickled = pickle.loads(pickle.dumps(http))
+    self.assertEqual(None, unpickled.connection_pool)
+    self.assertEqual({}, unpickled.connections)
+    self.assertFalse(unpickled._authorizations_lock is
+                     http._authorizations_lock)
+    resp, content = unpickled.request(self.server.url + '/ok')
+    self.assertEqual(200, resp.status)
+    unpickled.clear_credentials()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,187 @@
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the refreshes run by the notification worker.
+
+They need the App Engine SDK on the path, along with the libraries and
+Feedly keys the application is deployed with. Run from the root of the
+repository with:
+
+  python -m unittest discover -s tests
+"""
+
+
+import datetime
+import json
+import os
+import sys
+import unittest
+import urllib
+import urlparse
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'lib'))
+sys.path.insert(0, ROOT_DIR)
+
+import httplib2
+
+from apiclient.discovery import build_from_document
+from oauth2client.client import OAuth2Credentials
+from test_http import CONTENT_ID
+from test_http import batch_response
+
+try:
+  from google.appengine.ext import testbed
+  import main_handler
+  from model import FeedlyUser
+  import refresh_cards
+  import util
+except (ImportError, IOError):
+  testbed = None
+
+
+USER_ID = 'google-user'
+FEEDLY_USER_ID = 'feedly-user'
+
+
+def read_datafile(filename):
+  f = open(os.path.join(os.path.dirname(__file__), 'data', filename), 'r')
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+
+class MirrorHttp(object):
+  """Answers the Mirror API calls of a refresh on an empty timeline.
+
+  Attributes:
+    requests: list of the (method, path) of the requests received, the
+      requests of a batch are listed as ('BATCH', id).
+  """
+
+  def __init__(self, timeline_item):
+    self.timeline_item = timeline_item
+    self.requests = []
+
+  def request(self, uri, method='GET', body=None, headers=None,
+              redirections=1, connection_type=None):
+    path = urlparse.urlparse(uri).path
+    self.requests.append((method, path))
+    if path == '/batch':
+      content_ids = CONTENT_ID.findall(body)
+      for content_id in content_ids:
+        self.requests.append(
+            ('BATCH', urllib.unquote(content_id.rsplit('+', 1)[1])))
+      resp = httplib2.Response({
+          'status': '200',
+          'content-type': 'multipart/mixed; boundary="batch_boundary"'})
+      return resp, batch_response(
+          [(content_id, '200', '{"id": "new"}')
+           for content_id in content_ids])
+    if path == '/mirror/v1/timeline/' + self.timeline_item['id']:
+      content = self.timeline_item
+    elif method == 'GET':
+      content = {'items': []}
+    else:
+      content = {'id': 'new'}
+    return httplib2.Response({'status': '200'}), json.dumps(content)
+
+
+class FeedlyAPI(object):
+  """Feedly whose first access token has expired."""
+
+  def __init__(self):
+    self.profile_tokens = []
+    self.marked = []
+
+  def getProfile(self, token):
+    self.profile_tokens.append(token)
+    if token == 'expired':
+      return {'errorCode': 401}
+    return {'id': FEEDLY_USER_ID}
+
+  def refreshToken(self, refresh_token):
+    if refresh_token != 'refresh':
+      return {'errorCode': 400}
+    return {'access_token': 'fresh', 'expires_in': 3600}
+
+  def getStreamContentUser(self, token, userId, count=None, unreadOnly=None):
+    return {'items': [{
+        'id': 'entry1',
+        'title': 'Title',
+        'origin': {'title': 'Origin'},
+        'alternate': [{'href': 'http://example.com/entry1'}],
+        }]}
+
+  def markAsRead(self, token, entryIds):
+    self.marked.append((token, entryIds))
+
+
+@unittest.skipIf(testbed is None, 'Needs the App Engine SDK and Feedly SDK')
+class WorkerRefreshTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+
+    self.refresh_id = refresh_cards.new_refresh_id(FEEDLY_USER_ID)
+    refresh_cards.register(self.refresh_id)
+    self.http = MirrorHttp({'id': 'card', 'sourceItemId': self.refresh_id})
+    self.mirror = build_from_document(read_datafile('mirror.json'),
+                                      http=self.http)
+    self.feedly = FeedlyAPI()
+
+    self.saved = (main_handler.FeedlyAPI, util.create_service,
+                  util.SHARED_HTTP)
+    main_handler.FeedlyAPI = lambda user, secret: self.feedly
+    util.create_service = lambda service, version, creds=None: self.mirror
+    util.SHARED_HTTP = self.http
+
+    util.credentials_storage(USER_ID).put(OAuth2Credentials(
+        'access', 'client', 'secret', 'refresh-google',
+        datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+        'https://accounts.google.com/o/oauth2/token', 'test'))
+    FeedlyUser(key_name=USER_ID, id=USER_ID, feedly_access_token='expired',
+               feedly_refresh_token='refresh',
+               feedly_token_expiry=datetime.datetime.utcnow()).put()
+
+  def tearDown(self):
+    (main_handler.FeedlyAPI, util.create_service,
+     util.SHARED_HTTP) = self.saved
+    self.testbed.deactivate()
+
+  def test_refresh_with_expired_token(self):
+    job = {'userToken': USER_ID, 'itemId': 'card', 'payloads': ['refresh']}
+    main_handler.process_notification(job)
+
+    self.assertEqual(['expired', 'fresh'], self.feedly.profile_tokens)
+    user = FeedlyUser.get_by_key_name(USER_ID)
+    self.assertEqual('fresh', user.feedly_access_token)
+    self.assertTrue(user.feedly_token_expiry > datetime.datetime.utcnow())
+    # The subscription of the user is checked and recorded.
+    self.assertTrue(('POST', '/mirror/v1/subscriptions') in self.http.requests)
+    self.assertNotEqual(None, user.subscription_verified)
+    self.assertNotEqual(None, user.timeline_watermark)
+    self.assertTrue(('BATCH', 'entry1') in self.http.requests)
+    self.assertEqual([('fresh', ['entry1'])], self.feedly.marked)
+    # The refresh card was consumed.
+    self.assertFalse(refresh_cards.consume(self.refresh_id))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how long building a service from its discovery document takes.
+
+For each document, reports the time build_from_document takes on a cold
+instance, where method docstrings are built lazily, and the time it takes
+when every docstring is then read as well, which is what building used to
+cost when docstrings were rendered eagerly.
+
+Usage:
+  python tools/benchmark_discovery.py [--iterations N] [DOCUMENT.json ...]
+
+Without documents, the Mirror v1 and OAuth2 v2 documents are fetched from the
+discovery service.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import httplib2
+from apiclient import discovery
+from apiclient.http import HttpMock
+
+
+DEFAULT_APIS = (('mirror', 'v1'), ('oauth2', 'v2'))
+
+
+def fetch_document(api, version):
+  """Return the discovery document of an API from the discovery service."""
+  uri = discovery.DISCOVERY_URI.replace('{api}', api).replace(
+      '{apiVersion}', version)
+  try:
+    resp, content = httplib2.Http().request(uri)
+  except (httplib2.HttpLib2Error, IOError), e:
+    raise SystemExit('Unable to fetch %s: %s\n'
+                     'Pass the discovery documents as arguments instead.'
+                     % (uri, e))
+  if resp.status >= 300:
+    raise SystemExit('Unable to fetch %s: %s' % (uri, resp.status))
+  return content
+
+
+def read_all_docs(template):
+  """Read the docstring of every method of template and its nested ones."""
+  for _, method in template.methods:
+    method.__doc__
+  for nested in template.resources.itervalues():
+    read_all_docs(nested)
+
+
+def build_cold(document, with_docs):
+  """Build a service as on a new instance, optionally reading all docs."""
+  discovery._service_templates.clear()
+  service = discovery.build_from_document(
+      document, http=HttpMock(None, {'status': '200'}))
+  if with_docs:
+    read_all_docs(service._template)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('documents', nargs='*',
+                      help='discovery documents to build services from')
+  parser.add_argument('--iterations', type=int, default=50,
+                      help='number of builds timed per document')
+  args = parser.parse_args(argv[1:])
+
+  if args.documents:
+    documents = [(path, open(path).read()) for path in args.documents]
+  else:
+    documents = [('%s %s' % api, fetch_document(*api)) for api in DEFAULT_APIS]
+
+  print '%-30s %14s %14s' % ('document', 'lazy docs', 'all docs')
+  for name, document in documents:
+    timings = []
+    for with_docs in (False, True):
+      seconds = min(timeit.repeat(
+          lambda: build_cold(document, with_docs), repeat=3,
+          number=args.iterations)) / args.iterations
+      timings.append('%.2f ms' % (seconds * 1000))
+    print '%-30s %14s %14s' % (name, timings[0], timings[1])
+
+
+if __name__ == '__main__':
+  main(sys.argv)
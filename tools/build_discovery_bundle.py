@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Snapshots the discovery documents of the APIs used into a bundle.
+
+util.create_service builds services from the bundle instead of fetching the
+documents when a new instance starts. Run this before deploying, with the
+same version of Python as App Engine, and again whenever an API changes:
+
+  python tools/build_discovery_bundle.py [--output discovery.bundle] \
+      [API:VERSION ...]
+
+Without APIs, the bundle holds Mirror v1 and OAuth2 v2.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import httplib2
+import uritemplate
+from apiclient import discovery
+
+
+DEFAULT_APIS = ('mirror:v1', 'oauth2:v2')
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), '..',
+                              'discovery.bundle')
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('apis', nargs='*', default=DEFAULT_APIS,
+                      help='APIs to snapshot, as name:version')
+  parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                      help='path of the bundle to write')
+  args = parser.parse_args(argv[1:])
+
+  http = httplib2.Http()
+  entries = {}
+  for api in args.apis:
+    name, version = api.split(':', 1)
+    url = uritemplate.expand(discovery.DISCOVERY_URI,
+                             {'api': name, 'apiVersion': version})
+    entry = discovery._fetch_discovery_document(http, url, name, version)
+    # Building the service normalizes the parameters of the document in
+    # place, so that is stored as well.
+    discovery.build_from_document(entry.service, http=http)
+    entries[url] = entry
+    print 'Added %s %s (revision %s)' % (name, version,
+                                        entry.service.get('revision'))
+
+  discovery.DiscoveryBundle(entries, time.time()).save(args.output)
+  print 'Wrote %s' % args.output
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -17,14 +17,20 @@
 __author__ = 'alainv@google.com (Alain Vongsouvanh)'
 
 
+import datetime
 from urlparse import urlparse
 
 import httplib2
+from FeedlyKey import FEEDLY_USER, FEEDLY_SECRET
+from apiclient.discovery import DiscoveryBundle
 from apiclient.discovery import build
+from google.appengine.api import memcache
 from oauth2client.appengine import StorageByKeyName
 from oauth2client.client import AccessTokenRefreshError
 import sessions
 
+import cache
+from lib.FeedlySDK.FeedlyApi import FeedlyAPI
 from model import Credentials
 
 
@@ -33,6 +39,29 @@ from model import Credentials
 # python -c "import os; print os.urandom(64)" > session.secret
 SESSION_SECRET = open('session.secret').read()
 
+# Discovery documents of the APIs used, snapshotted with
+# tools/build_discovery_bundle.py so that new instances don't have to fetch
+# them. None if the bundle is missing.
+DISCOVERY_BUNDLE = DiscoveryBundle.load('discovery.bundle')
+
+# Connections to Google APIs are kept open and shared by every request served
+# by this instance instead of being set up again for each one.
+HTTP_CONNECTION_POOL = httplib2.ConnectionPool()
+
+# Http instance for requests that carry no user credentials of their own, such
+# as token refreshes and batch requests. Since it borrows its connections from
+# the pool it can be shared by all the threads of the instance.
+SHARED_HTTP = httplib2.Http(connection_pool=HTTP_CONNECTION_POOL)
+
+# Credentials are read on every request and rarely written, so they are cached
+# on the instance in front of memcache instead of being loaded and unpickled
+# from the datastore each time.
+CREDENTIALS_CACHE = cache.TwoTierCache(memcache, key_prefix='credentials#')
+
+# Access tokens this close to expiring are refreshed before handling a request
+# rather than risking that they expire halfway through it.
+TOKEN_REFRESH_SKEW = datetime.timedelta(minutes=5)
+
 
 def get_full_url(request_handler, path):
   """Return the full url from the provided request handler and path."""
@@ -40,12 +69,18 @@ def get_full_url(request_handler, path):
   return '%s://%s%s' % (pr.scheme, pr.netloc, path)
 
 
+def credentials_storage(userid):
+  """Return the Storage of a user's credentials, behind CREDENTIALS_CACHE."""
+  return StorageByKeyName(Credentials, userid, 'credentials',
+                          cache=CREDENTIALS_CACHE)
+
+
 def load_session_credentials(request_handler):
   """Load credentials from the current session."""
   session = sessions.LilCookies(request_handler, SESSION_SECRET)
   userid = session.get_secure_cookie(name='userid')
   if userid:
-    return userid, StorageByKeyName(Credentials, userid, 'credentials').get()
+    return userid, credentials_storage(userid).get()
   else:
     return None, None
 
@@ -56,11 +91,22 @@ def store_userid(request_handler, userid):
   session.set_secure_cookie(name='userid', value=userid)
 
 
+def create_http():
+  """Create an Http instance that uses the shared connection pool.
+
+  Use this rather than SHARED_HTTP for anything that is going to be authorized
+  with a user's credentials, since authorizing modifies the Http instance.
+  """
+  return httplib2.Http(connection_pool=HTTP_CONNECTION_POOL)
+
+
 def create_service(service, version, creds=None):
   """Create a Google API service.
 
   Load an API service from a discovery document and authorize it with the
-  provided credentials.
+  provided credentials. Discovery documents come from DISCOVERY_BUNDLE, are
+  cached per instance and shared between instances through memcache, so this
+  rarely touches the network.
 
   Args:
     service: Service name (e.g 'mirror', 'oauth2').
@@ -70,13 +116,84 @@ def create_service(service, version, creds=None):
     Authorized Google API service.
   """
   # Instantiate an Http instance
-  http = httplib2.Http()
+  http = create_http()
 
   if creds:
     # Authorize the Http instance with the passed credentials
     creds.authorize(http)
 
-  return build(service, version, http=http)
+  return build(service, version, http=http, cache=memcache,
+               bundle=DISCOVERY_BUNDLE)
+
+
+def iter_pages(collection, request, method_name='list'):
+  """Yield the response of a list request, then the ones of its next pages.
+
+  Pages are only requested as they are consumed, so a caller that stops
+  iterating early doesn't fetch the remaining ones.
+
+  Args:
+    collection: Resource the request was made from (e.g service.timeline()).
+    request: HttpRequest for the first page.
+    method_name: Name of the list method, whose _next method is used to
+      request the next pages.
+  """
+  next_method = getattr(collection, method_name + '_next')
+  while request is not None:
+    response = request.execute()
+    yield response
+    request = next_method(request, response)
+
+
+def credentials_need_refresh(credentials, skew=TOKEN_REFRESH_SKEW):
+  """Return whether the access token must be refreshed before it is used.
+
+  Args:
+    credentials: OAuth2Credentials to check.
+    skew: datetime.timedelta, how long before its expiry a token is already
+      treated as expired.
+  Returns:
+    True if the access token is missing, invalid or expires within skew.
+  """
+  if not credentials.access_token or credentials.access_token_expired:
+    return True
+  expiry = credentials.token_expiry
+  return expiry is not None and datetime.datetime.utcnow() + skew >= expiry
+
+
+def feedly_token_expiry(token_response):
+  """Return when a token obtained from Feedly expires.
+
+  Args:
+    token_response: dict, response of FeedlyAPI.getToken or refreshToken.
+  Returns:
+    datetime.datetime in UTC, or None if the response has no expires_in.
+  """
+  expires_in = token_response.get('expires_in')
+  if expires_in is None:
+    return None
+  return datetime.datetime.utcnow() + datetime.timedelta(
+      seconds=int(expires_in))
+
+
+def refresh_feedly_token(user, fa=None):
+  """Refresh a user's Feedly access token and store the new one.
+
+  Args:
+    user: FeedlyUser entity whose token is refreshed.
+    fa: FeedlyAPI instance to use, a new one is created if None.
+  Returns:
+    The new access token, or None if Feedly refused to refresh it.
+  """
+  if fa is None:
+    fa = FeedlyAPI(FEEDLY_USER, FEEDLY_SECRET)
+  resp = fa.refreshToken(user.feedly_refresh_token)
+  if 'access_token' not in resp:
+    return None
+  user.feedly_access_token = resp['access_token']
+  user.feedly_token_expiry = feedly_token_expiry(resp)
+  user.put()
+  return user.feedly_access_token
 
 
 def auth_required(handler_method):
@@ -85,17 +202,18 @@ def auth_required(handler_method):
   def check_auth(self, *args):
     self.userid, self.credentials = load_session_credentials(self)
     self.mirror_service = create_service('mirror', 'v1', self.credentials)
-    # TODO: Also check that credentials are still valid.
     if self.credentials:
       try:
-        self.credentials.refresh(httplib2.Http())
+        # Only refresh tokens that are about to expire. Tokens revoked or
+        # expired early are refreshed on the first 401 by the Http instance
+        # the credentials authorized in create_service.
+        if credentials_need_refresh(self.credentials):
+          self.credentials.refresh(SHARED_HTTP)
         return handler_method(self, *args)
       except AccessTokenRefreshError:
         # Access has been revoked.
         store_userid(self, '')
-        credentials_entity = Credentials.get_by_key_name(self.userid)
-        if credentials_entity:
-          credentials_entity.delete()
+        credentials_storage(self.userid).delete()
     self.redirect('/auth')
   return check_auth
 